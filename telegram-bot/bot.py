@@ -1,6 +1,7 @@
 import asyncio
 import atexit
 import base64
+import contextvars
 import hashlib
 import io
 import logging
@@ -8,7 +9,13 @@ import os
 import random
 import re
 import signal
+import sqlite3
+import threading
 import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 
 # ── Защита от дублирования: только 1 экземпляр бота ──────────────
@@ -56,14 +63,16 @@ def _kill_old_instance() -> None:
     atexit.register(_remove_pid_file)
 
 _kill_old_instance()
-from typing import Optional, Dict, List, Any, Tuple
+from typing import Optional, Dict, List, Any, Tuple, Callable, Awaitable
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from openai import OpenAI
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
 
 # Буфер фото по user_id для разового разбора (доступен из job)
-_pending: Dict[int, Dict[str, Any]] = {}  # user_id -> {"chat_id": int, "file_ids": [(file_id, mime), ...]}
+_pending: Dict[int, Dict[str, Any]] = {}  # user_id -> {"chat_id": int, "file_ids": [(file_id, mime, file_unique_id), ...]}
 # Последнее заключение по user_id для кнопок «Диагноз» и «Лечение»
 _user_last: Dict[int, Dict[str, str]] = {}  # user_id -> {"diagnosis": str, "treatment": str}
 # Отложенные задачи батча, когда job_queue недоступен: user_id -> asyncio.Task
@@ -171,9 +180,9 @@ MEDICAL_QUESTIONS = MEDICAL_QUESTIONS_FULL[:5]
 def _ai_choice_keyboard() -> Optional[InlineKeyboardMarkup]:
     """Инлайн-кнопки выбора ИИ (только доступные провайдеры)."""
     buttons = []
-    if _use_groq():
+    if _provider_available("groq"):
         buttons.append(InlineKeyboardButton("Groq", callback_data=CB_GROQ))
-    if get_openai_client():
+    if _provider_available("openai"):
         buttons.append(InlineKeyboardButton("OpenAI (GPT)", callback_data=CB_OPENAI))
     if not buttons:
         return None
@@ -248,40 +257,37 @@ def _sheet_start_row(tg_username: str = "", tg_phone: str = "") -> Tuple[Optiona
     """
     Создаёт новую строку (id + дата + telegram + телефон) в начале опроса.
     Возвращает (row_index_1based, id, None) или (None, None, ошибка).
+    В режиме SQLite вместо номера строки возвращается -id анкеты в базе (отрицательный ключ).
     """
+    if _use_db():
+        survey_id = _db_start_survey(tg_username, tg_phone)
+        return -survey_id, survey_id, None
     try:
         wks, err = _get_sheet_wks()
         if wks is None:
             return None, None, err
-        rows = wks.get_all_values()
 
         expected_header = SHEET_HEADER
-        if not rows:
-            wks.append_row(expected_header, value_input_option="RAW")
-            rows = [expected_header]
-        elif not _sheet_cache.get("header_ok"):
-            current_header = rows[0][:len(expected_header)]
-            if current_header != expected_header:
-                cell_range = f"A1:{chr(64 + len(expected_header))}1"
-                wks.update(cell_range, [expected_header], value_input_option="RAW")
+        if not _sheet_cache.get("header_ok"):
+            current_header = wks.row_values(1)[:len(expected_header)]
+            if not current_header:
+                wks.append_row(expected_header, value_input_option="RAW")
+            elif current_header != expected_header:
+                from gspread.utils import rowcol_to_a1
+
+                wks.update(f"A1:{rowcol_to_a1(1, len(expected_header))}", [expected_header], value_input_option="RAW")
             _sheet_cache["header_ok"] = True
 
-        new_id = 1
-        for i, row in enumerate(rows):
-            if i == 0:
-                continue
-            if row and row[0]:
-                try:
-                    existing_id = int(row[0])
-                    if existing_id >= new_id:
-                        new_id = existing_id + 1
-                except (ValueError, TypeError):
-                    pass
-
+        new_id = _allocate_id("surveys", lambda: _sheet_max_id(wks))
         now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
         new_row = [str(new_id), now, tg_username or "", tg_phone or ""] + [""] * len(MEDICAL_QUESTIONS)
-        wks.append_row(new_row, value_input_option="RAW")
-        row_index = len(rows) + 1
+        resp = wks.append_row(new_row, value_input_option="RAW")
+        row_index = _appended_row(resp)
+        if row_index is None:
+            row_index = wks.find(str(new_id), in_column=1).row
+        with _survey_index_lock:
+            if _survey_index["loaded_at"]:
+                _survey_index_add_rows([new_row], row_index)
         return row_index, new_id, None
     except Exception as e:
         _sheet_cache["wks"] = None
@@ -289,25 +295,246 @@ def _sheet_start_row(tg_username: str = "", tg_phone: str = "") -> Tuple[Optiona
         return None, None, str(e)[:200]
 
 
-def _sheet_update_answer(row_index: int, step: int, value: str) -> Optional[str]:
+# Отложенная запись в лист опроса: ответы копятся в памяти (строка → столбец → значение, повторная запись
+# той же ячейки заменяет прежнюю) и уходят одним batch_update раз в SHEET_FLUSH_SEC и по окончании опроса.
+# Не ушедшее из-за ошибки остаётся в очереди до следующей попытки и сохраняется на диск, в том числе при
+# остановке, — после перезапуска очередь дописывается
+SHEET_FLUSH_SEC = float(os.getenv("SHEET_FLUSH_SEC", "5"))
+SHEET_QUEUE_PATH = os.getenv(
+    "SHEET_QUEUE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sheet_queue.json")
+)
+_sheet_writes: Dict[int, Dict[int, str]] = {}
+_sheet_write_state: Dict[str, Any] = {"flushes": 0, "cells": 0, "calls": 0, "failures": 0, "dirty": False}
+_sheet_flush_lock = asyncio.Lock()
+
+
+def _sheet_queue_cell(row_index: int, col: int, value: str) -> None:
+    _sheet_writes.setdefault(row_index, {})[col] = value
+    _sheet_write_state["dirty"] = True
+    _survey_index_set_cell(row_index, col, value)
+
+
+def _sheet_update_answer(row_index: int, step: int, value: str) -> None:
     """
-    Записывает ответ на вопрос step (1-based) в строку row_index.
+    Ставит в очередь ответ на вопрос step (1-based) для строки row_index.
     Столбец: A=id, B=дата, C=telegram, D=телефон, E=q1(step1), F=q2(step2), …
     """
+    if row_index < 0 or _use_db():
+        _db_update_survey(row_index, step, (value or "")[:500])
+        return
+    col = step + 4  # step 1 → col 5 (E), step 2 → col 6 (F), ...
+    _sheet_queue_cell(row_index, col, (value or "")[:500])
+
+
+def _sheet_update_phone(row_index: int, phone: str) -> None:
+    """Ставит в очередь номер телефона для столбца D (телефон)."""
+    if row_index < 0 or _use_db():
+        _db_update_survey(row_index, phone=phone)
+        return
+    _sheet_queue_cell(row_index, 4, phone)
+
+
+def _sheet_batch_ranges(writes: Dict[int, Dict[int, str]]) -> List[Dict[str, Any]]:
+    """Ячейки → диапазоны для batch_update: подряд идущие столбцы одной строки — один диапазон."""
+    from gspread.utils import rowcol_to_a1
+
+    ranges: List[Dict[str, Any]] = []
+    for row_index in sorted(writes):
+        cols = sorted(writes[row_index])
+        run: List[int] = []
+        for col in cols + [0]:
+            if run and col != run[-1] + 1:
+                ranges.append({
+                    "range": f"{rowcol_to_a1(row_index, run[0])}:{rowcol_to_a1(row_index, run[-1])}",
+                    "values": [[writes[row_index][c] for c in run]],
+                })
+                run = []
+            run.append(col)
+    return ranges
+
+
+def _sheet_write_batch(writes: Dict[int, Dict[int, str]]) -> Optional[str]:
     try:
         wks, err = _get_sheet_wks()
         if wks is None:
-            return err
-        col = step + 4  # step 1 → col 5 (E), step 2 → col 6 (F), ...
-        cell_value = (value or "")[:500]
-        wks.update_cell(row_index, col, cell_value)
+            return err or "Таблица недоступна"
+        wks.batch_update(_sheet_batch_ranges(writes), value_input_option="USER_ENTERED")
         return None
     except Exception as e:
         _sheet_cache["wks"] = None
-        logger.exception("Google Sheet update cell error: %s", e)
+        logger.exception("Google Sheet batch update error: %s", e)
         return str(e)[:200]
 
 
+async def _sheet_flush() -> bool:
+    """Отправляет накопленные записи одним запросом. True — очередь пуста."""
+    async with _sheet_flush_lock:
+        if not _sheet_writes:
+            return True
+        writes = {row: dict(cells) for row, cells in _sheet_writes.items()}
+        _sheet_writes.clear()
+        err = await asyncio.to_thread(_sheet_write_batch, writes)
+        if err is None:
+            _sheet_write_state["flushes"] += 1
+            _sheet_write_state["calls"] += 1
+            _sheet_write_state["cells"] += sum(len(cells) for cells in writes.values())
+            return not _sheet_writes
+        # Возвращаем в очередь; то, что успели записать заново за время запроса, новее — его не трогаем
+        for row, cells in writes.items():
+            pending = _sheet_writes.setdefault(row, {})
+            for col, value in cells.items():
+                pending.setdefault(col, value)
+        _sheet_write_state["failures"] += 1
+        _sheet_write_state["dirty"] = True
+        logger.warning("Запись в таблицу отложена (%d строк): %s", len(_sheet_writes), err)
+        await asyncio.to_thread(_sheet_queue_save)
+        return False
+
+
+def _sheet_queue_save() -> None:
+    """Сохраняет неотправленные записи на диск атомарно (пустая очередь — файл удаляется)."""
+    if not _sheet_write_state["dirty"]:
+        return
+    _sheet_write_state["dirty"] = False
+    try:
+        if not _sheet_writes:
+            if os.path.exists(SHEET_QUEUE_PATH):
+                os.remove(SHEET_QUEUE_PATH)
+            return
+        data = [[row, list(cells.items())] for row, cells in _sheet_writes.items()]
+        tmp_path = SHEET_QUEUE_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            _json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, SHEET_QUEUE_PATH)
+    except OSError as e:
+        logger.warning("Очередь записи в таблицу не сохранена: %s", e)
+
+
+def _sheet_queue_load() -> None:
+    """Читает с диска записи, не отправленные до перезапуска."""
+    try:
+        with open(SHEET_QUEUE_PATH, encoding="utf-8") as f:
+            data = _json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.warning("Очередь записи в таблицу не прочитана: %s", e)
+        return
+    for row, cells in data:
+        for col, value in cells:
+            _sheet_writes.setdefault(int(row), {}).setdefault(int(col), value)
+    _sheet_write_state["dirty"] = True
+    logger.info("Очередь записи в таблицу: восстановлено %d строк", len(_sheet_writes))
+
+
+async def _job_sheet_flush(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if STORAGE_BACKEND == "sqlite" and not _db_state["ready"] and await _sheet_flush():
+        # Очередь записи выгружена — импорт увидит все ответы, начатые в режиме sheets
+        try:
+            _db_state["ready"] = await asyncio.to_thread(_db_import_sheets)
+        except Exception as e:
+            logger.warning("Импорт из таблицы в базу не выполнен: %s", e)
+        if _db_state["ready"]:
+            logger.info("Импорт завершён, данные обслуживает база")
+    if _use_db():
+        await asyncio.to_thread(_db_replicate)
+    elif await _sheet_flush():
+        await asyncio.to_thread(_sheet_queue_save)
+
+
+# Индекс листа опроса в памяти (режим sheets): telegram-username → последняя строка с этим username и её
+# содержимое. Лист читается целиком один раз (при старте), при промахе дочитываются только строки, добавленные
+# после загрузки; раз в SURVEY_INDEX_TTL_SEC — полная перезагрузка, чтобы подхватить ручные правки.
+# Свои изменения (новая анкета, ответы из очереди записи) бот отражает в индексе сразу. Лист читается без
+# lock: _survey_index_set_cell вызывается из цикла событий и не должен ждать сетевой запрос. Изменения,
+# пришедшие во время перезагрузки, и ещё не выгруженная очередь записи накладываются на новый снимок
+SURVEY_INDEX_TTL_SEC = 600
+_SURVEY_TG_COL = 2  # C (0-based), столбец "telegram"
+_survey_index: Dict[str, Any] = {
+    "by_tg": {}, "row_tg": {}, "rows": 0, "loaded_at": 0.0, "loading": False, "edits": [],
+}
+_survey_index_lock = threading.RLock()
+
+
+def _survey_index_add_rows(rows: List[List[str]], first_row_index: int) -> None:
+    """Добавляет строки листа в индекс. Вызывать под _survey_index_lock."""
+    by_tg, row_tg = _survey_index["by_tg"], _survey_index["row_tg"]
+    for offset, row in enumerate(rows):
+        tg = row[_SURVEY_TG_COL].strip().lower() if len(row) > _SURVEY_TG_COL else ""
+        if not tg:
+            continue
+        row_index = first_row_index + offset
+        prev = by_tg.get(tg)
+        if prev and prev[0] >= row_index:
+            continue  # более новая строка или та же, но снимок уже свежее листа
+        if prev:
+            row_tg.pop(prev[0], None)
+        by_tg[tg] = (row_index, list(row))
+        row_tg[row_index] = tg
+    _survey_index["rows"] = max(_survey_index["rows"], first_row_index + len(rows) - 1)
+
+
+def _survey_index_apply(row_index: int, col: int, value: str) -> None:
+    """Запись ячейки (col 1-based) в снимок строки, если строка в индексе. Вызывать под _survey_index_lock."""
+    tg = _survey_index["row_tg"].get(row_index)
+    if tg is None:
+        return
+    row = _survey_index["by_tg"][tg][1]
+    if len(row) < col:
+        row.extend([""] * (col - len(row)))
+    row[col - 1] = value
+
+
+def _survey_index_load(wks) -> None:
+    """Загружает индекс заново, если он пуст или устарел (и другой поток его уже не грузит)."""
+    with _survey_index_lock:
+        fresh = _survey_index["loaded_at"] and time.monotonic() - _survey_index["loaded_at"] < SURVEY_INDEX_TTL_SEC
+        if fresh or _survey_index["loading"]:
+            return
+        _survey_index.update(loading=True, edits=[])
+    try:
+        rows = wks.get_all_values()
+    except Exception:
+        with _survey_index_lock:
+            _survey_index.update(loading=False, edits=[])
+        raise
+    pending = [(row, col, value) for row, cells in list(_sheet_writes.items()) for col, value in list(cells.items())]
+    with _survey_index_lock:
+        _survey_index.update(by_tg={}, row_tg={}, rows=1)
+        _survey_index_add_rows(rows[1:], 2)
+        for row, col, value in pending + _survey_index["edits"]:
+            _survey_index_apply(row, col, value)
+        _survey_index.update(loaded_at=time.monotonic(), loading=False, edits=[])
+        n_tg = len(_survey_index["by_tg"])
+    logger.info("Индекс опроса загружен: %s строк, %s username", len(rows), n_tg)
+
+
+def _survey_index_reset() -> None:
+    with _survey_index_lock:
+        _survey_index.update(by_tg={}, row_tg={}, rows=0, loaded_at=0.0)
+
+
+def _survey_index_set_cell(row_index: int, col: int, value: str) -> None:
+    """Отражает запись ячейки (col 1-based) в снимке строки, если строка в индексе."""
+    with _survey_index_lock:
+        if _survey_index["loading"]:
+            _survey_index["edits"].append((row_index, col, value))
+        _survey_index_apply(row_index, col, value)
+
+
+def _survey_index_warm() -> None:
+    """Загрузка индекса при старте, чтобы первый вход пациента не ждал чтения листа."""
+    if _use_db():
+        return
+    try:
+        wks, _ = _get_sheet_wks()
+        if wks is not None:
+            _survey_index_load(wks)
+    except Exception as e:
+        _survey_index_reset()
+        logger.warning("Индекс опроса не загружен: %s", e)
+
+
 def _sheet_load_survey_by_tg(tg_username: str) -> Optional[Dict[str, str]]:
     """
     Ищет последнюю строку в таблице опроса по telegram-username.
@@ -315,20 +542,27 @@ def _sheet_load_survey_by_tg(tg_username: str) -> Optional[Dict[str, str]]:
     """
     if not tg_username:
         return None
+    if _use_db():
+        return _db_load_survey_by_tg(tg_username)
     try:
         wks, err = _get_sheet_wks()
         if wks is None:
             return None
-        rows = wks.get_all_values()
-        if len(rows) <= 1:
-            return None
-        tg_col = 2  # C (0-based), column "telegram"
-        best_row = None
-        for row in rows[1:]:
-            if len(row) > tg_col and row[tg_col].strip().lower() == tg_username.strip().lower():
-                best_row = row
-        if not best_row:
+        tg = tg_username.strip().lower()
+        _survey_index_load(wks)
+        with _survey_index_lock:
+            hit = _survey_index["by_tg"].get(tg)
+            first = _survey_index["rows"] + 1
+        if hit is None and first <= wks.row_count:
+            tail = wks.get_values(f"{first}:{wks.row_count}")
+            with _survey_index_lock:
+                if tail:
+                    _survey_index_add_rows(tail, first)
+                hit = _survey_index["by_tg"].get(tg)
+        if hit is None:
             return None
+        with _survey_index_lock:
+            best_row = list(hit[1])
         answers: Dict[str, str] = {}
         n_questions = len(MEDICAL_QUESTIONS)
         for i in range(n_questions):
@@ -338,6 +572,7 @@ def _sheet_load_survey_by_tg(tg_username: str) -> Optional[Dict[str, str]]:
                 answers[f"q{i+1}"] = val
         return answers if answers else None
     except Exception as e:
+        _survey_index_reset()
         logger.warning("_sheet_load_survey_by_tg error: %s", e)
         return None
 
@@ -391,90 +626,145 @@ def _hash_password(password: str) -> str:
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
 
+# Индекс листа users в памяти: email → запись. Лист читается целиком один раз,
+# дальше при промахе дочитываются только строки, добавленные после загрузки (другим процессом или
+# вручную); полная перезагрузка — раз в USERS_INDEX_TTL_SEC, чтобы подхватить правки в самих строках.
+# Свои записи бот сразу отражает в индексе. Функции вызываются через asyncio.to_thread — отсюда lock
+USERS_INDEX_TTL_SEC = 600
+_users_index: Dict[str, Any] = {"by_email": {}, "rows": 0, "max_id": 0, "loaded_at": 0.0}
+_users_index_lock = threading.RLock()
+
+
+def _user_record(row: List[str], row_index: int) -> Dict[str, str]:
+    rec: Dict[str, Any] = {name: (row[i] if len(row) > i else "") for i, name in enumerate(USERS_SHEET_HEADER)}
+    rec["row_index"] = row_index
+    return rec
+
+
+def _users_index_put(rec: Dict[str, Any]) -> None:
+    email = rec["email"].strip().lower()
+    if not email:
+        return
+    _users_index["by_email"][email] = rec
+    try:
+        _users_index["max_id"] = max(_users_index["max_id"], int(rec["id"]))
+    except (ValueError, TypeError):
+        pass
+
+
+def _users_index_add_rows(rows: List[List[str]], first_row_index: int) -> None:
+    for offset, row in enumerate(rows):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        rec = _user_record(row, first_row_index + offset)
+        if rec["email"].strip().lower() in _users_index["by_email"]:
+            # Дубликат email в листе: как и раньше, действует первая строка
+            try:
+                _users_index["max_id"] = max(_users_index["max_id"], int(rec["id"]))
+            except (ValueError, TypeError):
+                pass
+            continue
+        _users_index_put(rec)
+    _users_index["rows"] = max(_users_index["rows"], first_row_index + len(rows) - 1)
+
+
+def _users_index_reset() -> None:
+    with _users_index_lock:
+        _users_index.update(by_email={}, rows=0, max_id=0, loaded_at=0.0)
+
+
+def _users_index_load(wks) -> None:
+    """Загружает индекс заново, если он пуст или устарел. Вызывать под _users_index_lock."""
+    if _users_index["loaded_at"] and time.monotonic() - _users_index["loaded_at"] < USERS_INDEX_TTL_SEC:
+        return
+    rows = wks.get_all_values()
+    _users_index.update(by_email={}, rows=1, max_id=0)
+    _users_index_add_rows(rows[1:], 2)
+    _users_index["loaded_at"] = time.monotonic()
+    logger.info("Индекс users загружен: %s пользователей", len(_users_index["by_email"]))
+
+
+def _users_index_catch_up(wks) -> None:
+    """Дочитывает строки, появившиеся после последней загрузки. Вызывать под _users_index_lock."""
+    first = _users_index["rows"] + 1
+    if first > wks.row_count:
+        return
+    tail = wks.get_values(f"A{first}:H")
+    if tail:
+        _users_index_add_rows(tail, first)
+
+
+def _users_lookup(wks, email: str) -> Optional[Dict[str, Any]]:
+    """Запись по email из индекса; при промахе дочитывает новые строки листа. Вызывать под lock."""
+    _users_index_load(wks)
+    email_lower = email.strip().lower()
+    rec = _users_index["by_email"].get(email_lower)
+    if rec is None:
+        _users_index_catch_up(wks)
+        rec = _users_index["by_email"].get(email_lower)
+    return rec
+
+
 def _find_user_by_email(email: str) -> Optional[Dict[str, str]]:
     """Ищет пользователя по email. Возвращает dict или None."""
+    if _use_db():
+        return _db_find_user_by_email(email)
     try:
         wks, err = _get_users_wks()
         if wks is None:
             return None
-        rows = wks.get_all_values()
-        email_lower = email.strip().lower()
-        for i, row in enumerate(rows):
-            if i == 0:
-                continue
-            if len(row) > 1 and row[1].strip().lower() == email_lower:
-                return {
-                    "row_index": i + 1,
-                    "id": row[0] if len(row) > 0 else "",
-                    "email": row[1] if len(row) > 1 else "",
-                    "password": row[2] if len(row) > 2 else "",
-                    "password_hash": row[3] if len(row) > 3 else "",
-                    "telegram_id": row[4] if len(row) > 4 else "",
-                    "telegram_username": row[5] if len(row) > 5 else "",
-                    "confirmed": row[6] if len(row) > 6 else "",
-                    "created_at": row[7] if len(row) > 7 else "",
-                }
-        return None
+        with _users_index_lock:
+            rec = _users_lookup(wks, email)
+            return dict(rec) if rec else None
     except Exception as e:
         _users_cache["wks"] = None
+        _users_index_reset()
         logger.exception("find_user_by_email error: %s", e)
         return None
 
 
-def _next_user_id(wks) -> int:
-    """Вычисляет следующий ID пользователя (max существующих + 1)."""
-    try:
-        rows = wks.get_all_values()
-        max_id = 0
-        for i, row in enumerate(rows):
-            if i == 0 or not row:
-                continue
-            try:
-                max_id = max(max_id, int(row[0]))
-            except (ValueError, IndexError):
-                pass
-        return max_id + 1
-    except Exception:
-        return 1
-
-
 def _create_user(email: str, password: str, tg_id: int, tg_username: str) -> Optional[str]:
     """Создаёт пользователя (confirmed=no). Возвращает None при успехе, иначе текст ошибки."""
+    if _use_db():
+        return _db_create_user(email, password, tg_id, tg_username)
     try:
         wks, err = _get_users_wks()
         if wks is None:
             return err or "Таблица недоступна"
-        existing = _find_user_by_email(email)
-        if existing:
-            return "Пользователь с таким email уже зарегистрирован."
-        new_id = _next_user_id(wks)
-        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
-        row = [str(new_id), email.strip().lower(), password, _hash_password(password), str(tg_id), tg_username, "no", now]
-        wks.append_row(row, value_input_option="RAW")
+        with _users_index_lock:
+            if _users_lookup(wks, email):
+                return "Пользователь с таким email уже зарегистрирован."
+            new_id = _allocate_id("users", lambda: _users_index["max_id"], resync_sec=0)
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+            row = [str(new_id), email.strip().lower(), password, _hash_password(password), str(tg_id), tg_username, "no", now]
+            resp = wks.append_row(row, value_input_option="RAW")
+            _users_index_add_rows([row], _appended_row(resp) or _users_index["rows"] + 1)
         return None
     except Exception as e:
         _users_cache["wks"] = None
+        _users_index_reset()
         logger.exception("create_user error: %s", e)
         return str(e)[:200]
 
 
 def _confirm_user(email: str) -> bool:
     """Ставит confirmed=yes. Возвращает True при успехе."""
+    if _use_db():
+        return _db_update_user(email, confirmed="yes")
     try:
         wks, err = _get_users_wks()
         if wks is None:
             return False
-        rows = wks.get_all_values()
-        email_lower = email.strip().lower()
-        for i, row in enumerate(rows):
-            if i == 0:
-                continue
-            if len(row) > 1 and row[1].strip().lower() == email_lower:
-                wks.update_cell(i + 1, 7, "yes")
-                return True
-        return False
+        with _users_index_lock:
+            rec = _users_lookup(wks, email)
+            if rec is None:
+                return False
+            wks.update_cell(rec["row_index"], 7, "yes")
+            rec["confirmed"] = "yes"
+            return True
     except Exception as e:
         _users_cache["wks"] = None
+        _users_index_reset()
         logger.exception("confirm_user error: %s", e)
         return False
 
@@ -493,47 +783,581 @@ def _check_password(email: str, password: str) -> Optional[Dict[str, str]]:
 
 def _update_user_tg(email: str, tg_id: int, tg_username: str) -> None:
     """Обновляет telegram_id и username при авторизации."""
+    if _use_db():
+        _db_update_user(email, telegram_id=str(tg_id), telegram_username=tg_username)
+        return
     try:
         wks, err = _get_users_wks()
         if wks is None:
             return
-        rows = wks.get_all_values()
-        email_lower = email.strip().lower()
-        for i, row in enumerate(rows):
-            if i == 0:
-                continue
-            if len(row) > 1 and row[1].strip().lower() == email_lower:
-                wks.update_cell(i + 1, 5, str(tg_id))
-                wks.update_cell(i + 1, 6, tg_username)
+        with _users_index_lock:
+            rec = _users_lookup(wks, email)
+            if rec is None:
+                return
+            if rec.get("telegram_id") == str(tg_id) and rec.get("telegram_username") == tg_username:
                 return
+            r = rec["row_index"]
+            wks.update(f"E{r}:F{r}", [[str(tg_id), tg_username]], value_input_option="RAW")
+            rec["telegram_id"] = str(tg_id)
+            rec["telegram_username"] = tg_username
     except Exception as e:
         _users_cache["wks"] = None
+        _users_index_reset()
         logger.exception("update_user_tg error: %s", e)
 
 
 def _reset_user_password(email: str) -> Optional[str]:
     """Сбрасывает пароль: генерирует новый, записывает хеш в таблицу. Возвращает новый пароль или None."""
+    if _use_db():
+        new_password = str(random.randint(100000, 999999))
+        ok = _db_update_user(email, password=new_password, password_hash=_hash_password(new_password))
+        return new_password if ok else None
     try:
         wks, err = _get_users_wks()
         if wks is None:
             return None
-        rows = wks.get_all_values()
-        email_lower = email.strip().lower()
-        for i, row in enumerate(rows):
-            if i == 0:
-                continue
-            if len(row) > 1 and row[1].strip().lower() == email_lower:
-                new_password = str(random.randint(100000, 999999))
-                wks.update_cell(i + 1, 3, new_password)
-                wks.update_cell(i + 1, 4, _hash_password(new_password))
-                return new_password
-        return None
+        with _users_index_lock:
+            rec = _users_lookup(wks, email)
+            if rec is None:
+                return None
+            new_password = str(random.randint(100000, 999999))
+            r = rec["row_index"]
+            wks.update(f"C{r}:D{r}", [[new_password, _hash_password(new_password)]], value_input_option="RAW")
+            rec["password"] = new_password
+            rec["password_hash"] = _hash_password(new_password)
+            return new_password
     except Exception as e:
         _users_cache["wks"] = None
+        _users_index_reset()
         logger.exception("reset_password error: %s", e)
         return None
 
 
+# --------------- Хранилище: SQLite + зеркало в Google Таблицу ---------------
+# STORAGE_BACKEND=sqlite (по умолчанию): пользователи и анкеты живут в локальной SQLite (WAL), чтение и запись
+# на горячем пути — локальный диск. Изменённые строки помечаются версией, фоновая задача раз в SHEET_FLUSH_SEC
+# зеркалит их в листы с прежней разметкой (SHEET_HEADER, users / USERS_SHEET_HEADER), которые читают сотрудники.
+# STORAGE_BACKEND=sheets — прежний режим: таблица и есть база. Строки обоих листов импортируются в SQLite
+# (каждый лист один раз, отметка в таблице meta); пока импорт не прошёл для обоих листов, бот работает
+# в режиме sheets и повторяет импорт в фоновой задаче
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+STORAGE_DB_PATH = os.getenv(
+    "STORAGE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.db")
+)
+STORAGE_REPLICATE_BATCH = 200
+_USERS_FIELDS = USERS_SHEET_HEADER[1:]  # без id
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL DEFAULT '',
+    password_hash TEXT NOT NULL DEFAULT '',
+    telegram_id TEXT NOT NULL DEFAULT '',
+    telegram_username TEXT NOT NULL DEFAULT '',
+    confirmed TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 1,
+    synced_version INTEGER NOT NULL DEFAULT 0,
+    sheet_row INTEGER
+);
+CREATE INDEX IF NOT EXISTS users_telegram_id ON users (telegram_id);
+CREATE INDEX IF NOT EXISTS users_telegram_username ON users (lower(telegram_username));
+CREATE INDEX IF NOT EXISTS users_unsynced ON users (id) WHERE version > synced_version;
+CREATE TABLE IF NOT EXISTS surveys (
+    id INTEGER PRIMARY KEY,
+    created_at TEXT NOT NULL DEFAULT '',
+    telegram TEXT NOT NULL DEFAULT '',
+    phone TEXT NOT NULL DEFAULT '',
+    answers TEXT NOT NULL DEFAULT '{}',
+    version INTEGER NOT NULL DEFAULT 1,
+    synced_version INTEGER NOT NULL DEFAULT 0,
+    sheet_row INTEGER
+);
+CREATE INDEX IF NOT EXISTS surveys_telegram ON surveys (lower(telegram), id);
+CREATE INDEX IF NOT EXISTS surveys_unsynced ON surveys (id) WHERE version > synced_version;
+CREATE INDEX IF NOT EXISTS surveys_sheet_row ON surveys (sheet_row);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+_db_state: Dict[str, Any] = {"conn": None, "ready": False, "replicated": 0, "failures": 0}
+_db_lock = threading.RLock()
+
+
+def _use_db() -> bool:
+    """SQLite обслуживает запросы: выбран этот режим и данные из таблицы уже импортированы."""
+    return STORAGE_BACKEND == "sqlite" and _db_state["ready"]
+
+
+def _db() -> sqlite3.Connection:
+    """Соединение с базой (одно на процесс, доступ под _db_lock — функции зовутся из asyncio.to_thread)."""
+    conn = _db_state["conn"]
+    if conn is None:
+        conn = sqlite3.connect(STORAGE_DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_DB_SCHEMA)
+        _db_state["conn"] = conn
+    return conn
+
+
+def _db_user_dict(row: sqlite3.Row) -> Dict[str, str]:
+    rec = {name: row[name] for name in _USERS_FIELDS}
+    rec["id"] = str(row["id"])
+    return rec
+
+
+def _db_find_user_by_email(email: str) -> Optional[Dict[str, str]]:
+    with _db_lock:
+        row = _db().execute("SELECT * FROM users WHERE email = ?", (email.strip().lower(),)).fetchone()
+    return _db_user_dict(row) if row else None
+
+
+def _db_insert(table: str, columns: List[str], values: List[Any]) -> int:
+    """Вставляет строку с id из счётчика counters[table] (общего с режимом sheets) в одной транзакции."""
+    with _db_lock:
+        conn = _db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _db_bump_counter(conn, table, conn.execute(f"SELECT coalesce(max(id), 0) FROM {table}").fetchone()[0])
+            conn.execute("UPDATE counters SET value = value + 1 WHERE name = ?", (table,))
+            new_id = conn.execute("SELECT value FROM counters WHERE name = ?", (table,)).fetchone()[0]
+            conn.execute(
+                f"INSERT INTO {table} (id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})", (new_id, *values)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return new_id
+
+
+def _db_create_user(email: str, password: str, tg_id: int, tg_username: str) -> Optional[str]:
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+    try:
+        _db_insert(
+            "users",
+            ["email", "password", "password_hash", "telegram_id", "telegram_username", "confirmed", "created_at"],
+            [email.strip().lower(), password, _hash_password(password), str(tg_id), tg_username, "no", now],
+        )
+        return None
+    except sqlite3.IntegrityError:
+        return "Пользователь с таким email уже зарегистрирован."
+
+
+def _db_update_user(email: str, **fields: str) -> bool:
+    sets = ", ".join(f"{name} = ?" for name in fields)
+    with _db_lock:
+        cur = _db().execute(
+            f"UPDATE users SET {sets}, version = version + 1 WHERE email = ?",
+            (*fields.values(), email.strip().lower()),
+        )
+    return cur.rowcount > 0
+
+
+def _db_start_survey(tg_username: str, tg_phone: str) -> int:
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+    return _db_insert("surveys", ["created_at", "telegram", "phone"], [now, tg_username or "", tg_phone or ""])
+
+
+def _db_update_survey(row_key: int, step: Optional[int] = None, value: str = "", phone: Optional[str] = None) -> None:
+    """row_key < 0 — -id анкеты; > 0 — номер строки в листе (анкета начата до перехода на базу)."""
+    with _db_lock:
+        if row_key < 0:
+            survey_id = -row_key
+        else:
+            row = _db().execute("SELECT id FROM surveys WHERE sheet_row = ?", (row_key,)).fetchone()
+            if row is None:
+                return
+            survey_id = row["id"]
+        if phone is not None:
+            _db().execute("UPDATE surveys SET phone = ?, version = version + 1 WHERE id = ?", (phone, survey_id))
+        if step is not None:
+            _db().execute(
+                "UPDATE surveys SET answers = json_set(answers, ?, ?), version = version + 1 WHERE id = ?",
+                (f"$.q{step}", value, survey_id),
+            )
+
+
+def _db_load_survey_by_tg(tg_username: str) -> Optional[Dict[str, str]]:
+    with _db_lock:
+        row = _db().execute(
+            "SELECT answers FROM surveys WHERE lower(telegram) = lower(?) ORDER BY id DESC LIMIT 1",
+            (tg_username.strip(),),
+        ).fetchone()
+    if not row:
+        return None
+    answers = {k: v for k, v in _json.loads(row["answers"]).items() if str(v).strip()}
+    return answers or None
+
+
+def _db_survey_sheet_row(row: sqlite3.Row) -> List[str]:
+    answers = _json.loads(row["answers"])
+    return [str(row["id"]), row["created_at"], row["telegram"], row["phone"]] + [
+        answers.get(f"q{i + 1}", "") for i in range(len(MEDICAL_QUESTIONS))
+    ]
+
+
+def _db_user_sheet_row(row: sqlite3.Row) -> List[str]:
+    return [str(row["id"])] + [row[name] for name in _USERS_FIELDS]
+
+
+def _db_import_table(table: str, rows: List[List[str]]) -> int:
+    """Переносит строки листа в таблицу базы (помечены как уже выгруженные). Вызывать в транзакции."""
+    conn, n = _db(), 0
+    for i, row in enumerate(rows[1:], start=2):
+        if table == "users":
+            rec = _user_record(row, i)
+            if not rec["email"].strip() or not rec["id"].strip().isdigit():
+                continue
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO users (id, email, password, password_hash, telegram_id,"
+                " telegram_username, confirmed, created_at, synced_version, sheet_row)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?)",
+                (int(rec["id"]), *(rec[name] for name in _USERS_FIELDS), i),
+            )
+        else:
+            if not row or not row[0].strip().isdigit():
+                continue
+            cells = row + [""] * (4 - len(row))
+            answers = {f"q{k + 1}": v for k, v in enumerate(row[4:4 + len(MEDICAL_QUESTIONS)]) if v}
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO surveys (id, created_at, telegram, phone, answers, synced_version, sheet_row)"
+                " VALUES (?, ?, ?, ?, ?, 1, ?)",
+                (int(row[0]), cells[1], cells[2], cells[3], _json.dumps(answers, ensure_ascii=False), i),
+            )
+        n += cur.rowcount
+    return n
+
+
+def _db_import_sheets() -> bool:
+    """
+    Переносит в базу листы users и опроса (отметка imported:<таблица> в meta). Оба листа читаются заранее
+    и импортируются одной транзакцией: пока хоть один недоступен, не импортируется ничего — иначе записи,
+    сделанные в режиме sheets до повторной попытки, не попали бы в уже импортированную таблицу.
+    True — оба листа импортированы (или таблица не настроена) и базой можно пользоваться.
+    """
+    fetched: List[Tuple[str, List[List[str]]]] = []
+    for table, get_wks in (("users", _get_users_wks), ("surveys", _get_sheet_wks)):
+        with _db_lock:
+            if _db().execute("SELECT 1 FROM meta WHERE key = ?", (f"imported:{table}",)).fetchone():
+                continue
+        wks, err = get_wks()
+        if wks is None and err:
+            logger.warning("Импорт листа %s в базу отложен: %s", table, err)
+            return False
+        fetched.append((table, wks.get_all_values() if wks is not None else []))
+    if not fetched:
+        return True
+    now = datetime.now(timezone.utc).isoformat()
+    with _db_lock:
+        conn = _db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            counts = {table: _db_import_table(table, rows) for table, rows in fetched}
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [(f"imported:{t}", now) for t in counts]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    logger.info("Импорт из таблицы в базу: %s", ", ".join(f"{t} {n}" for t, n in counts.items()))
+    return True
+
+
+def _storage_open() -> None:
+    """Открывает базу при старте и импортирует листы; при неудаче импорт повторит _job_sheet_flush."""
+    if STORAGE_BACKEND != "sqlite":
+        return
+    try:
+        _db_state["ready"] = _db_import_sheets()
+    except Exception as e:
+        logger.warning("Импорт из таблицы в базу не выполнен: %s", e)
+    if not _db_state["ready"]:
+        logger.warning("База не готова: до завершения импорта работаем напрямую с таблицей")
+
+
+def _storage_close() -> None:
+    with _db_lock:
+        conn = _db_state["conn"]
+        _db_state["conn"] = None
+    if conn is not None:
+        conn.close()
+
+
+_SHEET_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+
+def _appended_row(resp: Any) -> Optional[int]:
+    """Номер первой строки, записанной append_row/append_rows (из updatedRange ответа API)."""
+    m = _SHEET_ROW_RE.search(((resp or {}).get("updates") or {}).get("updatedRange", ""))
+    return int(m.group(1)) if m else None
+
+
+# Выдача id для режима STORAGE_BACKEND=sheets: счётчик в таблице counters локальной базы, инкремент в
+# BEGIN IMMEDIATE — без чтения листа и без гонок между одновременными запросами. Счётчик сверяется с
+# максимальным id в листе (seed) при первой выдаче в процессе и затем раз в resync_sec: id, добавленные в лист
+# вручную или другим процессом, не повторяются. Строки, созданные в режиме sqlite, двигают счётчик сами
+ID_RESYNC_SEC = 600
+_id_synced: Dict[str, float] = {}
+
+
+def _db_bump_counter(conn: sqlite3.Connection, name: str, value: int) -> None:
+    """Поднимает счётчик до value (не уменьшает). Вызывать под _db_lock."""
+    conn.execute(
+        "INSERT INTO counters (name, value) VALUES (?, ?)"
+        " ON CONFLICT(name) DO UPDATE SET value = max(value, excluded.value)",
+        (name, value),
+    )
+
+
+def _allocate_id(name: str, seed: Callable[[], int], resync_sec: float = ID_RESYNC_SEC) -> int:
+    now = time.monotonic()
+    last = _id_synced.get(name)
+    floor = seed() if last is None or now - last >= resync_sec else 0
+    with _db_lock:
+        conn = _db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _db_bump_counter(conn, name, floor)
+            conn.execute("UPDATE counters SET value = value + 1 WHERE name = ?", (name,))
+            value = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if last is None or now - last >= resync_sec:
+        _id_synced[name] = now
+    return value
+
+
+def _sheet_max_id(wks) -> int:
+    """Максимальный числовой id в столбце A листа (читается только этот столбец)."""
+    max_id = 0
+    for value in wks.col_values(1)[1:]:
+        try:
+            max_id = max(max_id, int(value))
+        except (ValueError, TypeError):
+            pass
+    return max_id
+
+
+def _db_replicate_table(table: str, wks, to_values: Callable[[sqlite3.Row], List[str]], value_input_option: str) -> int:
+    """Выгружает в лист строки таблицы, изменённые после прошлой выгрузки. Возвращает число строк."""
+    with _db_lock:
+        rows = _db().execute(
+            f"SELECT * FROM {table} WHERE version > synced_version ORDER BY id LIMIT ?", (STORAGE_REPLICATE_BATCH,)
+        ).fetchall()
+    if not rows:
+        return 0
+    from gspread.utils import rowcol_to_a1
+
+    synced: List[Tuple[int, int, int]] = []  # (id, version, sheet_row)
+    existing = [r for r in rows if r["sheet_row"]]
+    if existing:
+        wks.batch_update(
+            [
+                {
+                    "range": f"A{r['sheet_row']}:{rowcol_to_a1(r['sheet_row'], len(values))}",
+                    "values": [values],
+                }
+                for r in existing
+                for values in [to_values(r)]
+            ],
+            value_input_option=value_input_option,
+        )
+        synced += [(r["id"], r["version"], r["sheet_row"]) for r in existing]
+    fresh = [r for r in rows if not r["sheet_row"]]
+    if fresh:
+        resp = wks.append_rows([to_values(r) for r in fresh], value_input_option=value_input_option)
+        first = _appended_row(resp)
+        synced += [(r["id"], r["version"], first + k if first else None) for k, r in enumerate(fresh)]
+    with _db_lock:
+        _db().executemany(
+            f"UPDATE {table} SET synced_version = max(synced_version, ?), sheet_row = coalesce(?, sheet_row) WHERE id = ?",
+            [(version, sheet_row, row_id) for row_id, version, sheet_row in synced],
+        )
+    return len(rows)
+
+
+def _db_replicate() -> bool:
+    """Один проход зеркалирования базы в таблицу. True — всё выгружено (или таблица не настроена)."""
+    done = True
+    try:
+        users_wks, _ = _get_users_wks()
+        if users_wks is not None:
+            n = _db_replicate_table("users", users_wks, _db_user_sheet_row, "RAW")
+            _db_state["replicated"] += n
+            done = n < STORAGE_REPLICATE_BATCH
+    except Exception as e:
+        _users_cache["wks"] = None
+        _db_state["failures"] += 1
+        logger.warning("Зеркалирование users в таблицу отложено: %s", e)
+        done = False
+    try:
+        survey_wks, _ = _get_sheet_wks()
+        if survey_wks is not None:
+            if not _sheet_cache.get("header_ok"):
+                if survey_wks.row_values(1)[:len(SHEET_HEADER)] != SHEET_HEADER:
+                    from gspread.utils import rowcol_to_a1
+
+                    survey_wks.update(f"A1:{rowcol_to_a1(1, len(SHEET_HEADER))}", [SHEET_HEADER], value_input_option="RAW")
+                _sheet_cache["header_ok"] = True
+            n = _db_replicate_table("surveys", survey_wks, _db_survey_sheet_row, "USER_ENTERED")
+            _db_state["replicated"] += n
+            done = done and n < STORAGE_REPLICATE_BATCH
+    except Exception as e:
+        _sheet_cache["wks"] = None
+        _db_state["failures"] += 1
+        logger.warning("Зеркалирование опроса в таблицу отложено: %s", e)
+        done = False
+    return done
+
+
+def _db_backlog() -> int:
+    with _db_lock:
+        return _db().execute(
+            "SELECT (SELECT count(*) FROM users WHERE version > synced_version)"
+            " + (SELECT count(*) FROM surveys WHERE version > synced_version)"
+        ).fetchone()[0]
+
+
+# Шаблоны с данными пациента делятся на неизменный префикс (инструкции, одинаковые байт в байт для всех
+# пациентов) и суффикс с данными. Префикс идёт первым системным сообщением — так его подхватывает
+# автоматическое кеширование промптов у провайдера. Блоки шаблона (через пустую строку), где есть
+# {поле}, уходят в суффикс в исходном порядке, остальные — в префикс
+_PROMPT_FIELD_RE = re.compile(r"(?<!\{)\{[a-z_]+\}(?!\})")
+
+
+class _SplitPrompt(str):
+    """Заполненный шаблон: как строка — полный текст; prefix/suffix — неизменная и переменная части."""
+
+    def __new__(cls, prefix: str, suffix: str):
+        obj = super().__new__(cls, f"{prefix}\n\n{suffix}")
+        obj.prefix = prefix
+        obj.suffix = suffix
+        return obj
+
+
+# Бюджет входных токенов: данные пациента в шаблонах укладываются в лимит самой «тесной» из настроенных
+# моделей. Разделы заполняются по приоритету (PROMPT_FIELD_PRIORITY); не поместившийся раздел сокращается
+# (у истории обращений остаются последние), а если места почти нет — опускается. Токены оцениваются по длине
+# текста (~3 символа на токен для русского текста — с запасом для токенизаторов Llama и GPT)
+PROMPT_TOKEN_BUDGET = {"groq": 8000, "openai": 24000}
+PROMPT_RESERVE_TOKENS = 300  # сообщение пользователя и служебные токены
+PROMPT_MIN_SECTION_TOKENS = 60
+PROMPT_CHARS_PER_TOKEN = 3
+PROMPT_FIELD_PRIORITY = (
+    "survey_data",
+    "patient_request",
+    "followup_question",
+    "documents_section",
+    "followup_qa",
+    "qa_so_far",
+    "qa_block",
+    "patient_history",
+    "previous_analysis",
+    "full_analysis",
+    "analysis_summary",
+)
+_PROMPT_DROPPED = "[раздел опущен: не помещается в лимит запроса]"
+_PROMPT_TRIMMED = "\n…[сокращено]"
+_PROMPT_HISTORY_TRIMMED = "[более ранние обращения опущены]\n\n"
+
+
+def _count_tokens(text: str) -> int:
+    """Оценка числа токенов по длине текста."""
+    return (len(text) + PROMPT_CHARS_PER_TOKEN - 1) // PROMPT_CHARS_PER_TOKEN
+
+
+def _prompt_token_budget() -> int:
+    """Лимит входных токенов: минимум по настроенным провайдерам (запрос может уйти к любому из них)."""
+    _init_ai_clients()
+    budgets = [PROMPT_TOKEN_BUDGET[p] for p in _ai_clients if p in PROMPT_TOKEN_BUDGET]
+    return min(budgets) if budgets else max(PROMPT_TOKEN_BUDGET.values())
+
+
+def _shrink_section(name: str, text: str, tokens: int) -> str:
+    """Сокращает раздел до tokens токенов: история — с начала (остаются последние обращения), прочее — с конца."""
+    if tokens < PROMPT_MIN_SECTION_TOKENS:
+        return _PROMPT_DROPPED
+    if name == "patient_history":
+        limit = (tokens - _count_tokens(_PROMPT_HISTORY_TRIMMED)) * PROMPT_CHARS_PER_TOKEN
+        entries = text.split("\n\n--- ")
+        kept: List[str] = []
+        size = 0
+        for entry in reversed(entries):
+            size += len(entry) + 6
+            if size > limit:
+                break
+            kept.append(entry)
+        if not kept:
+            return _PROMPT_DROPPED
+        kept.reverse()
+        body = "\n\n--- ".join(kept)
+        return _PROMPT_HISTORY_TRIMMED + (body if body.startswith("---") else "--- " + body)
+    limit = (tokens - _count_tokens(_PROMPT_TRIMMED)) * PROMPT_CHARS_PER_TOKEN
+    cut = text[:limit]
+    newline = cut.rfind("\n")
+    if newline > limit // 2:
+        cut = cut[:newline]
+    return cut.rstrip() + _PROMPT_TRIMMED
+
+
+class _PromptTemplate:
+    """Шаблон промпта с разделением на кешируемый префикс и суффикс с данными пациента.
+    format() укладывает данные в бюджет токенов и пишет в лог разбивку по разделам."""
+
+    def __init__(self, template: str, name: str):
+        blocks = template.split("\n\n")
+        self.name = name
+        self.prefix = "\n\n".join(b for b in blocks if not _PROMPT_FIELD_RE.search(b)).format()
+        self.suffix = "\n\n".join(b for b in blocks if _PROMPT_FIELD_RE.search(b))
+
+    def format(self, **fields: Any) -> _SplitPrompt:
+        budget = _prompt_token_budget()
+        fields = {key: str(value) for key, value in fields.items()}
+        # Бюджет — только полям, которые есть в шаблоне: лишний аргумент не должен вытеснять нужные разделы
+        ranked = [key for key in PROMPT_FIELD_PRIORITY if key in fields and f"{{{key}}}" in self.suffix]
+        skeleton = self.suffix.format(**{key: ("" if key in ranked else value) for key, value in fields.items()})
+        fixed = _count_tokens(self.prefix) + _count_tokens(skeleton) + PROMPT_RESERVE_TOKENS
+        remaining = budget - fixed
+        breakdown = [f"инструкции {fixed - PROMPT_RESERVE_TOKENS}"]
+        for key in ranked:
+            tokens = _count_tokens(fields[key])
+            if tokens > remaining:
+                fields[key] = _shrink_section(key, fields[key], max(remaining, 0))
+                tokens = _count_tokens(fields[key])
+                breakdown.append(f"{key} {tokens} (сокращено)")
+            else:
+                breakdown.append(f"{key} {tokens}")
+            remaining -= tokens
+        logger.info(
+            "Промпт %s: %s; итого ~%d из %d токенов",
+            self.name, ", ".join(breakdown), budget - remaining - PROMPT_RESERVE_TOKENS, budget,
+        )
+        return _SplitPrompt(self.prefix, self.suffix.format(**fields))
+
+
+def _prompt_messages(system_prompt: str, user_text: str) -> List[Dict[str, str]]:
+    """Сообщения для chat.completions: у _SplitPrompt префикс и данные — отдельными системными сообщениями."""
+    if isinstance(system_prompt, _SplitPrompt):
+        system = [
+            {"role": "system", "content": system_prompt.prefix},
+            {"role": "system", "content": system_prompt.suffix},
+        ]
+    else:
+        system = [{"role": "system", "content": system_prompt}]
+    return system + [{"role": "user", "content": user_text}]
+
+
 # Промпт для одного документа
 MEDICAL_PROMPT = """Ты помогаешь пожилым людям понять медицинские документы: анализы, заключения врачей, выписки из больницы.
 
@@ -546,26 +1370,19 @@ MEDICAL_PROMPT = """Ты помогаешь пожилым людям понят
 
 Пиши по-русски, короткими предложениями, доброжелательно. Не пугай, но и не скрывай важное."""
 
-# Промпт для нескольких документов: один общий разбор, хронология, выводы, рекомендации
-MULTI_DOC_PROMPT = """Ты помогаешь пожилым людям разобраться в нескольких медицинских документах сразу: анализы, заключения, выписки.
+# Извлечение данных из одного документа (результат кешируется и затем идёт в FULL_ANALYSIS_PROMPT)
+DOC_EXTRACT_PROMPT = """Ты извлекаешь данные из изображения медицинского документа (анализ, заключение, выписка, назначение).
 
-По всем изображениям вместе сделай ОДНО короткое заключение. Уложи в ДВА структурированных абзаца (нумеруй пункты 1-2-3). Пиши максимально просто и чётко.
+Перепиши всё существенное структурированным текстом, без интерпретации и советов:
+- Тип документа, дата, учреждение, врач (если видны).
+- Каждый показатель с новой строки: название — значение — единицы — референсный интервал (как в документе).
+- Заключения, диагнозы, назначения и рекомендации — дословно или близко к тексту.
 
-АБЗАЦ 1 — ЧТО ПРОИЗОШЛО И ЧТО ЭТО ЗНАЧИТ:
-1) Кратко: что произошло со здоровьем (хронология, связки между документами).
-2) Какие цифры и результаты анализов/исследований это подтверждают (ключевые показатели).
-3) Что предполагают врачи, что уже сделали и что планируют сделать.
-
-АБЗАЦ 2 — ЧТО ДЕЛАТЬ И К ЧЕМУ БЫТЬ ГОТОВЫМ:
-1) Чего врачи не сделали или не учли — что важно спросить на приёме.
-2) Как себя вести и к чему быть готовым (реалистично, без паники).
-3) Что точно делать и чего точно не делать (конкретные рекомендации).
-
-Пиши по-русски, простыми словами. Не пугай, но не скрывай важное. Без лишних деталей — только суть и выводы."""
+Числа пиши цифрами, как в документе. Не используй LaTeX. Если часть текста не читается — так и укажи. Если на изображении нет медицинского документа — напиши «Медицинских данных нет»."""
 
 TEXT_PROMPT = """Ты помогаешь пожилым людям разобраться в вопросах здоровья и медицинских терминах. Отвечай простым русским языком, коротко и по делу. Если спрашивают про анализы или диагнозы — объясни без страшных слов и подскажи, что делать дальше."""
 
-FOLLOWUP_PROMPT = """Ты — врач-консультант высшей категории. Пациент обращается повторно с новой информацией или новой ситуацией.
+FOLLOWUP_PROMPT = _PromptTemplate("""Ты — врач-консультант высшей категории. Пациент обращается повторно с новой информацией или новой ситуацией.
 
 ДАННЫЕ ПАЦИЕНТА (из опроса):
 {survey_data}
@@ -595,9 +1412,9 @@ FOLLOWUP_PROMPT = """Ты — врач-консультант высшей ка
 - Затем блок «Для более точного анализа было бы полезно загрузить:» (если применимо)
 
 НИКОГДА не используй LaTeX, $, \\text{{}}. Числа пиши обычным текстом (126 г/л, 10⁹/л).
-Пиши по-русски, простыми словами, обращаясь на «вы»."""
+Пиши по-русски, простыми словами, обращаясь на «вы».""", "followup")
 
-REQUEST_ANALYSIS_PROMPT = """Ты — опытный врач-диагност высшей категории с 30-летним стажем. Тебе поступил запрос от пациента.
+REQUEST_ANALYSIS_PROMPT = _PromptTemplate("""Ты — опытный врач-диагност высшей категории с 30-летним стажем. Тебе поступил запрос от пациента.
 
 ДАННЫЕ ПАЦИЕНТА (из опроса):
 {survey_data}
@@ -641,11 +1458,11 @@ REQUEST_ANALYSIS_PROMPT = """Ты — опытный врач-диагност 
 - Протокол СМП (скорой помощи)
 - История болезни / амбулаторная карта
 
-Пиши по-русски, простыми словами, обращаясь на «вы». Не ставь диагноз. Не пугай. Будь конкретен."""
+Пиши по-русски, простыми словами, обращаясь на «вы». Не ставь диагноз. Не пугай. Будь конкретен.""", "request_analysis")
 
 MAX_ADAPTIVE_QUESTIONS = 10
 
-ADAPTIVE_QUESTION_PROMPT = """Ты — опытный и внимательный врач-диагност. Ты ведёшь живой диалог с пациентом, как настоящий доктор на приёме.
+ADAPTIVE_QUESTION_PROMPT = _PromptTemplate("""Ты — опытный и внимательный врач-диагност. Ты ведёшь живой диалог с пациентом, как настоящий доктор на приёме.
 
 ДАННЫЕ ПАЦИЕНТА (из анкеты):
 {survey_data}
@@ -670,7 +1487,7 @@ ADAPTIVE_QUESTION_PROMPT = """Ты — опытный и внимательны
 - Если пациент описал новую ситуацию, а у него уже были предыдущие обращения — сначала уточни, связана ли новая жалоба с предыдущими (если это не очевидно).
 - НЕ задавай вопросы, ответы на которые уже есть в анкете, истории или предыдущих ответах.
 - Если ты уже понимаешь картину достаточно хорошо для безопасных рекомендаций — ЗАКАНЧИВАЙ. Не затягивай опрос ради опроса.
-- Минимум вопросов — 1, максимум — {max_questions}. Спрашивай столько, сколько РЕАЛЬНО нужно.
+- Минимум вопросов — 1, максимум указан рядом с номером текущего вопроса. Спрашивай столько, сколько РЕАЛЬНО нужно.
 
 ФОРМАТ ОТВЕТА — строго JSON, без обёрток, без markdown:
 
@@ -686,10 +1503,68 @@ ADAPTIVE_QUESTION_PROMPT = """Ты — опытный и внимательны
 - Альтернативные вопросы (с «или»): укажи варианты выбора в options (НЕ "Да"/"Нет").
 - Выбор из вариантов (сроки, место, интенсивность): 2–4 варианта в options.
 - Открытый вопрос (нужен развёрнутый ответ): options пустой [], но ОБЯЗАТЕЛЬНО добавь подсказку в скобках (примеры ответов), чтобы пациент понимал, что писать.
-- Будь ЧЕЛОВЕЧНЫМ: не допрашивай, а беседуй. Формулируй мягко, понятно для пожилого человека."""
+- Будь ЧЕЛОВЕЧНЫМ: не допрашивай, а беседуй. Формулируй мягко, понятно для пожилого человека.""", "adaptive_question")
+
+# План уточняющих вопросов одним запросом: дерево вопросов с переходами по вариантам ответа.
+# Бот проходит его сам и перепланирует, только если свободный ответ не совпал ни с одним вариантом
+CLARIFY_PLAN_ENABLED = os.getenv("AI_QUESTION_PLAN", "1").strip().lower() not in ("0", "false", "no")
+CLARIFY_MAX_REPLANS = 1
+
+# Спекулятивные запросы в пошаговом режиме: пока пациент читает вопрос с кнопками, следующий вопрос
+# заранее генерируется для каждого варианта (не больше CLARIFY_SPECULATE_OPTIONS вариантов
+# и CLARIFY_SPECULATE_BUDGET лишних запросов за консультацию)
+CLARIFY_SPECULATE_ENABLED = os.getenv("AI_SPECULATE", "1").strip().lower() not in ("0", "false", "no")
+CLARIFY_SPECULATE_OPTIONS = 4
+CLARIFY_SPECULATE_BUDGET = 12
+
+QUESTION_PLAN_PROMPT = _PromptTemplate("""Ты — опытный и внимательный врач-диагност. Ты ведёшь живой диалог с пациентом, как настоящий доктор на приёме.
+
+ДАННЫЕ ПАЦИЕНТА (из анкеты):
+{survey_data}
+
+ИСТОРИЯ ПРЕДЫДУЩИХ ОБРАЩЕНИЙ (хронология):
+{patient_history}
+
+ТЕКУЩЕЕ ОБРАЩЕНИЕ ПАЦИЕНТА:
+{patient_request}
+
+УЖЕ ЗАДАННЫЕ ВОПРОСЫ И ОТВЕТЫ (в этом диалоге):
+{qa_so_far}
+
+Лимит вопросов по любой ветке: {max_questions}
+
+ТВОЯ ЗАДАЧА:
+Составь СРАЗУ ВЕСЬ план уточняющих вопросов в виде дерева: какой вопрос задать первым и какой задавать дальше в зависимости от ответа пациента.
+По любой ветке пациент должен пройти не больше вопросов, чем указано в лимите.
+
+ПРИНЦИП (как настоящий врач):
+- Задавай вопросы только если тебе реально не хватает информации для точного заключения.
+- Следующий вопрос в ветке выбирай ИСХОДЯ ИЗ ответа на предыдущий — адаптируйся к новому контексту.
+- Если пациент описал новую ситуацию, а у него уже были предыдущие обращения — сначала уточни, связана ли новая жалоба с предыдущими (если это не очевидно).
+- НЕ задавай вопросы, ответы на которые уже есть в анкете, истории или предыдущих ответах.
+- Когда по ветке картина уже понятна — заканчивай её ("done"). Не затягивай опрос ради опроса.
+
+ФОРМАТ ОТВЕТА — строго JSON, без обёрток, без markdown:
+{{"start": "q1", "questions": [
+  {{"id": "q1", "q": "Текст вопроса", "options": ["вариант1", "вариант2"], "next": ["q2", "q3"], "then": "done"}},
+  {{"id": "q2", "q": "Текст вопроса (подсказка с примерами ответа)", "options": [], "next": [], "then": "q3"}}
+]}}
+- "next" — id следующего вопроса для каждого варианта из options (по порядку) или "done".
+- "then" — id следующего вопроса (или "done") для ответа своими словами и для открытых вопросов.
+
+Если информации уже достаточно и вопросы не нужны:
+{{"done": true}}
+
+ПРАВИЛА ДЛЯ ВОПРОСОВ:
+- СТРОГО по-русски, на «вы». Никаких иероглифов или нелатинских символов кроме кириллицы.
+- Вопросы Да/Нет (содержат «ли вы», «были ли», «есть ли» и т.п.): options обязательно ["Да", "Нет"] (или + "Не помню").
+- Альтернативные вопросы (с «или»): укажи варианты выбора в options (НЕ "Да"/"Нет").
+- Выбор из вариантов (сроки, место, интенсивность): 2–4 варианта в options.
+- Открытый вопрос (нужен развёрнутый ответ): options пустой [], но ОБЯЗАТЕЛЬНО добавь подсказку в скобках (примеры ответов), чтобы пациент понимал, что писать.
+- Будь ЧЕЛОВЕЧНЫМ: не допрашивай, а беседуй. Формулируй мягко, понятно для пожилого человека.""", "question_plan")
 
 # Уточняющие вопросы после анализа документов (1–5 вопросов для уточнения заключения)
-POST_DOC_QUESTIONS_PROMPT = """Ты — врач-диагност. По документам пациента уже проведён первичный анализ. Чтобы уточнить заключение и рекомендации, нужно задать пациенту от 1 до 5 коротких уточняющих вопросов.
+POST_DOC_QUESTIONS_PROMPT = _PromptTemplate("""Ты — врач-диагност. По документам пациента уже проведён первичный анализ. Чтобы уточнить заключение и рекомендации, нужно задать пациенту от 1 до 5 коротких уточняющих вопросов.
 
 ЗАПРОС ПАЦИЕНТА:
 {patient_request}
@@ -701,10 +1576,10 @@ POST_DOC_QUESTIONS_PROMPT = """Ты — врач-диагност. По доку
 
 ВАЖНО: для открытых вопросов ОБЯЗАТЕЛЬНО добавляй подсказку в скобках с примерами возможных ответов. Пациенты часто не знают, что и как описать. Примеры: «Опишите характер боли (давящая, колющая, жгучая, тупая, ноющая)», «Какие лекарства принимаете? (название, дозировка, частота приёма)».
 
-Формат ответа: строго по одному вопросу на строку, без нумерации. Не пиши вводных фраз — только вопросы, каждый с новой строки. По-русски, на «вы»."""
+Формат ответа: строго по одному вопросу на строку, без нумерации. Не пиши вводных фраз — только вопросы, каждый с новой строки. По-русски, на «вы».""", "post_doc_questions")
 
 # Уточнение заключения с учётом ответов пациента на уточняющие вопросы
-REFINED_ANALYSIS_PROMPT = """Ты — врач-диагност. У тебя есть первичный анализ по документам пациента и ответы пациента на уточняющие вопросы. Дай итоговое заключение и рекомендации с учётом этой дополнительной информации.
+REFINED_ANALYSIS_PROMPT = _PromptTemplate("""Ты — врач-диагност. У тебя есть первичный анализ по документам пациента и ответы пациента на уточняющие вопросы. Дай итоговое заключение и рекомендации с учётом этой дополнительной информации.
 
 ПЕРВИЧНЫЙ АНАЛИЗ:
 {full_analysis}
@@ -714,7 +1589,7 @@ REFINED_ANALYSIS_PROMPT = """Ты — врач-диагност. У тебя е
 
 ЗАДАЧА: сохрани структуру первичного анализа, но дополни и скорректируй разделы с учётом ответов пациента. Если ответы меняют выводы или рекомендации — укажи это явно.
 
-ОФОРМЛЕНИЕ: все числа — только цифрами (возраст 39, рост 186 см, вес 110 кг, показатели анализов). Возраст — цифрой, рассчитай от текущего года по году рождения. Каждый пункт с новой строки. Пиши по-русски. Не используй LaTeX. Будь конкретен."""
+ОФОРМЛЕНИЕ: все числа — только цифрами (возраст 39, рост 186 см, вес 110 кг, показатели анализов). Возраст — цифрой, рассчитай от текущего года по году рождения. Каждый пункт с новой строки. Пиши по-русски. Не используй LaTeX. Будь конкретен.""", "refined_analysis")
 
 INTENT_CLASSIFY_PROMPT = """Пользователь общается с медицинским ботом. Бот попросил загрузить медицинские документы (анализы, заключения, выписки).
 Пользователь написал: "{user_text}"
@@ -726,11 +1601,9 @@ INTENT_CLASSIFY_PROMPT = """Пользователь общается с мед
 
 Ответ (одно слово):"""
 
-FULL_ANALYSIS_PROMPT = """Ты — врач-диагност высшей категории и профильный специалист. Твоя задача: собрать ВСЮ имеющуюся информацию о пациенте и выдать итоговое заключение («итог») по строго заданному плану.
-
-ИСХОДНЫЕ ДАННЫЕ:
+FULL_ANALYSIS_PROMPT = _PromptTemplate("""Ты — врач-диагност высшей категории и профильный специалист. Твоя задача: собрать ВСЮ имеющуюся информацию о пациенте и выдать итоговое заключение («итог») по строго заданному плану.
 
-Данные из опроса (анкета):
+ИСХОДНЫЕ ДАННЫЕ — данные из опроса (анкета):
 {survey_data}
 
 Описание ситуации / запрос пациента:
@@ -741,8 +1614,6 @@ FULL_ANALYSIS_PROMPT = """Ты — врач-диагност высшей кат
 
 {documents_section}
 
----
-
 ФОРМАТИРОВАНИЕ (ОБЯЗАТЕЛЬНО):
 - Все числа — только цифрами: возраст (39), рост (186 см), вес (110 кг), показатели анализов, даты, дозировки. Никогда не пиши числа словами («тридцать девять», «сто десять» и т.п.).
 - Возраст: рассчитай от текущего года (2026) по году рождения из опроса. Пиши только цифрой: «39 лет», не «тридцать девять лет».
@@ -781,7 +1652,7 @@ FULL_ANALYSIS_PROMPT = """Ты — врач-диагност высшей кат
 **8. РЕКОМЕНДАЦИИ: ЛЕКАРСТВА И ПРОЦЕДУРЫ**
 Конкретные препараты (название, форма, доза, длительность — по возможности), процедуры, манипуляции. Противопоказания и чего избегать, с учётом данных опроса (аллергии, сопутствующие болезни).
 
-Пиши по-русски. Не используй LaTeX, формулы, $ или \\text{{}}. Все числа — только цифрами (126 г/л, 7,76×10⁹/л, 15 мм/час); для степеней — ⁰¹²³⁴⁵⁶⁷⁸⁹. Никогда не заменяй цифры словами. Будь конкретен. Не пугай, но не скрывай важное."""
+Пиши по-русски. Не используй LaTeX, формулы, $ или \\text{{}}. Все числа — только цифрами (126 г/л, 7,76×10⁹/л, 15 мм/час); для степеней — ⁰¹²³⁴⁵⁶⁷⁸⁹. Никогда не заменяй цифры словами. Будь конкретен. Не пугай, но не скрывай важное.""", "full_analysis")
 
 # Ключи в user_data для буфера фото
 PENDING_IMAGES_KEY = "pending_images"
@@ -793,22 +1664,801 @@ GROQ_VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
 GROQ_TEXT_MODEL = "llama-3.3-70b-versatile"
 
 
-def _use_groq() -> bool:
-    return bool(os.getenv("GROQ_API_KEY"))
-
-
-def get_groq_client() -> Optional[OpenAI]:
-    api_key = os.getenv("GROQ_API_KEY")
+OPENAI_VISION_MODEL = "gpt-4o"
+OPENAI_TEXT_MODEL = "gpt-4o-mini"
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+
+# Пул HTTP-соединений на провайдера: соединения живут между запросами (keep-alive)
+AI_MAX_CONNECTIONS = 20
+AI_KEEPALIVE_CONNECTIONS = 10
+AI_KEEPALIVE_EXPIRY_SEC = 120
+
+# Провайдеры в порядке предпочтения
+AI_PROVIDERS = ("groq", "openai")
+# Таймаут прогрева соединений при старте (сек)
+AI_WARMUP_TIMEOUT_SEC = 10
+# Таймауты одного запроса (сек) — вместо многоминутного таймаута SDK по умолчанию
+AI_TEXT_TIMEOUT_SEC = 60
+AI_VISION_TIMEOUT_SEC = 120
+# Модели провайдеров по типу запроса
+AI_MODELS = {
+    "groq": {"text": GROQ_TEXT_MODEL, "vision": GROQ_VISION_MODEL},
+    "openai": {"text": OPENAI_TEXT_MODEL, "vision": OPENAI_VISION_MODEL},
+}
+WHISPER_MODELS = {"groq": "whisper-large-v3", "openai": "whisper-1"}
+# Лимиты vision-запроса у провайдеров: размер изображения в base64 (байт)
+AI_VISION_MAX_IMAGE_B64 = {"groq": 4 * 1024 * 1024, "openai": 20 * 1024 * 1024}
+# Сколько документов батча распознаётся одновременно
+VISION_EXTRACT_CONCURRENCY = 4
+# Маршрутизатор: окно статистики, порог и пауза автомата (circuit breaker)
+AI_HEALTH_WINDOW = 50
+AI_BREAKER_FAILURES = 3
+AI_BREAKER_COOLDOWN_SEC = 30
+# Хеджирование интерактивных шагов (включается AI_HEDGE=1): если основной провайдер не ответил
+# за AI_HEDGE_PERCENTILE-й перцентиль своей задержки, тот же запрос уходит второму
+AI_HEDGE_ENABLED = os.getenv("AI_HEDGE", "").strip().lower() in ("1", "true", "yes")
+AI_HEDGE_PERCENTILE = float(os.getenv("AI_HEDGE_PERCENTILE", "90"))
+AI_HEDGE_MIN_SAMPLES = 5
+AI_HEDGE_DEFAULT_DELAY_SEC = 4.0
+# Период записи метрик в лог (сек)
+AI_METRICS_LOG_SEC = 600
+
+# Реестр провайдеров: клиенты создаются один раз при старте процесса, доступность — из кеша
+_ai_clients: Dict[str, AsyncOpenAI] = {}  # provider -> AsyncOpenAI
+_ai_registry: Dict[str, Any] = {"initialized": False, "warmup_task": None}
+# Здоровье провайдеров: provider -> {"latencies", "errors", "failures", "state", "opened_at", "probe_at"}
+_ai_health: Dict[str, Dict[str, Any]] = {}
+# Задержка интерактивных шагов: step -> {"latencies", "calls", "hedged", "hedge_wins"}
+_step_stats: Dict[str, Dict[str, Any]] = {}
+_token_stats: Dict[str, Dict[str, int]] = {}  # provider -> {"calls", "prompt", "cached", "completion"}
+_clarify_speculation: Dict[int, Dict[str, Any]] = {}  # chat_id -> {"step": int, "tasks": {вариант: Task}}
+_speculation_stats: Dict[str, int] = {"launched": 0, "hits": 0, "misses": 0}
+
+
+def _make_ai_client(provider: str) -> Optional[AsyncOpenAI]:
+    """Создаёт AsyncOpenAI с собственным пулом соединений для провайдера ("groq" | "openai")."""
+    if provider == "groq":
+        api_key, base_url = os.getenv("GROQ_API_KEY"), GROQ_BASE_URL
+    elif provider == "openai":
+        api_key, base_url = os.getenv("OPENAI_API_KEY"), None
+    else:
+        return None
     if not api_key:
         return None
-    return OpenAI(base_url="https://api.groq.com/openai/v1", api_key=api_key)
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=AI_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=AI_KEEPALIVE_EXPIRY_SEC,
+        ),
+    )
+    # Повторы делает маршрутизатор (на другом провайдере), а не SDK на том же
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
 
 
-def get_openai_client() -> Optional[OpenAI]:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+def _init_ai_clients() -> None:
+    """Создаёт клиентов всех настроенных провайдеров (один раз на процесс)."""
+    if _ai_registry["initialized"]:
+        return
+    for provider in AI_PROVIDERS:
+        client = _make_ai_client(provider)
+        if client is not None:
+            _ai_clients[provider] = client
+    _ai_registry["initialized"] = True
+    logger.info("AI-провайдеры: %s", ", ".join(_ai_clients) or "нет")
+
+
+def _provider_available(provider: str) -> bool:
+    """Настроен ли провайдер — ответ из реестра, без создания клиента."""
+    _init_ai_clients()
+    return provider in _ai_clients
+
+
+def _any_provider_available() -> bool:
+    _init_ai_clients()
+    return bool(_ai_clients)
+
+
+def _get_ai_client(provider: str) -> Optional[AsyncOpenAI]:
+    """Возвращает общий клиент провайдера из реестра."""
+    _init_ai_clients()
+    return _ai_clients.get(provider)
+
+
+async def _warmup_ai_client(provider: str, client: AsyncOpenAI) -> None:
+    """Открывает TLS-соединение к провайдеру лёгким запросом models.list."""
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(client.models.list(), AI_WARMUP_TIMEOUT_SEC)
+        logger.info("Прогрев %s: %.0f мс", provider, (time.monotonic() - started) * 1000)
+    except Exception as e:
+        logger.warning("Прогрев %s не удался: %s", provider, e)
+
+
+async def _warmup_ai_clients() -> None:
+    """Прогревает соединения всех провайдеров параллельно."""
+    await asyncio.gather(*(_warmup_ai_client(p, c) for p, c in list(_ai_clients.items())))
+
+
+def _start_ai_warmup() -> None:
+    """Создаёт клиентов и запускает прогрев в фоне (до первого апдейта)."""
+    _init_ai_clients()
+    task = _ai_registry.get("warmup_task")
+    if task is None or task.done():
+        _ai_registry["warmup_task"] = asyncio.create_task(_warmup_ai_clients())
+
+
+async def _close_ai_clients() -> None:
+    """Закрывает пулы соединений всех провайдеров (при остановке бота)."""
+    task = _ai_registry.get("warmup_task")
+    if task is not None and not task.done():
+        task.cancel()
+    _ai_registry["warmup_task"] = None
+    for provider, client in list(_ai_clients.items()):
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning("Закрытие клиента %s: %s", provider, e)
+    _ai_clients.clear()
+    _ai_registry["initialized"] = False
+
+
+def _provider_health(provider: str) -> Dict[str, Any]:
+    health = _ai_health.get(provider)
+    if health is None:
+        health = {
+            "latencies": deque(maxlen=AI_HEALTH_WINDOW),
+            "errors": deque(maxlen=AI_HEALTH_WINDOW),
+            "failures": 0,
+            "state": "closed",
+            "opened_at": 0.0,
+            "probe_at": 0.0,
+        }
+        _ai_health[provider] = health
+    return health
+
+
+def _is_breaker_error(e: Exception) -> bool:
+    """429, 5xx, таймаут и обрыв соединения — признак деградации провайдера."""
+    if isinstance(e, APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, (APIConnectionError, asyncio.TimeoutError, httpx.TransportError))
+
+
+def _record_ai_result(provider: str, latency: float, error: Optional[Exception] = None) -> None:
+    """Обновляет скользящую статистику провайдера и состояние автомата."""
+    health = _provider_health(provider)
+    health["probe_at"] = 0.0
+    failed = error is not None and _is_breaker_error(error)
+    health["errors"].append(1 if failed else 0)
+    if not failed:
+        if error is None:
+            health["latencies"].append(latency)
+        if health["state"] != "closed":
+            logger.info("Провайдер %s снова доступен", provider)
+        health["failures"] = 0
+        health["state"] = "closed"
+        return
+    health["failures"] += 1
+    if health["state"] == "half_open" or health["failures"] >= AI_BREAKER_FAILURES:
+        if health["state"] != "open":
+            logger.warning("Провайдер %s отключён на %d с: %s", provider, AI_BREAKER_COOLDOWN_SEC, error)
+        health["state"] = "open"
+        health["opened_at"] = time.monotonic()
+
+
+def _provider_allowed(provider: str) -> bool:
+    """Можно ли включить провайдера в маршрут. После паузы пропускает его для пробного запроса,
+    если пробный запрос ещё не идёт; сам пробный запрос занимает _claim_probe."""
+    health = _provider_health(provider)
+    if health["state"] == "closed":
+        return True
+    now = time.monotonic()
+    if health["state"] == "open":
+        if now - health["opened_at"] < AI_BREAKER_COOLDOWN_SEC:
+            return False
+        health["state"] = "half_open"
+    return now - health["probe_at"] >= AI_BREAKER_COOLDOWN_SEC
+
+
+def _claim_probe(provider: str) -> bool:
+    """Вызывается прямо перед запросом к провайдеру. Для полуоткрытого занимает единственный пробный
+    запрос (False — его уже отправил другой запрос); закрытый и отключённый (маршрут без здоровых) не ограничивает."""
+    health = _provider_health(provider)
+    if health["state"] != "half_open":
+        return True
+    now = time.monotonic()
+    if now - health["probe_at"] < AI_BREAKER_COOLDOWN_SEC:
+        return False
+    health["probe_at"] = now
+    return True
+
+
+def _provider_score(provider: str) -> Tuple[float, float]:
+    """Ключ сортировки: доля ошибок, затем медианная задержка."""
+    health = _provider_health(provider)
+    errors = health["errors"]
+    error_rate = sum(errors) / len(errors) if errors else 0.0
+    latencies = sorted(health["latencies"])
+    median = latencies[len(latencies) // 2] if latencies else 0.0
+    return round(error_rate, 1), median
+
+
+def _route_providers(preferred: Optional[str] = None, payload_bytes: int = 0) -> List[str]:
+    """Порядок провайдеров для запроса: сначала здоровые (по ошибкам и задержке), preferred — первым.
+    payload_bytes — размер изображения: провайдеры с меньшим лимитом пропускаются.
+    Если все отключены — возвращает всех настроенных, чтобы не отказывать пользователю."""
+    available = [p for p in AI_PROVIDERS if _provider_available(p)]
+    if payload_bytes:
+        fitting = [p for p in available if payload_bytes <= AI_VISION_MAX_IMAGE_B64.get(p, 0)]
+        if not fitting:
+            logger.warning("Изображение %d байт больше лимита всех провайдеров", payload_bytes)
+        available = fitting or available
+    ordered = sorted(available, key=lambda p: (p != preferred, _provider_score(p)))
+    healthy = [p for p in ordered if _provider_allowed(p)]
+    # Пробный запрос к полуоткрытому провайдеру идёт первым: при ошибке сразу переключимся на здоровый
+    probes = [p for p in healthy if _provider_health(p)["state"] == "half_open"]
+    healthy = probes + [p for p in healthy if p not in probes]
+    return healthy or ordered
+
+
+# Ограничитель частоты: на каждую пару провайдер/модель — корзина запросов (RPM) и корзина токенов (TPM).
+# Когда лимит исчерпан, запросы ждут в очереди по порядку (asyncio.Lock честный), а не падают с 429.
+# Остаток и лимит токенов уточняются по заголовкам x-ratelimit-* каждого ответа. Если ждать дольше
+# RATE_MAX_WAIT_SEC или в очереди больше RATE_MAX_QUEUE запросов — провайдер пропускается (маршрутизатор
+# отдаст запрос следующему)
+RATE_LIMITS = {
+    "groq": {"rpm": int(os.getenv("GROQ_RPM", "30")), "tpm": int(os.getenv("GROQ_TPM", "6000"))},
+    "openai": {"rpm": int(os.getenv("OPENAI_RPM", "500")), "tpm": int(os.getenv("OPENAI_TPM", "200000"))},
+}
+RATE_MAX_WAIT_SEC = 20.0
+RATE_MAX_QUEUE = 20
+RATE_IMAGE_TOKENS = 1000  # оценка входных токенов на одно изображение
+
+_rate_buckets: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+
+class _RateLimitBusy(Exception):
+    """Провайдер перегружен по лимитам: очередь полна или ждать слишком долго. Не считается сбоем провайдера."""
+
+
+def _rate_bucket(provider: str, model: str) -> Dict[str, Any]:
+    key = (provider, model)
+    bucket = _rate_buckets.get(key)
+    if bucket is None:
+        limits = RATE_LIMITS.get(provider, {"rpm": 60, "tpm": 100000})
+        bucket = _rate_buckets[key] = {
+            "rpm": limits["rpm"], "tpm": limits["tpm"],
+            "requests": float(limits["rpm"]), "tokens": float(limits["tpm"]),
+            "updated": time.monotonic(), "blocked_until": 0.0, "lock": asyncio.Lock(),
+            "waiting": 0, "max_waiting": 0, "waits": 0, "wait_total": 0.0, "wait_max": 0.0, "rejected": 0,
+        }
+    return bucket
+
+
+def _rate_refill(bucket: Dict[str, Any], now: float) -> None:
+    elapsed = now - bucket["updated"]
+    bucket["updated"] = now
+    bucket["requests"] = min(bucket["rpm"], bucket["requests"] + bucket["rpm"] * elapsed / 60)
+    bucket["tokens"] = min(bucket["tpm"], bucket["tokens"] + bucket["tpm"] * elapsed / 60)
+
+
+def _rate_wait_time(bucket: Dict[str, Any], tokens: int, now: float) -> float:
+    """Сколько ждать, пока в корзинах хватит места на запрос."""
+    wait = max(0.0, bucket["blocked_until"] - now)
+    if bucket["requests"] < 1:
+        wait = max(wait, (1 - bucket["requests"]) * 60 / bucket["rpm"])
+    if bucket["tokens"] < tokens:
+        wait = max(wait, (tokens - bucket["tokens"]) * 60 / bucket["tpm"])
+    return wait
+
+
+def _estimate_request_tokens(messages: list, max_tokens: int) -> int:
+    """Оценка токенов запроса для корзины: вход + половина лимита ответа (точный остаток придёт в заголовках)."""
+    prompt = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            prompt += _count_tokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    prompt += _count_tokens(part.get("text", ""))
+                else:
+                    prompt += RATE_IMAGE_TOKENS
+    return prompt + max_tokens // 2
+
+
+async def _rate_acquire(provider: str, model: str, tokens: int) -> None:
+    """Ждёт своей очереди и места в корзинах; _RateLimitBusy — если очередь полна или ждать дольше RATE_MAX_WAIT_SEC."""
+    bucket = _rate_bucket(provider, model)
+    tokens = min(tokens, bucket["tpm"])
+    if bucket["waiting"] >= RATE_MAX_QUEUE:
+        bucket["rejected"] += 1
+        raise _RateLimitBusy(f"{provider}: очередь запросов переполнена")
+    bucket["waiting"] += 1
+    bucket["max_waiting"] = max(bucket["max_waiting"], bucket["waiting"])
+    started = time.monotonic()
+    try:
+        async with bucket["lock"]:
+            while True:
+                now = time.monotonic()
+                _rate_refill(bucket, now)
+                wait = _rate_wait_time(bucket, tokens, now)
+                if wait <= 0:
+                    break
+                if now - started + wait > RATE_MAX_WAIT_SEC:
+                    bucket["rejected"] += 1
+                    raise _RateLimitBusy(f"{provider}: до сброса лимита {wait:.0f} с")
+                await asyncio.sleep(wait)
+            bucket["requests"] -= 1
+            bucket["tokens"] -= tokens
+    finally:
+        bucket["waiting"] -= 1
+    waited = time.monotonic() - started
+    if waited > 0.05:
+        bucket["waits"] += 1
+        bucket["wait_total"] += waited
+        bucket["wait_max"] = max(bucket["wait_max"], waited)
+
+
+def _parse_reset_seconds(value: Optional[str]) -> float:
+    """Время до сброса лимита из заголовка: "6s", "1m30.5s", "120ms" или число секунд."""
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(num) * units[unit] for num, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value))
+
+
+def _rate_learn(provider: str, model: str, headers: Any) -> None:
+    """Уточняет корзины по заголовкам ответа (x-ratelimit-*, retry-after)."""
+    if headers is None:
+        return
+    bucket = _rate_bucket(provider, model)
+    now = time.monotonic()
+    _rate_refill(bucket, now)
+    try:
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_tokens:
+            bucket["tpm"] = int(float(limit_tokens))
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            bucket["tokens"] = min(float(bucket["tpm"]), float(remaining_tokens))
+        # У OpenAI лимит запросов — в минуту; у Groq этот заголовок суточный, поэтому учитываем только исчерпание
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        if limit_requests and provider == "openai":
+            bucket["rpm"] = int(float(limit_requests))
+        if headers.get("x-ratelimit-remaining-requests") == "0":
+            reset = _parse_reset_seconds(headers.get("x-ratelimit-reset-requests"))
+            bucket["blocked_until"] = max(bucket["blocked_until"], now + reset)
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            bucket["blocked_until"] = max(bucket["blocked_until"], now + _parse_reset_seconds(retry_after))
+    except (TypeError, ValueError) as e:
+        logger.debug("Заголовки лимитов %s не разобраны: %s", provider, e)
+
+
+def _rate_report() -> str:
+    """Насыщение лимитов для лога: глубина очереди, ожидание, отказы."""
+    parts = []
+    for (provider, model), bucket in _rate_buckets.items():
+        if not bucket["waits"] and not bucket["rejected"]:
+            continue
+        avg = bucket["wait_total"] / bucket["waits"] if bucket["waits"] else 0.0
+        parts.append(
+            f"{provider}/{model}: сейчас в очереди {bucket['waiting']} (макс. {bucket['max_waiting']}), "
+            f"ждали {bucket['waits']} раз, в среднем {avg:.1f} с, макс. {bucket['wait_max']:.1f} с, отказов {bucket['rejected']}"
+        )
+    return "; ".join(parts)
+
+
+async def _rated_create(provider: str, model: str, messages: list, max_tokens: int, **kwargs: Any) -> Tuple[Any, float]:
+    """chat.completions.create через ограничитель частоты. На 429 лимиты берутся из ответа и запрос
+    один раз повторяется после паузы. Возвращает (ответ или поток, время отправки — без ожидания в очереди)."""
+    client = _get_ai_client(provider)
+    tokens = _estimate_request_tokens(messages, max_tokens)
+    for attempt in range(2):
+        await _rate_acquire(provider, model, tokens)
+        if not attempt and not _claim_probe(provider):
+            raise _RateLimitBusy(f"{provider}: пробный запрос после отключения уже отправлен")
+        started = time.monotonic()
+        try:
+            raw = await client.chat.completions.with_raw_response.create(
+                model=model, messages=messages, max_tokens=max_tokens, **kwargs
+            )
+        except APIStatusError as e:
+            _rate_learn(provider, model, e.response.headers)
+            if e.status_code != 429 or attempt:
+                raise
+            logger.info("%s: лимит запросов (429), жду сброса", provider)
+            continue
+        _rate_learn(provider, model, raw.headers)
+        parsed = raw.parse()
+        if asyncio.iscoroutine(parsed):
+            parsed = await parsed
+        return parsed, started
+    raise RuntimeError("unreachable")
+
+
+# Планировщик запросов к ИИ: не больше AI_MAX_CONCURRENT логических запросов одновременно (хедж и повторы
+# внутри одного запроса не считаются). Свободный слот получает запрос с самым высоким приоритетом
+# (interactive → analysis → background), среди равных — пользователь, у которого сейчас меньше запросов
+# в работе и кто дольше не получал слот, затем по порядку прихода. Пользователь берётся из контекста обработки обновления (_llm_user)
+AI_MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", "8"))
+LLM_PRIORITIES = {"interactive": 0, "analysis": 1, "background": 2}
+
+_llm_user: contextvars.ContextVar[int] = contextvars.ContextVar("llm_user", default=0)
+_llm_sched: Dict[str, Any] = {"running": 0, "waiters": [], "seq": 0, "user_running": {}, "last_grant": {}}
+_llm_sched_stats: Dict[str, Dict[str, float]] = {}
+# Задачи, чей приоритет повышен (_llm_promote): их запросы, ещё не вставшие в очередь, идут с этим приоритетом
+_llm_boost: "weakref.WeakKeyDictionary[asyncio.Task, str]" = weakref.WeakKeyDictionary()
+
+
+def _llm_grant(user: int) -> None:
+    _llm_sched["running"] += 1
+    _llm_sched["user_running"][user] = _llm_sched["user_running"].get(user, 0) + 1
+    if len(_llm_sched["last_grant"]) > 10000:
+        _llm_sched["last_grant"].clear()
+    _llm_sched["last_grant"][user] = time.monotonic()
+
+
+def _llm_release(user: int) -> None:
+    """Освобождает слот и отдаёт его следующему по приоритету и очерёдности."""
+    _llm_sched["running"] -= 1
+    left = _llm_sched["user_running"].get(user, 1) - 1
+    if left:
+        _llm_sched["user_running"][user] = left
+    else:
+        _llm_sched["user_running"].pop(user, None)
+    waiters = _llm_sched["waiters"]
+    while waiters and _llm_sched["running"] < AI_MAX_CONCURRENT:
+        user_running, last_grant = _llm_sched["user_running"], _llm_sched["last_grant"]
+        best = min(
+            waiters,
+            key=lambda w: (w["rank"], user_running.get(w["user"], 0), last_grant.get(w["user"], 0.0), w["seq"]),
+        )
+        waiters.remove(best)
+        if best["future"].done():
+            continue  # ожидание отменено, сам waiter ещё не успел убрать себя из очереди
+        best["future"].set_result(None)
+        _llm_grant(best["user"])
+
+
+@asynccontextmanager
+async def _llm_slot(priority: str = "interactive"):
+    """Слот планировщика на время одного логического запроса к ИИ."""
+    user = _llm_user.get()
+    task = asyncio.current_task()
+    boosted = _llm_boost.get(task) if task is not None else None
+    if boosted is not None and LLM_PRIORITIES[boosted] < LLM_PRIORITIES[priority]:
+        priority = boosted
+    started = time.monotonic()
+    if _llm_sched["running"] < AI_MAX_CONCURRENT and not _llm_sched["waiters"]:
+        _llm_grant(user)
+    else:
+        _llm_sched["seq"] += 1
+        waiter = {
+            "rank": LLM_PRIORITIES[priority], "user": user, "seq": _llm_sched["seq"], "task": task,
+            "future": asyncio.get_running_loop().create_future(),
+        }
+        _llm_sched["waiters"].append(waiter)
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                _llm_release(user)  # слот уже выдан, но запрос отменили
+            elif waiter in _llm_sched["waiters"]:
+                _llm_sched["waiters"].remove(waiter)
+            raise
+    waited = time.monotonic() - started
+    stats = _llm_sched_stats.setdefault(priority, {"count": 0, "queued": 0, "wait_total": 0.0, "wait_max": 0.0})
+    stats["count"] += 1
+    if waited > 0.01:
+        stats["queued"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+    try:
+        yield
+    finally:
+        _llm_release(user)
+
+
+def _llm_promote(task: asyncio.Task, priority: str) -> None:
+    """Повышает приоритет запросов задачи: стоящий в очереди — сразу, будущие — при входе в _llm_slot.
+    Так результат фоновой задачи, которого теперь ждёт пользователь, не стоит за фоновой работой."""
+    _llm_boost[task] = priority
+    for waiter in _llm_sched["waiters"]:
+        if waiter["task"] is task:
+            waiter["rank"] = min(waiter["rank"], LLM_PRIORITIES[priority])
+
+
+def _llm_sched_report() -> str:
+    """Ожидание в очереди планировщика по классам приоритета."""
+    parts = []
+    for priority, stats in _llm_sched_stats.items():
+        avg = stats["wait_total"] / stats["queued"] if stats["queued"] else 0.0
+        parts.append(
+            f"{priority}: {int(stats['count'])} запросов, ждали {int(stats['queued'])}, "
+            f"в среднем {avg:.1f} с, макс. {stats['wait_max']:.1f} с"
+        )
+    if _llm_sched["waiters"]:
+        parts.append(f"сейчас в очереди {len(_llm_sched['waiters'])}")
+    return "; ".join(parts)
+
+
+async def _chat_completion(
+    provider: str, model: str, messages: list, max_tokens: int, timeout: float = AI_TEXT_TIMEOUT_SEC,
+    json_schema: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Один асинхронный запрос chat.completions к провайдеру. Пустая строка — провайдер не настроен.
+    json_schema — структурированный ответ: у OpenAI строгая схема, у Groq — JSON-режим (схема описана в промпте)."""
+    client = _get_ai_client(provider)
+    if not client:
+        return ""
+    extra: Dict[str, Any] = {}
+    if json_schema is not None:
+        if provider == "openai":
+            extra["response_format"] = {"type": "json_schema", "json_schema": json_schema}
+        else:
+            extra["response_format"] = {"type": "json_object"}
+    started = time.monotonic()
+    try:
+        response, started = await _rated_create(provider, model, messages, max_tokens, timeout=timeout, **extra)
+    except _RateLimitBusy:
+        raise
+    except Exception as e:
+        _record_ai_result(provider, time.monotonic() - started, e)
+        raise
+    _record_ai_result(provider, time.monotonic() - started)
+    _record_usage(provider, getattr(response, "usage", None))
+    _record_finish(response.choices[0].finish_reason)
+    return (response.choices[0].message.content or "").strip()
+
+
+async def _routed_completion(
+    kind: str, messages: list, max_tokens: int, preferred: Optional[str] = None, payload_bytes: int = 0,
+    json_schema: Optional[Dict[str, Any]] = None, route: Optional[List[str]] = None,
+) -> Tuple[str, Optional[Exception]]:
+    """Запрос через маршрутизатор: kind = "text" | "vision". Возвращает (текст, последняя ошибка).
+    route — уже вычисленный маршрут (чтобы не считать его заново)."""
+    timeout = AI_VISION_TIMEOUT_SEC if kind == "vision" else AI_TEXT_TIMEOUT_SEC
+    last_err: Optional[Exception] = None
+    if route is None:
+        route = _route_providers(preferred, payload_bytes)
+    for provider in route:
+        try:
+            text = await _chat_completion(
+                provider, AI_MODELS[provider][kind], messages, max_tokens, timeout, json_schema=json_schema
+            )
+        except Exception as e:
+            last_err = e
+            logger.warning("%s %s: %s", provider, kind, e)
+            continue
+        if text:
+            return text, None
+    return "", last_err
+
+
+def _percentile(values, pct: float) -> float:
+    """Перцентиль pct (0–100) по списку значений; 0 для пустого списка."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def _hedge_delay(provider: str) -> float:
+    """Через сколько секунд дублировать запрос второму провайдеру."""
+    latencies = _provider_health(provider)["latencies"]
+    if len(latencies) < AI_HEDGE_MIN_SAMPLES:
+        return AI_HEDGE_DEFAULT_DELAY_SEC
+    return _percentile(latencies, AI_HEDGE_PERCENTILE)
+
+
+def _usage_field(obj: Any, name: str) -> Any:
+    """Поле usage: объект SDK или словарь (нестандартные поля провайдера приходят словарями)."""
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def _record_usage(provider: str, usage: Any) -> None:
+    """Учитывает токены ответа провайдера, в том числе входные токены, взятые из кеша промптов."""
+    if usage is None:
+        return
+    details = _usage_field(usage, "prompt_tokens_details")
+    stats = _token_stats.setdefault(provider, {"calls": 0, "prompt": 0, "cached": 0, "completion": 0})
+    stats["calls"] += 1
+    stats["prompt"] += _usage_field(usage, "prompt_tokens") or 0
+    stats["cached"] += (_usage_field(details, "cached_tokens") or 0) if details is not None else 0
+    stats["completion"] += _usage_field(usage, "completion_tokens") or 0
+
+
+def _token_report() -> str:
+    """Сводка по токенам для лога: вход (доля из кеша) и выход по провайдерам."""
+    parts = []
+    for provider, stats in _token_stats.items():
+        cached_pct = 100 * stats["cached"] / stats["prompt"] if stats["prompt"] else 0.0
+        parts.append(
+            f"{provider}: {stats['calls']} запросов, вход {stats['prompt']} (из кеша {stats['cached']}, "
+            f"{cached_pct:.0f}%), выход {stats['completion']}"
+        )
+    return "; ".join(parts)
+
+
+def _record_step(step: str, latency: float, hedged: bool, hedge_won: bool) -> None:
+    stats = _step_stats.get(step)
+    if stats is None:
+        stats = {"latencies": deque(maxlen=AI_HEALTH_WINDOW * 4), "calls": 0, "hedged": 0, "hedge_wins": 0}
+        _step_stats[step] = stats
+    stats["latencies"].append(latency)
+    stats["calls"] += 1
+    stats["hedged"] += int(hedged)
+    stats["hedge_wins"] += int(hedge_won)
+
+
+def _step_report() -> str:
+    """Сводка по интерактивным шагам: p50/p99 задержки, число хеджей и побед второго провайдера."""
+    lines = []
+    for step, stats in sorted(_step_stats.items()):
+        lines.append(
+            f"{step}: p50={_percentile(stats['latencies'], 50):.1f}s p99={_percentile(stats['latencies'], 99):.1f}s "
+            f"calls={stats['calls']} hedged={stats['hedged']} hedge_wins={stats['hedge_wins']}"
+        )
+    return "; ".join(lines)
+
+
+async def _hedge_race(
+    primary: str, secondary: str, call: Callable[[str], Awaitable[Any]], discard: Optional[Callable] = None
+) -> Tuple[Any, Optional[str], bool, Optional[Exception]]:
+    """Запускает call(primary); если он не ответил за перцентиль своей задержки (или упал) — call(secondary).
+    Побеждает первый непустой результат, проигравший отменяется (discard — закрыть лишний результат).
+    Возвращает (результат, победитель, был ли хедж, последняя ошибка)."""
+    pending: Dict[asyncio.Task, str] = {asyncio.create_task(call(primary)): primary}
+    hedge_at = time.monotonic() + _hedge_delay(primary)
+    hedged = False
+    result, winner, last_err = None, None, None
+    try:
+        while pending and not result:
+            wait_for = None if hedged else max(0.0, hedge_at - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    value = task.result()
+                except Exception as e:
+                    last_err = e
+                    logger.warning("%s (хедж): %s", provider, e)
+                    continue
+                if value and not result:
+                    result, winner = value, provider
+                elif value and discard is not None:
+                    await discard(value)
+            # Основной не успел или уже упал — отправляем тот же запрос второму
+            if not result and not hedged:
+                hedged = True
+                pending[asyncio.create_task(call(secondary))] = secondary
+    finally:
+        for task in pending:
+            task.cancel()
+    return result, winner, hedged, (None if result else last_err)
+
+
+async def _hedged_completion(
+    step: str, kind: str, messages: list, max_tokens: int
+) -> Tuple[str, Optional[Exception]]:
+    """Интерактивный запрос: при AI_HEDGE=1 и медленном основном провайдере дублирует запрос второму."""
+    started = time.monotonic()
+    route = _route_providers()
+    if not AI_HEDGE_ENABLED or len(route) < 2:
+        text, last_err = await _routed_completion(kind, messages, max_tokens, route=route)
+        _record_step(step, time.monotonic() - started, hedged=False, hedge_won=False)
+        return text, last_err
+
+    timeout = AI_VISION_TIMEOUT_SEC if kind == "vision" else AI_TEXT_TIMEOUT_SEC
+
+    async def _call(provider: str) -> str:
+        return await _chat_completion(provider, AI_MODELS[provider][kind], messages, max_tokens, timeout)
+
+    text, winner, hedged, last_err = await _hedge_race(route[0], route[1], _call)
+    _record_step(step, time.monotonic() - started, hedged=hedged, hedge_won=hedged and winner == route[1])
+    return text or "", last_err
+
+
+async def _open_stream(provider: str, kind: str, messages: list, max_tokens: int) -> Optional[Tuple[Any, Any, str, float]]:
+    """Открывает потоковый ответ и ждёт первый непустой фрагмент.
+    Возвращает (поток, итератор оставшихся чанков, первый фрагмент, время старта) или None, если ответ пуст."""
+    client = _get_ai_client(provider)
+    if not client:
         return None
-    return OpenAI(api_key=api_key)
+    timeout = AI_VISION_TIMEOUT_SEC if kind == "vision" else AI_TEXT_TIMEOUT_SEC
+    # Usage в потоке: OpenAI присылает его последним чанком по stream_options, Groq — в x_groq
+    extra = {"stream_options": {"include_usage": True}} if provider == "openai" else {}
+    started = time.monotonic()
+    try:
+        stream, started = await _rated_create(
+            provider, AI_MODELS[provider][kind], messages, max_tokens, timeout=timeout, stream=True, **extra
+        )
+        chunks = stream.__aiter__()
+        async for chunk in chunks:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                return stream, chunks, delta, started
+    except _RateLimitBusy:
+        raise
+    except Exception as e:
+        _record_ai_result(provider, time.monotonic() - started, e)
+        raise
+    _record_ai_result(provider, time.monotonic() - started)
+    return None
+
+
+async def _close_stream(opened: Tuple[Any, Any, str, float]) -> None:
+    """Закрывает лишний поток (проигравший в хедже)."""
+    try:
+        await opened[0].close()
+    except Exception:
+        pass
+
+
+async def _stream_completion(
+    kind: str,
+    messages: list,
+    max_tokens: int,
+    on_delta: Callable[[str], Awaitable[None]],
+    step: Optional[str] = None,
+) -> Tuple[str, Optional[Exception]]:
+    """Потоковый запрос через маршрутизатор: каждый фрагмент текста передаётся в on_delta.
+    До первого фрагмента можно переключиться на другого провайдера (или хеджировать, если задан step);
+    после — ответ дочитывается у выбранного. Для step в метрики пишется время до первого текста."""
+    started = time.monotonic()
+    route = _route_providers()
+    opened, provider, hedged, last_err = None, None, False, None
+    if step and AI_HEDGE_ENABLED and len(route) >= 2:
+        opened, provider, hedged, last_err = await _hedge_race(
+            route[0], route[1], lambda p: _open_stream(p, kind, messages, max_tokens), discard=_close_stream
+        )
+    else:
+        for candidate in route:
+            try:
+                opened = await _open_stream(candidate, kind, messages, max_tokens)
+            except Exception as e:
+                last_err = e
+                logger.warning("%s %s (поток): %s", candidate, kind, e)
+                continue
+            if opened:
+                provider = candidate
+                break
+    if step:
+        _record_step(step, time.monotonic() - started, hedged=hedged, hedge_won=hedged and provider == route[1])
+    if not opened:
+        return "", last_err
+
+    _, chunks, first, provider_started = opened
+    parts = [first]
+    await on_delta(first)
+    try:
+        async for chunk in chunks:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                await on_delta(delta)
+            if chunk.choices:
+                _record_finish(chunk.choices[0].finish_reason)
+            x_groq = getattr(chunk, "x_groq", None)
+            usage = getattr(chunk, "usage", None) or (_usage_field(x_groq, "usage") if x_groq else None)
+            if usage is not None:
+                _record_usage(provider, usage)
+    except Exception as e:
+        # Часть ответа уже показана — не начинаем заново у другого провайдера, отдаём что есть
+        _record_ai_result(provider, time.monotonic() - provider_started, e)
+        logger.warning("%s %s (поток оборван): %s", provider, kind, e)
+        return "".join(parts).strip(), e
+    _record_ai_result(provider, time.monotonic() - provider_started)
+    return "".join(parts).strip(), None
 
 
 def _no_ai_message() -> str:
@@ -816,6 +2466,8 @@ def _no_ai_message() -> str:
 
 
 def _short_error(e: Exception) -> str:
+    if isinstance(e, _RateLimitBusy):
+        return "Сервис сейчас перегружен запросами. Попробуйте через минуту."
     msg = str(e).strip()
     if "429" in msg or "quota" in msg.lower() or "insufficient_quota" in msg:
         return "Закончился лимит по ключу. Groq: console.groq.com; OpenAI: platform.openai.com."
@@ -854,9 +2506,7 @@ def _strip_latex(text: str) -> str:
 
 def _format_conclusion_for_elderly(raw: str) -> str:
     """Форматирует заключение для удобного чтения: заголовки, эмодзи, жирный текст, разбивка."""
-    if not raw or len(raw) > 4000:
-        raw = (raw or "")[:4000]
-    raw = _strip_latex(raw)
+    raw = _strip_latex(raw or "")
     raw = _escape_html(raw)
     raw = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", raw)
 
@@ -896,17 +2546,247 @@ def _format_conclusion_for_elderly(raw: str) -> str:
     raw = re.sub(r"\n{3,}", "\n\n", raw)
     raw = raw.strip()
     if len(raw) > 4080:
+        # Страховка от лимита Telegram: сюда должны приходить страницы _split_pages, а не весь текст
+        _record_wasted_output(raw[4077:])
         raw = raw[:4077] + "..."
     return raw
 
 
-async def _send_long_html(bot, chat_id: int, text: str, reply_markup=None) -> None:
-    """Отправляет длинный HTML-текст частями (лимит Telegram 4096)."""
-    chunk_size = 4000
-    for i in range(0, len(text), chunk_size):
-        chunk = text[i : i + chunk_size]
-        markdown = reply_markup if (i + chunk_size >= len(text)) else None
-        await bot.send_message(chat_id, chunk, parse_mode="HTML", reply_markup=markdown)
+# Потоковый вывод: не чаще одного редактирования в STREAM_EDIT_INTERVAL_SEC на чат (лимиты Telegram),
+# страница — не больше STREAM_PAGE_CHARS исходного текста (запас до 4096 на HTML-разметку)
+STREAM_EDIT_INTERVAL_SEC = 1.5
+STREAM_PAGE_CHARS = 3500
+
+# Лимит генерации считается от того, сколько текста реально покажем: страниц по STREAM_PAGE_CHARS
+# (длинный ответ выводится несколькими сообщениями, ничего не обрезается)
+OUTPUT_TOKENS_PER_PAGE = STREAM_PAGE_CHARS // PROMPT_CHARS_PER_TOKEN
+ANSWER_MAX_PAGES = 2
+ANALYSIS_MAX_PAGES = 3
+
+_output_stats: Dict[str, int] = {"wasted_tokens": 0, "length_stops": 0}
+
+
+def _output_tokens(pages: int) -> int:
+    """max_tokens для ответа, который поместится в pages сообщений."""
+    return pages * OUTPUT_TOKENS_PER_PAGE
+
+
+def _record_wasted_output(text: str) -> None:
+    """Учитывает сгенерированный, но не показанный пациенту текст."""
+    _output_stats["wasted_tokens"] += _count_tokens(text)
+
+
+def _record_finish(finish_reason: Optional[str]) -> None:
+    """Ответ упёрся в max_tokens — лимит стоит поднять или сократить запрос на длину."""
+    if finish_reason == "length":
+        _output_stats["length_stops"] += 1
+
+
+_HTML_ESCAPE_EXTRA = {"&": 4, "<": 3, ">": 3}
+
+
+def _escaped_prefix(text: str, limit: int) -> int:
+    """Сколько символов исходного текста помещается в limit после _escape_html (&amp; и т.п. длиннее)."""
+    size = 0
+    for i, ch in enumerate(text):
+        size += 1 + _HTML_ESCAPE_EXTRA.get(ch, 0)
+        if size > limit:
+            return i
+    return len(text)
+
+
+def _split_pages(text: str, limit: int = STREAM_PAGE_CHARS) -> List[str]:
+    """Делит исходный текст на страницы по абзацам/строкам; limit считается по длине после экранирования HTML,
+    поэтому страница не вырастает за лимит при оформлении. Уже заполненные страницы не меняются при дописывании."""
+    pages = []
+    end = _escaped_prefix(text, limit)
+    while end < len(text):
+        cut = text.rfind("\n\n", 0, end)
+        if cut < end // 2:
+            cut = text.rfind("\n", 0, end)
+        if cut < end // 2:
+            cut = end
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+        end = _escaped_prefix(text, limit)
+    pages.append(text)
+    return pages
+
+
+def _clean_answer(text: str) -> str:
+    return _strip_foreign_chars(_strip_latex(text))
+
+
+def _format_analysis_page(text: str) -> str:
+    return _format_conclusion_for_elderly(_strip_foreign_chars(text))
+
+
+async def _send_pages(bot, chat_id: int, text: str, *, html: bool = False, reply_markup=None) -> None:
+    """Отправляет длинный текст несколькими сообщениями по страницам _split_pages (без обрезки).
+    html=True — оформление заключения; reply_markup — у последнего сообщения."""
+    pages = _split_pages(text)
+    for i, page in enumerate(pages):
+        markup = reply_markup if i == len(pages) - 1 else None
+        if html:
+            try:
+                await bot.send_message(chat_id, _format_analysis_page(page), parse_mode="HTML", reply_markup=markup)
+                continue
+            except BadRequest as e:
+                logger.warning("HTML-страница не отправлена, отправляю текстом: %s", e)
+        await bot.send_message(chat_id, page, reply_markup=markup)
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    """Пауза из RetryAfter (в PTB это число секунд или timedelta)."""
+    value = e.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class _ChatStream:
+    """Показывает ответ ИИ по мере генерации: редактирует сообщение с ограничением частоты,
+    длинный ответ продолжает в следующих сообщениях."""
+
+    def __init__(self, bot, chat_id: int, placeholder: str, render: Callable[[str], str], parse_mode: Optional[str] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.placeholder = placeholder
+        self.render = render
+        self.parse_mode = parse_mode
+        self.text = ""
+        self.messages: List[Any] = []
+        self.shown: List[str] = []
+        self.next_edit = 0.0
+
+    async def start(self) -> None:
+        msg = await self.bot.send_message(self.chat_id, self.placeholder)
+        self.messages.append(msg)
+        self.shown.append(self.placeholder)
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL_SEC
+
+    async def feed(self, delta: str) -> None:
+        self.text += delta
+        if time.monotonic() >= self.next_edit:
+            await self._flush(final=False)
+
+    async def finish(self, reply_markup=None) -> None:
+        attached = await self._flush(final=True, reply_markup=reply_markup)
+        if reply_markup is not None and not attached and self.messages:
+            await self._attach_markup(reply_markup)
+
+    async def discard(self) -> None:
+        """Убирает заглушку, если ответа нет."""
+        for msg in self.messages:
+            try:
+                await self.bot.delete_message(chat_id=self.chat_id, message_id=msg.message_id)
+            except Exception:
+                pass
+        self.messages.clear()
+        self.shown.clear()
+
+    async def _attach_markup(self, reply_markup) -> None:
+        """Клавиатуру (ReplyKeyboardMarkup) нельзя добавить правкой сообщения — последняя страница
+        отправляется заново вместе с ней, прежнее сообщение удаляется."""
+        last = self.messages[-1]
+        text = self.shown[-1]
+        try:
+            msg = await self.bot.send_message(self.chat_id, text, parse_mode=self.parse_mode, reply_markup=reply_markup)
+        except BadRequest:
+            msg = await self.bot.send_message(
+                self.chat_id, _clean_answer(_split_pages(self.text)[-1]), reply_markup=reply_markup
+            )
+        except Exception as e:
+            logger.warning("Не удалось прикрепить клавиатуру к ответу: %s", e)
+            return
+        self.messages[-1] = msg
+        try:
+            await self.bot.delete_message(chat_id=self.chat_id, message_id=last.message_id)
+        except Exception:
+            pass
+
+    async def _replace_plain(self, i: int, text: str) -> None:
+        """Запасной вариант, если Telegram не принял HTML страницы: та же страница обычным текстом."""
+        try:
+            if i < len(self.messages):
+                await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.messages[i].message_id, text=text)
+            else:
+                self.messages.append(await self.bot.send_message(self.chat_id, text))
+                self.shown.append(text)
+        except Exception as e:
+            logger.warning("Не удалось показать ответ: %s", e)
+
+    async def _flush(self, final: bool, reply_markup=None) -> bool:
+        """Обновляет сообщения по страницам. True — reply_markup ушёл с новым сообщением последней страницы."""
+        pages = _split_pages(self.text)
+        attached = False
+        for i, page in enumerate(pages):
+            rendered = self.render(page).strip() or "…"
+            if i < len(self.shown) and rendered == self.shown[i]:
+                continue
+            try:
+                if i < len(self.messages):
+                    await self.bot.edit_message_text(
+                        chat_id=self.chat_id,
+                        message_id=self.messages[i].message_id,
+                        text=rendered,
+                        parse_mode=self.parse_mode,
+                    )
+                    self.shown[i] = rendered
+                else:
+                    # Сообщение страницы записываем только после успешной отправки: i всегда == len(self.messages)
+                    markup = reply_markup if final and i == len(pages) - 1 else None
+                    msg = await self.bot.send_message(self.chat_id, rendered, parse_mode=self.parse_mode, reply_markup=markup)
+                    self.messages.append(msg)
+                    self.shown.append(rendered)
+                    attached = markup is not None
+            except RetryAfter as e:
+                # Telegram просит подождать — откладываем промежуточные правки, финальную повторим
+                retry_after = _retry_after_seconds(e)
+                self.next_edit = time.monotonic() + retry_after
+                if not final:
+                    return False
+                await asyncio.sleep(retry_after)
+                return await self._flush(final=True, reply_markup=reply_markup)
+            except Exception as e:
+                logger.debug("Потоковое обновление сообщения: %s", e)
+                if final and self.parse_mode:
+                    await self._replace_plain(i, _clean_answer(page))
+                if i >= len(self.messages):
+                    # Страница так и не отправлена — следующие не отправляем, иначе сообщения сдвинутся
+                    # относительно страниц и следующий flush отредактирует не то сообщение
+                    break
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL_SEC
+        return attached
+
+
+async def _stream_answer(
+    bot,
+    chat_id: int,
+    system_prompt: str,
+    user_text: str,
+    placeholder: str,
+    *,
+    html: bool = False,
+    max_tokens: int = 0,
+    step: Optional[str] = None,
+    reply_markup=None,
+) -> Tuple[str, Optional[Exception]]:
+    """Генерирует ответ потоком прямо в чат. html=True — оформление заключения (_format_conclusion_for_elderly),
+    reply_markup — у последней страницы ответа. Возвращает (исходный текст, ошибка); при пустом ответе заглушка удаляется, сообщение об ошибке — за вызывающим."""
+    messages = _prompt_messages(system_prompt, user_text)
+    max_tokens = max_tokens or _output_tokens(ANALYSIS_MAX_PAGES if html else ANSWER_MAX_PAGES)
+    stream = _ChatStream(
+        bot, chat_id, placeholder,
+        render=_format_analysis_page if html else _clean_answer,
+        parse_mode="HTML" if html else None,
+    )
+    await stream.start()
+    async with _llm_slot("analysis" if html else "interactive"):
+        text, last_err = await _stream_completion("text", messages, max_tokens, stream.feed, step=step)
+    if not text:
+        await stream.discard()
+        return "", last_err
+    await stream.finish(reply_markup)
+    return text, last_err
 
 
 def _save_conclusion(user_id: int, conclusion: str) -> None:
@@ -922,107 +2802,31 @@ def _save_conclusion(user_id: int, conclusion: str) -> None:
         treatment = ("АБЗАЦ 2 " + parts[1]).strip() if len(parts) > 1 else ""
     if user_id not in _user_last:
         _user_last[user_id] = {"diagnosis": "", "treatment": ""}
-    _user_last[user_id]["diagnosis"] = diagnosis[:4000]
-    _user_last[user_id]["treatment"] = treatment[:4000] if treatment else conclusion[:4000]
+    _user_last[user_id]["diagnosis"] = diagnosis
+    _user_last[user_id]["treatment"] = treatment or conclusion
+
+
+def _single_image_messages(image_b64: str, mime: str) -> list:
+    return [
+        {"role": "system", "content": MEDICAL_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Объясни этот медицинский документ простыми словами по пунктам из инструкции."},
+                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{image_b64}"}},
+            ],
+        },
+    ]
 
 
 async def _ask_openai_image(image_b64: str, mime: str = "image/jpeg") -> str:
-    client = get_openai_client()
-    if not client:
-        return ""
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": MEDICAL_PROMPT},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Объясни этот медицинский документ простыми словами по пунктам из инструкции."},
-                    {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{image_b64}"}},
-                ],
-            },
-        ],
-        max_tokens=1500,
-    )
-    return (response.choices[0].message.content or "").strip()
-
-
-async def _ask_openai_text(user_text: str) -> str:
-    client = get_openai_client()
-    if not client:
-        return ""
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": TEXT_PROMPT},
-            {"role": "user", "content": user_text},
-        ],
-        max_tokens=1000,
-    )
-    return (response.choices[0].message.content or "").strip()
-
-
-def _build_multi_content(images: list) -> list:
-    """Список content для OpenAI/Groq: текст + все картинки."""
-    parts = [{"type": "text", "text": "По всем приложенным документам сделай одно заключение по инструкции (два абзаца, пункты 1-2-3)."}]
-    for b64, mime in images:
-        parts.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}})
-    return parts
-
-
-async def _ask_groq_images(images: list) -> str:
-    """images: список кортежей (image_b64, mime)."""
-    client = get_groq_client()
-    if not client or not images:
-        return ""
-    content = _build_multi_content(images)
-    response = client.chat.completions.create(
-        model=GROQ_VISION_MODEL,
-        messages=[
-            {"role": "system", "content": MULTI_DOC_PROMPT},
-            {"role": "user", "content": content},
-        ],
-        max_tokens=2000,
-    )
-    return (response.choices[0].message.content or "").strip()
-
-
-async def _ask_openai_images(images: list) -> str:
-    """images: список кортежей (image_b64, mime)."""
-    client = get_openai_client()
-    if not client or not images:
-        return ""
-    content = _build_multi_content(images)
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": MULTI_DOC_PROMPT},
-            {"role": "user", "content": content},
-        ],
-        max_tokens=2000,
-    )
-    return (response.choices[0].message.content or "").strip()
+    async with _llm_slot("analysis"):
+        return await _chat_completion("openai", OPENAI_VISION_MODEL, _single_image_messages(image_b64, mime), 1500)
 
 
 async def _ask_groq_image(image_b64: str, mime: str = "image/jpeg") -> str:
-    client = get_groq_client()
-    if not client:
-        return ""
-    response = client.chat.completions.create(
-        model=GROQ_VISION_MODEL,
-        messages=[
-            {"role": "system", "content": MEDICAL_PROMPT},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Объясни этот медицинский документ простыми словами по пунктам из инструкции."},
-                    {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{image_b64}"}},
-                ],
-            },
-        ],
-        max_tokens=1500,
-    )
-    return (response.choices[0].message.content or "").strip()
+    async with _llm_slot("analysis"):
+        return await _chat_completion("groq", GROQ_VISION_MODEL, _single_image_messages(image_b64, mime), 1500)
 
 
 def _format_survey_data(answers: dict) -> str:
@@ -1148,6 +2952,73 @@ def _parse_adaptive_question(response: str) -> Optional[Dict[str, Any]]:
     return None
 
 
+def _parse_question_plan(response: str) -> Optional[Dict[str, Any]]:
+    """Парсит план вопросов: {"start": id или None, "nodes": {id: {"q", "options", "next", "then"}}}.
+    start=None — вопросы не нужны; None вместо плана — ответ не разобран."""
+    if not response or not response.strip():
+        return None
+    text = response.strip()
+    text = re.sub(r"^```(?:json)?\s*", "", text)
+    text = re.sub(r"\s*```$", "", text)
+    try:
+        data = _json.loads(text)
+    except (_json.JSONDecodeError, TypeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    if data.get("done"):
+        return {"start": None, "nodes": {}}
+    nodes: Dict[str, Dict[str, Any]] = {}
+    for item in data.get("questions") or []:
+        if not isinstance(item, dict):
+            continue
+        node_id = str(item.get("id", "")).strip()
+        q_text = str(item.get("q", "")).strip()
+        if not node_id or len(q_text) <= 3:
+            continue
+        opts = item.get("options") or []
+        opts = [str(o).strip() for o in opts if str(o).strip()] if isinstance(opts, list) else []
+        nxt = item.get("next") or []
+        nxt = [str(n).strip() for n in nxt] if isinstance(nxt, list) else []
+        nodes[node_id] = {
+            "q": q_text,
+            "options": _auto_add_yes_no(q_text, opts),
+            "next": nxt,
+            "then": str(item.get("then") or "done").strip(),
+        }
+    if not nodes:
+        return None
+    start = str(data.get("start") or "").strip()
+    if start not in nodes:
+        start = next(iter(nodes))
+    return {"start": start, "nodes": nodes}
+
+
+def _match_option(answer: str, options: List[str]) -> Optional[int]:
+    """Индекс варианта, которому соответствует ответ (точно или по началу фразы: «да, болит» → «Да»)."""
+    norm = re.sub(r"[^\w\s]", " ", answer.lower()).split()
+    if not norm:
+        return None
+    for i, opt in enumerate(options):
+        words = re.sub(r"[^\w\s]", " ", opt.lower()).split()
+        if words and norm[:len(words)] == words:
+            return i
+    return None
+
+
+def _plan_next_node(plan: Dict[str, Any], node_id: str, answer: str) -> Tuple[Optional[str], bool]:
+    """Следующий вопрос плана после ответа на node_id: (id или None — план закончен, совпал ли ответ с вариантом)."""
+    node = plan["nodes"].get(node_id) or {}
+    options = node.get("options") or []
+    idx = _match_option(answer, options) if options else None
+    nxt = node.get("next") or []
+    target = nxt[idx] if idx is not None and idx < len(nxt) else node.get("then", "done")
+    matched = not options or idx is not None
+    if target not in plan["nodes"] or target in plan.get("asked", []):
+        return None, matched
+    return target, matched
+
+
 def _format_patient_history(history: List[Dict[str, str]]) -> str:
     """Форматирует историю обращений пациента для промптов."""
     if not history:
@@ -1174,92 +3045,588 @@ def _format_qa_so_far(questions: List[Dict[str, Any]], answers: Dict[int, str])
     return "\n\n".join(lines) if lines else "Вопросы ещё не задавались."
 
 
-async def _ask_ai_text(system_prompt: str, user_text: str) -> str:
-    """Универсальный запрос к текстовому ИИ (Groq, затем OpenAI)."""
-    text = ""
-    client = get_groq_client()
-    if client:
+async def _ask_ai_text(
+    system_prompt: str, user_text: str, step: Optional[str] = None, max_tokens: int = 2000,
+    priority: str = "interactive",
+) -> str:
+    """Универсальный запрос к текстовому ИИ (провайдер выбирает маршрутизатор, очередь — планировщик).
+    step — имя интерактивного шага: такие запросы хеджируются и попадают в метрики задержки."""
+    messages = _prompt_messages(system_prompt, user_text)
+    async with _llm_slot(priority):
+        if step:
+            text, _ = await _hedged_completion(step, "text", messages, max_tokens)
+        else:
+            text, _ = await _routed_completion("text", messages, max_tokens)
+    return text
+
+
+# Локальный классификатор намерений на этапе сбора документов: частые формулировки («всё», «готово»,
+# «нет документов», «нету», вопрос со знаком «?») распознаются правилами без запроса к ИИ.
+# Ответ с уверенностью ниже INTENT_LOCAL_MIN_CONFIDENCE уходит в INTENT_CLASSIFY_PROMPT
+INTENT_LOCAL_MIN_CONFIDENCE = 0.8
+
+_INTENT_DONE_PHRASES = frozenset({
+    "все", "готово", "это все", "вот и все", "пока все", "на этом все", "все готово", "все загрузил",
+    "все загрузила", "все отправил", "все отправила", "загрузил", "загрузила", "отправил", "отправила",
+    "больше документов нет", "больше ничего нет", "больше нет документов", "закончил", "закончила",
+})
+_INTENT_NO_DOCS_PHRASES = frozenset({
+    "нет", "нету", "нема", "неа", "ничего", "ничего нет", "нет ничего", "не имею", "ничего не имею",
+    "нет у меня", "у меня нет", "у меня ничего нет", "на руках нет", "нет на руках", "ничего на руках нет",
+    "без документов", "документов нет", "нет документов",
+})
+_INTENT_NEGATION_RE = re.compile(
+    r"\b(нет|нету|нема|не\s+(имею|сохранил\w*|осталось|остались|делал\w*|сдавал\w*|брал\w*)|"
+    r"отсутству\w*|потерял\w*|выбросил\w*|ничего)\b"
+)
+_INTENT_DOCS_RE = re.compile(
+    r"\b(док\w*|документ\w*|анализ\w*|бумаг\w*|справк\w*|выписк\w*|эпикриз\w*|заключени\w*|"
+    r"снимк\w*|снимок|результат\w*|обследовани\w*|фото\w*)"
+)
+# Обещание прислать позже («сейчас пришлю», «завтра скину») — отрицание рядом с документом тогда не значит
+# «документов нет»; «не понял», «не знаю» и т. п. — отрицание относится к глаголу, а не к документам
+_INTENT_SEND_RE = re.compile(
+    r"\b(пришл\w*|присыл\w*|отправ\w*|скин\w*|загру\w*|сфотограф\w*|сниму|донес\w*|найд\w*|поищ\w*|"
+    r"буд\w*|позже|потом|завтра|сейчас|скоро)\b"
+)
+_INTENT_OTHER_NEGATED_RE = re.compile(r"\bне\s+(?!(имею|сохранил\w*|осталось|остались|делал\w*|сдавал\w*|брал\w*)\b)\w+")
+_INTENT_NEGATION_WINDOW = 3
+# Утвердительный контекст: часть документов всё же есть или будет («анализы есть», «но», «только выписки нет»,
+# «прикладываю»), «ничего страшного / особенного» — оценка, а не отсутствие документов
+_INTENT_AFFIRMATIVE_RE = re.compile(
+    r"\b(есть|имеется|имеются|но|а|только|лишь|кроме|вот|прикладыва\w*|прилага\w*|приложу|прикрепл\w*|"
+    r"прикреп\w*)\b|\bничего\s+\w+ого\b"
+)
+_INTENT_QUESTION_START_RE = re.compile(
+    r"^(что|чем|как|какой|какая|какие|каком|почему|зачем|когда|сколько|где|можно\s+ли|стоит\s+ли|нужно\s+ли|"
+    r"надо\s+ли|опасно\s+ли|нормально\s+ли|это\s+нормально|подскажите|скажите|объясните|посоветуйте)\b"
+)
+_INTENT_MEDICAL_RE = re.compile(
+    r"\b(бол\w*|давлени\w*|температур\w*|лекарств\w*|таблетк\w*|врач\w*|лечени\w*|симптом\w*|"
+    r"сахар\w*|холестерин\w*|гемоглобин\w*|пить|принимать|диагноз\w*)"
+)
+
+_intent_stats: Dict[str, int] = {"local": 0, "llm": 0}
+
+
+def _normalize_intent_text(text: str) -> str:
+    """Нижний регистр, ё → е, без пунктуации и лишних пробелов."""
+    text = text.lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def _classify_intent_local(text: str) -> Tuple[str, float]:
+    """Намерение на этапе сбора документов по правилам: ("done" | "no_docs" | "question" | "other", уверенность 0..1)."""
+    norm = _normalize_intent_text(text)
+    if not norm:
+        return "other", 0.0
+    if norm in _INTENT_DONE_PHRASES:
+        return "done", 1.0
+    if norm in _INTENT_NO_DOCS_PHRASES:
+        return "no_docs", 1.0
+    words = norm.split()
+    is_question = text.rstrip().endswith("?") or bool(_INTENT_QUESTION_START_RE.match(norm))
+    if _INTENT_NEGATION_RE.search(norm) and _INTENT_DOCS_RE.search(norm) and not is_question and len(words) <= 12:
+        if _INTENT_SEND_RE.search(norm) or _INTENT_OTHER_NEGATED_RE.search(norm) or _INTENT_AFFIRMATIVE_RE.search(norm):
+            return "no_docs", 0.5
+        negations = [norm[:m.start()].count(" ") for m in _INTENT_NEGATION_RE.finditer(norm)]
+        docs = [norm[:m.start()].count(" ") for m in _INTENT_DOCS_RE.finditer(norm)]
+        if not any(abs(n - d) <= _INTENT_NEGATION_WINDOW for n in negations for d in docs):
+            return "no_docs", 0.5
+        if any(d > negations[0] for d in docs) and len(docs) > 1:
+            return "no_docs", 0.5  # после отрицания упомянут другой документ — возможно, он есть
+        return "no_docs", 0.9
+    if is_question:
+        confidence = 0.6
+        if text.rstrip().endswith("?"):
+            confidence += 0.2
+        if _INTENT_QUESTION_START_RE.match(norm):
+            confidence += 0.1
+        if _INTENT_MEDICAL_RE.search(norm):
+            confidence += 0.1
+        return "question", round(min(confidence, 1.0), 2)
+    return "other", 0.3
+
+
+# Кеш извлечённых из документов данных: повторно присланный документ не скачивается и не распознаётся заново.
+# Ключи: file_unique_id Telegram -> sha256 содержимого -> данные; LRU с ограничением объёма, хранится в JSON.
+VISION_CACHE_PATH = os.getenv(
+    "VISION_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vision_cache.json")
+)
+VISION_CACHE_MAX_ITEMS = 2000
+VISION_CACHE_MAX_BYTES = 8 * 1024 * 1024
+# Меняется вместе с DOC_EXTRACT_PROMPT / моделями — старые записи при этом отбрасываются
+VISION_CACHE_VERSION = 1
+
+_vision_cache: Dict[str, Any] = {
+    "entries": OrderedDict(),  # sha256 -> findings (от старых к свежим)
+    "by_file": {},  # file_unique_id -> sha256
+    "bytes": 0,
+    "loaded": False,
+    "dirty": False,
+    "hits": 0,
+    "misses": 0,
+}
+
+
+def _vision_cache_load() -> None:
+    """Читает кеш с диска (один раз на процесс)."""
+    if _vision_cache["loaded"]:
+        return
+    _vision_cache["loaded"] = True
+    try:
+        with open(VISION_CACHE_PATH, encoding="utf-8") as f:
+            data = _json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.warning("Кеш документов не прочитан: %s", e)
+        return
+    if data.get("version") != VISION_CACHE_VERSION:
+        return
+    for digest, findings in data.get("entries", []):
+        _vision_cache["entries"][digest] = findings
+        _vision_cache["bytes"] += len(findings.encode("utf-8"))
+    _vision_cache["by_file"] = {
+        uid: digest for uid, digest in data.get("by_file", {}).items() if digest in _vision_cache["entries"]
+    }
+    _vision_cache_evict()
+    logger.info("Кеш документов: %d записей", len(_vision_cache["entries"]))
+
+
+def _vision_cache_save() -> None:
+    """Сохраняет кеш на диск атомарно (если были изменения)."""
+    if not _vision_cache["dirty"]:
+        return
+    _vision_cache["dirty"] = False
+    data = {
+        "version": VISION_CACHE_VERSION,
+        "entries": list(_vision_cache["entries"].items()),
+        "by_file": dict(_vision_cache["by_file"]),
+    }
+    tmp_path = VISION_CACHE_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            _json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, VISION_CACHE_PATH)
+    except OSError as e:
+        logger.warning("Кеш документов не сохранён: %s", e)
+
+
+def _vision_cache_evict() -> None:
+    entries = _vision_cache["entries"]
+    evicted = set()
+    while entries and (len(entries) > VISION_CACHE_MAX_ITEMS or _vision_cache["bytes"] > VISION_CACHE_MAX_BYTES):
+        digest, findings = entries.popitem(last=False)
+        _vision_cache["bytes"] -= len(findings.encode("utf-8"))
+        evicted.add(digest)
+    if evicted:
+        by_file = _vision_cache["by_file"]
+        for uid in [uid for uid, digest in by_file.items() if digest in evicted]:
+            del by_file[uid]
+
+
+def _vision_cache_get(file_unique_id: str = "", digest: str = "") -> Optional[str]:
+    """Ищет данные документа по file_unique_id или по хешу содержимого."""
+    _vision_cache_load()
+    if not digest and file_unique_id:
+        digest = _vision_cache["by_file"].get(file_unique_id, "")
+    findings = _vision_cache["entries"].get(digest) if digest else None
+    if findings is not None:
+        _vision_cache["entries"].move_to_end(digest)
+    return findings
+
+
+def _vision_cache_put(digest: str, file_unique_id: str, findings: str) -> None:
+    _vision_cache_load()
+    entries = _vision_cache["entries"]
+    if digest in entries:
+        _vision_cache["bytes"] -= len(entries[digest].encode("utf-8"))
+    entries[digest] = findings
+    entries.move_to_end(digest)
+    _vision_cache["bytes"] += len(findings.encode("utf-8"))
+    if file_unique_id:
+        _vision_cache["by_file"][file_unique_id] = digest
+    _vision_cache["dirty"] = True
+    _vision_cache_evict()
+
+
+# Предобработка изображений перед vision-запросом (Pillow, в пуле потоков): поворот по EXIF,
+# уменьшение по длинной стороне, пережатие. Длинная сторона 1600 px — текст анализов читается,
+# а OpenAI и Groq всё равно уменьшают большие изображения на своей стороне.
+IMAGE_MAX_LONG_EDGE = int(os.getenv("IMAGE_MAX_LONG_EDGE", "1600"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG | WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "82"))
+# Обрезка по светлой области листа (включается IMAGE_CROP_DOCUMENT=1)
+IMAGE_CROP_DOCUMENT = os.getenv("IMAGE_CROP_DOCUMENT", "").strip().lower() in ("1", "true", "yes")
+IMAGE_WORKERS = 2
+
+_image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+
+def _crop_to_document(img):
+    """Обрезает фон вокруг светлого листа документа. Если лист не найден уверенно — возвращает как есть."""
+    probe = img.convert("L")
+    probe.thumbnail((400, 400))
+    mask = probe.point(lambda v: 255 if v > 150 else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return img
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    total = probe.size[0] * probe.size[1]
+    if area < total * 0.3 or area > total * 0.95:
+        return img
+    sx, sy = img.size[0] / probe.size[0], img.size[1] / probe.size[1]
+    return img.crop((int(bbox[0] * sx), int(bbox[1] * sy), int(bbox[2] * sx), int(bbox[3] * sy)))
+
+
+def _preprocess_image(raw: bytes, mime: str) -> Tuple[str, str, int]:
+    """Готовит изображение к отправке: (base64, mime, размер в байтах). Без Pillow или при ошибке — исходные байты."""
+    data = raw
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        Image = None
+    if Image is not None:
         try:
-            resp = client.chat.completions.create(
-                model=GROQ_TEXT_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_text},
-                ],
-                max_tokens=2000,
-            )
-            text = (resp.choices[0].message.content or "").strip()
+            with Image.open(io.BytesIO(raw)) as src:
+                original_size = src.size
+                rotated = src.getexif().get(0x0112, 1) != 1
+                img = ImageOps.exif_transpose(src)
+                if IMAGE_CROP_DOCUMENT:
+                    img = _crop_to_document(img)
+                if img.mode in ("RGBA", "LA", "P"):
+                    img = img.convert("RGBA")
+                    background = Image.new("RGB", img.size, "white")
+                    background.paste(img, mask=img.split()[-1])
+                    img = background
+                elif img.mode != "RGB":
+                    img = img.convert("RGB")
+                if max(img.size) > IMAGE_MAX_LONG_EDGE:
+                    img.thumbnail((IMAGE_MAX_LONG_EDGE, IMAGE_MAX_LONG_EDGE), Image.LANCZOS)
+                out = io.BytesIO()
+                img.save(out, format=IMAGE_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+            # Исходник оставляем, только если он уже меньше и не требовал поворота/уменьшения
+            if rotated or img.size != original_size or out.tell() < len(raw):
+                data = out.getvalue()
+                mime = "image/webp" if IMAGE_FORMAT == "WEBP" else "image/jpeg"
         except Exception as e:
-            logger.warning("Groq text: %s", e)
-    if not text:
-        client = get_openai_client()
-        if client:
+            logger.warning("Предобработка изображения: %s", e)
+    return base64.b64encode(data).decode("utf-8"), mime, len(data)
+
+
+# Загрузка файлов из Telegram: не больше DOWNLOAD_PER_USER одновременно на пользователя
+# и DOWNLOAD_GLOBAL на весь бот; временные сбои сети повторяются с паузой
+DOWNLOAD_GLOBAL = 8
+DOWNLOAD_PER_USER = 3
+DOWNLOAD_RETRIES = 2
+DOWNLOAD_RETRY_BASE_SEC = 1.0
+
+_download_global = asyncio.Semaphore(DOWNLOAD_GLOBAL)
+# user_id → [семафор, число загрузок в работе или в ожидании]; запись удаляется, когда загрузок нет
+_download_user_slots: Dict[int, List[Any]] = {}
+
+
+async def _download_once(bot, file_id: str, user_id: int) -> bytes:
+    """Одна попытка загрузки: сначала слот пользователя, затем глобальный — чужие файлы не ждут за альбомом."""
+    entry = _download_user_slots.get(user_id)
+    if entry is None:
+        entry = _download_user_slots[user_id] = [asyncio.Semaphore(DOWNLOAD_PER_USER), 0]
+    entry[1] += 1
+    try:
+        async with entry[0], _download_global:
+            tg_file = await bot.get_file(file_id)
+            buf = io.BytesIO()
+            await tg_file.download_to_memory(buf)
+            return buf.getvalue()
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _download_user_slots.pop(user_id, None)
+
+
+async def _download_file(bot, file_id: str, user_id: int = 0) -> bytes:
+    """Скачивает файл Telegram в память (get_file + download_to_memory) с ограничением параллельности и повторами."""
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            return await _download_once(bot, file_id, user_id)
+        except RetryAfter as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            delay = _retry_after_seconds(e)
+        except BadRequest:
+            raise
+        except (NetworkError, httpx.TransportError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            delay = DOWNLOAD_RETRY_BASE_SEC * 2 ** attempt
+            logger.info("Повтор загрузки %s через %.0f с: %s", file_id, delay, e)
+        # Пауза перед повтором — без занятых слотов
+        await asyncio.sleep(delay)
+
+
+async def _extract_document(image_b64: str, mime: str, provider: Optional[str] = None) -> str:
+    """Один vision-запрос: данные одного документа структурированным текстом."""
+    messages = [
+        {"role": "system", "content": DOC_EXTRACT_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Извлеки данные из этого документа по инструкции."},
+                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{image_b64}"}},
+            ],
+        },
+    ]
+    async with _llm_slot("analysis"):
+        text, _ = await _routed_completion("vision", messages, 1500, preferred=provider, payload_bytes=len(image_b64))
+    return _strip_latex(text)
+
+
+# Предзагрузка: файл скачивается и подготавливается сразу при получении, а не по кнопке анализа.
+# Готовые изображения держатся в памяти не дольше PREFETCH_TTL_SEC и в сумме не больше PREFETCH_MAX_BYTES;
+# vision-запрос не делается заранее, чтобы не тратить токены на брошенные батчи
+PREFETCH_MAX_BYTES = 48 * 1024 * 1024
+PREFETCH_TTL_SEC = 30 * 60
+
+_prefetch: Dict[int, Dict[str, Dict[str, Any]]] = {}  # user_id -> file_id -> {"task", "bytes", "at"}
+_prefetch_state: Dict[str, int] = {"bytes": 0, "hits": 0, "dropped": 0}
+
+
+def _prefetch_release(entry: Dict[str, Any]) -> None:
+    """Отменяет незавершённую предзагрузку и освобождает занятый ею объём."""
+    task = entry["task"]
+    if not task.done():
+        task.cancel()
+    _prefetch_state["bytes"] -= entry["bytes"]
+    entry["bytes"] = 0
+
+
+def _prefetch_take(user_id: int, file_id: str) -> Optional[Dict[str, Any]]:
+    """Забирает запись предзагрузки файла (она больше не учитывается в лимите)."""
+    entry = _prefetch.get(user_id, {}).pop(file_id, None)
+    if entry is not None:
+        entry["taken"] = True
+        _prefetch_state["bytes"] -= entry["bytes"]
+        entry["bytes"] = 0
+        if not _prefetch.get(user_id):
+            _prefetch.pop(user_id, None)
+    return entry
+
+
+def _drop_prefetch(user_id: int) -> None:
+    """Сбрасывает все предзагрузки пользователя (Стоп, перезапуск, брошенный батч)."""
+    for entry in (_prefetch.pop(user_id, None) or {}).values():
+        _prefetch_release(entry)
+
+
+def _prefetch_sweep() -> None:
+    """Удаляет предзагрузки старше PREFETCH_TTL_SEC."""
+    deadline = time.monotonic() - PREFETCH_TTL_SEC
+    for user_id in list(_prefetch):
+        files = _prefetch[user_id]
+        for file_id in [f for f, entry in files.items() if entry["at"] < deadline]:
+            _prefetch_release(files.pop(file_id))
+        if not files:
+            _prefetch.pop(user_id, None)
+
+
+async def _prefetch_document(bot, user_id: int, file_id: str, mime: str, entry: Dict[str, Any]) -> Optional[tuple]:
+    """Скачивает и подготавливает файл: (digest, исходный размер, image_b64, mime, размер). None — не удалось или нет места."""
+    try:
+        raw = await _download_file(bot, file_id, user_id)
+        image_b64, mime, size = await asyncio.get_running_loop().run_in_executor(
+            _image_pool, _preprocess_image, raw, mime
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.info("Предзагрузка %s не удалась: %s", file_id, e)
+        return None
+    result = hashlib.sha256(raw).hexdigest(), len(raw), image_b64, mime, size
+    if entry.get("taken"):
+        return result  # файл уже ждёт обработка батча — в лимите не учитываем
+    if _prefetch.get(user_id, {}).get(file_id) is not entry:
+        return None
+    if _prefetch_state["bytes"] + size > PREFETCH_MAX_BYTES:
+        _prefetch_state["dropped"] += 1
+        return None
+    entry["bytes"] = size
+    _prefetch_state["bytes"] += size
+    return result
+
+
+def _start_prefetch(bot, user_id: int, file_id: str, mime: str, file_unique_id: str = "") -> None:
+    """Запускает фоновую предзагрузку файла, если его данных ещё нет в кеше."""
+    if file_unique_id and _vision_cache_get(file_unique_id=file_unique_id) is not None:
+        return
+    _prefetch_sweep()
+    files = _prefetch.setdefault(user_id, {})
+    if file_id in files:
+        return
+    entry: Dict[str, Any] = {"bytes": 0, "at": time.monotonic()}
+    files[file_id] = entry
+    entry["task"] = asyncio.create_task(_prefetch_document(bot, user_id, file_id, mime, entry))
+
+
+async def _document_findings(
+    bot, file_id: str, mime: str, file_unique_id: str, provider: Optional[str] = None,
+    stats: Optional[Dict[str, int]] = None, user_id: int = 0, extract_slot: Optional[asyncio.Semaphore] = None,
+) -> str:
+    """Данные одного документа: из кеша (без скачивания и распознавания) или через vision-запрос.
+    stats накапливает размер исходных и отправленных изображений; extract_slot ограничивает
+    только vision-запросы, загрузки ограничены своими лимитами в _download_file."""
+    prefetched = _prefetch_take(user_id, file_id)
+    findings = _vision_cache_get(file_unique_id=file_unique_id) if file_unique_id else None
+    if findings is None:
+        prepared = await prefetched["task"] if prefetched else None
+        if prepared:
+            _prefetch_state["hits"] += 1
+            digest, original, image_b64, mime, size = prepared
+        else:
             try:
-                resp = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_text},
-                    ],
-                    max_tokens=2000,
-                )
-                text = (resp.choices[0].message.content or "").strip()
+                raw = await _download_file(bot, file_id, user_id)
             except Exception as e:
-                logger.warning("OpenAI text: %s", e)
-    return text
+                logger.warning("Не удалось загрузить файл %s: %s", file_id, e)
+                return ""
+            digest, original = hashlib.sha256(raw).hexdigest(), len(raw)
+        findings = _vision_cache_get(digest=digest)
+        if findings is None:
+            _vision_cache["misses"] += 1
+            if not prepared:
+                image_b64, mime, size = await asyncio.get_running_loop().run_in_executor(
+                    _image_pool, _preprocess_image, raw, mime
+                )
+            if stats is not None:
+                stats["original"] += original
+                stats["sent"] += size
+            if extract_slot is None:
+                findings = await _extract_document(image_b64, mime, provider)
+            else:
+                async with extract_slot:
+                    findings = await _extract_document(image_b64, mime, provider)
+            if not findings:
+                return ""
+        else:
+            _vision_cache["hits"] += 1
+        _vision_cache_put(digest, file_unique_id, findings)
+    else:
+        if prefetched:
+            _prefetch_release(prefetched)
+        _vision_cache["hits"] += 1
+    return findings
+
+
+async def _collect_document_findings(
+    bot, file_ids: list, provider: Optional[str] = None, user_id: int = 0
+) -> List[str]:
+    """Данные всех документов батча: загрузки и vision-запросы (не больше VISION_EXTRACT_CONCURRENCY)
+    идут параллельно, результат — в исходном порядке страниц, без неудачных.
+    Время — по самому медленному документу, а не сумма."""
+    extract_slot = asyncio.Semaphore(VISION_EXTRACT_CONCURRENCY)
+    stats = {"original": 0, "sent": 0}
+    started = time.monotonic()
+    results = await asyncio.gather(*(
+        _document_findings(bot, file_id, mime, file_unique_id, provider, stats, user_id, extract_slot)
+        for file_id, mime, file_unique_id in file_ids
+    ))
+    logger.info("Извлечение данных: %d документов за %.1f с", len(file_ids), time.monotonic() - started)
+    if stats["original"]:
+        logger.info(
+            "Предобработка изображений: %d КБ → %d КБ (сэкономлено %d КБ)",
+            stats["original"] // 1024, stats["sent"] // 1024, (stats["original"] - stats["sent"]) // 1024,
+        )
+    await asyncio.to_thread(_vision_cache_save)
+    return [text for text in results if text]
+
+
+# Итог и уточняющие вопросы после документов — одним структурированным ответом вместо двух запросов подряд
+ANALYSIS_WITH_QUESTIONS_SCHEMA: Dict[str, Any] = {
+    "name": "analysis_with_questions",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "analysis": {"type": "string"},
+            "questions": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["analysis", "questions"],
+        "additionalProperties": False,
+    },
+}
+ANALYSIS_WITH_QUESTIONS_INSTRUCTION = (
+    "Ответ — строго JSON-объект без markdown-обёртки: "
+    '{"analysis": "итог полностью, по структуре и правилам форматирования из инструкции", '
+    '"questions": ["вопрос 1", "вопрос 2"]}. '
+    "В questions — от 1 до 5 самых важных коротких уточняющих вопросов пациенту, которые помогут уточнить "
+    "заключение (текущие симптомы, приём лекарств, дата последнего обследования, аллергии и т.п.), по-русски, на «вы». "
+    "Для открытых вопросов добавляй подсказку в скобках с примерами ответов, например: "
+    "«Какие лекарства принимаете? (название, дозировка, частота приёма)»."
+)
+ANALYSIS_QUESTIONS_EXTRA_TOKENS = 400
 
 
-async def _ask_ai_with_images(system_prompt: str, user_text: str, images: list) -> str:
-    """Запрос к ИИ с текстом и изображениями (Groq, затем OpenAI)."""
-    content = [{"type": "text", "text": user_text}]
-    for b64, mime in images:
-        content.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}})
-    text = ""
-    client = get_groq_client()
-    if client:
-        try:
-            resp = client.chat.completions.create(
-                model=GROQ_VISION_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": content},
-                ],
-                max_tokens=3000,
+def _parse_analysis_with_questions(response: str) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """Строгий разбор ответа по ANALYSIS_WITH_QUESTIONS_SCHEMA: (итог, вопросы) или None, если ответ не по схеме."""
+    try:
+        data = _json.loads(response)
+    except (_json.JSONDecodeError, TypeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    analysis = data.get("analysis")
+    questions = data.get("questions")
+    if not isinstance(analysis, str) or not analysis.strip() or not isinstance(questions, list):
+        return None
+    if not all(isinstance(q, str) for q in questions):
+        return None
+    parsed = [
+        {"q": q.strip(), "options": _auto_add_yes_no(q.strip(), [])}
+        for q in questions[:5]
+        if len(q.strip()) > 3
+    ]
+    return analysis.strip(), parsed
+
+
+async def _synthesize_analysis(
+    survey_data: str,
+    patient_request: str,
+    followup_answers: str,
+    findings: List[str],
+    preferred: Optional[str] = None,
+    with_questions: bool = False,
+) -> Tuple[str, Optional[Exception]]:
+    """Итог по FULL_ANALYSIS_PROMPT одним запросом к текстовой модели по извлечённым данным документов.
+    with_questions=True — ответ по ANALYSIS_WITH_QUESTIONS_SCHEMA (JSON, разбирать _parse_analysis_with_questions)."""
+    followup_qa = ("\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()) if followup_answers.strip() else "Нет."
+    prompt = FULL_ANALYSIS_PROMPT.format(
+        survey_data=survey_data,
+        patient_request=patient_request or "Не указан",
+        followup_qa=followup_qa,
+        documents_section=_documents_section(findings),
+    )
+    user_msg = (
+        f"Запрос пациента: {patient_request or 'не указан'}\n\n"
+        "Выше приведены данные из медицинских документов. Проведи полный анализ по инструкции (8 пунктов итога)."
+    )
+    async with _llm_slot("analysis"):
+        if with_questions:
+            return await _routed_completion(
+                "text", _prompt_messages(prompt, f"{user_msg}\n\n{ANALYSIS_WITH_QUESTIONS_INSTRUCTION}"),
+                _output_tokens(ANALYSIS_MAX_PAGES) + ANALYSIS_QUESTIONS_EXTRA_TOKENS,
+                preferred=preferred, json_schema=ANALYSIS_WITH_QUESTIONS_SCHEMA,
             )
-            text = (resp.choices[0].message.content or "").strip()
-        except Exception as e:
-            logger.warning("Groq vision: %s", e)
-    if not text:
-        client = get_openai_client()
-        if client:
-            try:
-                resp = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": content},
-                    ],
-                    max_tokens=3000,
-                )
-                text = (resp.choices[0].message.content or "").strip()
-            except Exception as e:
-                logger.warning("OpenAI vision: %s", e)
-    return text
+        return await _routed_completion(
+            "text", _prompt_messages(prompt, user_msg), _output_tokens(ANALYSIS_MAX_PAGES), preferred=preferred
+        )
 
 
-async def _ask_groq_text(user_text: str) -> str:
-    client = get_groq_client()
-    if not client:
-        return ""
-    response = client.chat.completions.create(
-        model=GROQ_TEXT_MODEL,
-        messages=[
-            {"role": "system", "content": TEXT_PROMPT},
-            {"role": "user", "content": user_text},
-        ],
-        max_tokens=1000,
+def _documents_section(findings: List[str]) -> str:
+    """Блок документов для FULL_ANALYSIS_PROMPT из извлечённых данных."""
+    blocks = [f"--- Документ {i} ---\n{text}" for i, text in enumerate(findings, 1)]
+    return (
+        "Данные, извлечённые из медицинских документов пациента (по каждому документу отдельно). "
+        "Внимательно изучи ВСЕ документы и используй данные из них в итоге.\n\n" + "\n\n".join(blocks)
     )
-    return (response.choices[0].message.content or "").strip()
 
 
 def _progress_bar(pct: int) -> str:
@@ -1293,30 +3660,17 @@ async def _progress_updater(bot: Any, chat_id: int, message_id: int, stop_event:
 async def _process_pending_images(
     context: ContextTypes.DEFAULT_TYPE, user_id: int, provider: Optional[str] = None
 ) -> None:
-    """Скачать все фото из буфера, показать полосу загрузки, отправить в выбранную AI, выдать одно отформатированное сообщение.
-    provider: "groq" | "openai" | None (None = сначала Groq, при ошибке OpenAI)."""
+    """Разобрать все фото из буфера (данные по каждому документу, затем одно заключение), выдать одно отформатированное сообщение.
+    provider: "groq" | "openai" | None — предпочтительный провайдер; порядок и переключение выбирает маршрутизатор."""
     data = _pending.pop(user_id, None)
     if not data:
         return
+    _llm_user.set(user_id)  # из job_queue вызов идёт вне обработчика обновлений
     chat_id = data["chat_id"]
     file_ids = data["file_ids"]
     if not file_ids:
         return
     bot = context.bot
-    images_b64: List[tuple] = []
-    for file_id, mime in file_ids:
-        try:
-            tg_file = await bot.get_file(file_id)
-            buf = io.BytesIO()
-            await tg_file.download_to_memory(buf)
-            buf.seek(0)
-            raw = buf.read()
-            images_b64.append((base64.b64encode(raw).decode("utf-8"), mime))
-        except Exception as e:
-            logger.warning("Не удалось загрузить файл %s: %s", file_id, e)
-    if not images_b64:
-        await bot.send_message(chat_id, "Не удалось загрузить ни одного документа. Попробуй отправить снова.", reply_markup=MAIN_KEYBOARD)
-        return
 
     # Одно сообщение «Анализирую ваши данные» с полосой загрузки
     progress_msg = await bot.send_message(
@@ -1326,37 +3680,15 @@ async def _process_pending_images(
     stop_event = asyncio.Event()
     progress_task = asyncio.create_task(_progress_updater(bot, chat_id, progress_msg.message_id, stop_event))
 
-    text = ""
-    last_err = None
-    has_groq = _use_groq()
-    has_openai = bool(get_openai_client())
+    text, last_err = "", None
+    findings: List[str] = []
     try:
-        if provider == "groq" and has_groq:
-            try:
-                text = await _ask_groq_images(images_b64)
-            except Exception as e:
-                last_err = e
-                logger.warning("Groq при разборе нескольких фото: %s", e)
-        elif provider == "openai" and has_openai:
-            try:
-                text = await _ask_openai_images(images_b64)
-            except Exception as e:
-                last_err = e
-                logger.warning("OpenAI при разборе нескольких фото: %s", e)
-        else:
-            # provider is None or не совпадает — пробуем Groq, потом OpenAI
-            if has_groq:
-                try:
-                    text = await _ask_groq_images(images_b64)
-                except Exception as e:
-                    last_err = e
-                    logger.warning("Groq при разборе нескольких фото: %s", e)
-            if not text and has_openai:
-                try:
-                    text = await _ask_openai_images(images_b64)
-                except Exception as e:
-                    last_err = e
-                    logger.warning("OpenAI при разборе нескольких фото: %s", e)
+        # Этап 1: данные каждого документа параллельно; этап 2: одно заключение текстовой моделью
+        findings = await _collect_document_findings(bot, file_ids, provider, user_id)
+        if findings:
+            text, last_err = await _synthesize_analysis(
+                _format_survey_data({}), "", "", findings, preferred=provider
+            )
     finally:
         stop_event.set()
         progress_task.cancel()
@@ -1378,6 +3710,9 @@ async def _process_pending_images(
         except Exception:
             pass
 
+    if not findings:
+        await bot.send_message(chat_id, "Не удалось загрузить ни одного документа. Попробуй отправить снова.", reply_markup=MAIN_KEYBOARD)
+        return
     if not text:
         await bot.send_message(
             chat_id,
@@ -1385,21 +3720,13 @@ async def _process_pending_images(
             reply_markup=MAIN_KEYBOARD,
         )
         return
-    if len(text) > 4000:
-        text = text[:3997] + "..."
     _save_conclusion(user_id, text)
-    formatted = _format_conclusion_for_elderly(text)
-    await bot.send_message(
-        chat_id,
-        formatted,
-        reply_markup=MAIN_KEYBOARD,
-        parse_mode="HTML",
-    )
+    await _send_pages(bot, chat_id, text, html=True, reply_markup=MAIN_KEYBOARD)
 
 
 async def _job_process_pending(context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = context.job.data
-    await _process_pending_images(context, user_id, provider="groq")
+    await _process_pending_images(context, user_id)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1495,30 +3822,38 @@ def _schedule_pending_job(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> N
             pass
         ctx = _C()
         ctx.bot = app.bot
-        await _process_pending_images(ctx, uid, provider="groq")
+        await _process_pending_images(ctx, uid)
     _pending_tasks[user_id] = asyncio.create_task(_delayed_batch(context.application, user_id))
 
 
-def _add_to_pending(user_id: int, chat_id: int, file_id: str, mime: str) -> int:
-    """Добавляет файл в буфер _pending, возвращает кол-во файлов."""
+def _add_to_pending(
+    user_id: int, chat_id: int, file_id: str, mime: str, file_unique_id: str = "", bot=None
+) -> int:
+    """Добавляет файл в буфер _pending (и, если передан bot, сразу запускает его предзагрузку), возвращает кол-во файлов."""
+    if bot is not None:
+        _start_prefetch(bot, user_id, file_id, mime, file_unique_id)
     if user_id not in _pending:
         _pending[user_id] = {"chat_id": chat_id, "file_ids": []}
     _pending[user_id]["chat_id"] = chat_id
-    _pending[user_id]["file_ids"].append((file_id, mime))
+    _pending[user_id]["file_ids"].append((file_id, mime, file_unique_id))
     return len(_pending[user_id]["file_ids"])
 
 
+def _drop_pending(user_id: int) -> None:
+    """Очищает буфер _pending пользователя вместе с его предзагрузками."""
+    _pending.pop(user_id, None)
+    _drop_prefetch(user_id)
+
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    has_groq = _use_groq()
-    has_openai = bool(get_openai_client())
-    if not has_groq and not has_openai:
+    if not _any_provider_available():
         await update.message.reply_text(_no_ai_message())
         return
 
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     photo = update.message.photo[-1]
-    n = _add_to_pending(user_id, chat_id, photo.file_id, "image/jpeg")
+    n = _add_to_pending(user_id, chat_id, photo.file_id, "image/jpeg", photo.file_unique_id, context.bot)
 
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("📎 Отправить документы на анализ", callback_data=CB_SEND_DOCS)],
@@ -1545,9 +3880,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    has_groq = _use_groq()
-    has_openai = bool(get_openai_client())
-    if not has_groq and not has_openai:
+    if not _any_provider_available():
         await update.message.reply_text(_no_ai_message())
         return
 
@@ -1557,7 +3890,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if mime not in ("image/jpeg", "image/png", "image/gif", "image/webp"):
         mime = "image/jpeg"
 
-    n = _add_to_pending(user_id, chat_id, doc.file_id, mime)
+    n = _add_to_pending(user_id, chat_id, doc.file_id, mime, doc.file_unique_id, context.bot)
 
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("📎 Отправить документы на анализ", callback_data=CB_SEND_DOCS)],
@@ -1869,7 +4202,7 @@ async def handle_survey_callback(update: Update, context: ContextTypes.DEFAULT_T
 
     sheet_row = context.user_data.get("survey_sheet_row")
     if sheet_row is not None:
-        await asyncio.to_thread(_sheet_update_answer, sheet_row, step, answer_val)
+        _sheet_update_answer(sheet_row, step, answer_val)
 
     chat_id = query.message.chat_id
     bot = context.bot
@@ -1892,6 +4225,7 @@ async def handle_survey_callback(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data.pop("survey_question_message_id", None)
         context.user_data.pop("survey_sheet_row", None)
         context.user_data["completed_survey_answers"] = saved_answers
+        await _sheet_flush()
         context.user_data["awaiting_request"] = True
         await bot.send_message(
             chat_id,
@@ -1901,6 +4235,31 @@ async def handle_survey_callback(update: Update, context: ContextTypes.DEFAULT_T
         )
 
 
+async def _finish_doc_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
+    """Пользователь закончил присылать документы: выбор ИИ (или сразу разбор), если есть что разбирать."""
+    if user_id in _pending and _pending[user_id]["file_ids"]:
+        if context.job_queue:
+            job_name = f"process_pending_{user_id}"
+            for job in context.job_queue.jobs():
+                if job.name == job_name:
+                    job.schedule_removal()
+                    break
+        task = _pending_tasks.pop(user_id, None)
+        if task and not task.done():
+            task.cancel()
+        keyboard = _ai_choice_keyboard()
+        if keyboard:
+            await update.message.reply_text(
+                "Готово к анализу. Выберите ИИ:",
+                reply_markup=keyboard,
+            )
+        else:
+            await _process_pending_images(context, user_id)
+        return
+    # иначе просто ответим, что нечего разбирать
+    await update.message.reply_text("Пока нет документов для разбора. Пришли фото или файлы анализов/заключений.", reply_markup=MAIN_KEYBOARD)
+
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_text = (update.message.text or "").strip()
@@ -2127,13 +4486,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         context.user_data.pop("post_doc_followup_questions", None)
         full_analysis = context.user_data.get("full_analysis", "")
         if full_analysis:
-            qa_block = "Ответы пациента на уточняющие вопросы:\n" + user_text[:2000]
+            # Ответы целиком — в разделе qa_block шаблона (его сокращает бюджет токенов), в сообщении — только начало
             refine_prompt = REFINED_ANALYSIS_PROMPT.format(
-                full_analysis=full_analysis[:6000],
-                qa_block=qa_block,
+                full_analysis=full_analysis,
+                qa_block="Ответы пациента на уточняющие вопросы:\n" + user_text,
             )
             await update.message.reply_text("Уточняю заключение с учётом ваших ответов…")
-            refined = await _ask_ai_text(refine_prompt, qa_block)
+            refined = await _ask_ai_text(
+                refine_prompt, user_text[:500], max_tokens=_output_tokens(ANALYSIS_MAX_PAGES), priority="analysis"
+            )
             if refined:
                 refined = _strip_latex(refined)
                 context.user_data["full_analysis"] = refined
@@ -2156,7 +4517,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         context.user_data["survey_answers"][f"q{survey_step}"] = answer_val
         sheet_row = context.user_data.get("survey_sheet_row")
         if sheet_row is not None:
-            await asyncio.to_thread(_sheet_update_answer, sheet_row, survey_step, answer_val)
+            _sheet_update_answer(sheet_row, survey_step, answer_val)
         chat_id = update.effective_chat.id
         bot = context.bot
         msg_id = context.user_data.get("survey_question_message_id")
@@ -2179,6 +4540,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             context.user_data.pop("survey_question_message_id", None)
             context.user_data.pop("survey_sheet_row", None)
             context.user_data["completed_survey_answers"] = saved_answers
+            await _sheet_flush()
             context.user_data["awaiting_request"] = True
             await bot.send_message(
                 chat_id,
@@ -2202,7 +4564,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         task = _pending_tasks.pop(user_id, None)
         if task and not task.done():
             task.cancel()
-        _pending.pop(user_id, None)
+        _drop_pending(user_id)
         await update.message.reply_text("Остановлено. Буфер фото очищен.", reply_markup=MAIN_KEYBOARD)
         return
     if user_text == "Перезапустить":
@@ -2215,7 +4577,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         task = _pending_tasks.pop(user_id, None)
         if task and not task.done():
             task.cancel()
-        _pending.pop(user_id, None)
+        _drop_pending(user_id)
         await update.message.reply_text(
             "Перезапуск. Буфер очищен. Можешь начать заново: пришли фото или нажми «Добавить фото».",
             reply_markup=MAIN_KEYBOARD,
@@ -2231,7 +4593,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         last = _user_last.get(user_id, {})
         diagnosis = (last.get("diagnosis") or "").strip()
         if diagnosis:
-            await update.message.reply_text(diagnosis, reply_markup=MAIN_KEYBOARD)
+            await _send_pages(context.bot, update.effective_chat.id, diagnosis, reply_markup=MAIN_KEYBOARD)
         else:
             await update.message.reply_text("Пока нет сохранённого заключения. Пришли фото анализов/документов — разберу и сохраню.", reply_markup=MAIN_KEYBOARD)
         return
@@ -2239,7 +4601,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         last = _user_last.get(user_id, {})
         treatment = (last.get("treatment") or last.get("diagnosis") or "").strip()
         if treatment:
-            await update.message.reply_text(treatment, reply_markup=MAIN_KEYBOARD)
+            await _send_pages(context.bot, update.effective_chat.id, treatment, reply_markup=MAIN_KEYBOARD)
         else:
             await update.message.reply_text("Пока нет сохранённых рекомендаций по лечению. Пришли фото — после разбора они появятся здесь.", reply_markup=MAIN_KEYBOARD)
         return
@@ -2249,9 +4611,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if ask_result in ("где итог?", "где итог", "где результат?", "где результат", "показать результат", "показать итог", "итог", "результат"):
         analysis = context.user_data.get("full_analysis", "")
         if analysis:
-            to_show = analysis[:3997] + "..." if len(analysis) > 4000 else analysis
-            formatted = _format_conclusion_for_elderly(to_show)
-            await _send_long_html(context.bot, update.effective_chat.id, formatted, reply_markup=MAIN_KEYBOARD)
+            await _send_pages(context.bot, update.effective_chat.id, analysis, html=True, reply_markup=MAIN_KEYBOARD)
             continue_kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("✅ Да, продолжить", callback_data=CB_CONTINUE_YES), InlineKeyboardButton("❌ Нет, спасибо", callback_data=CB_CONTINUE_NO)],
             ])
@@ -2266,61 +4626,46 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     # «Всё» / «готово» — показать выбор ИИ и ждать нажатия кнопки (или уже есть кнопки в предыдущем сообщении)
     if user_text.lower() in ("всё", "готово", "все", "готово."):
-        if user_id in _pending and _pending[user_id]["file_ids"]:
-            if context.job_queue:
-                job_name = f"process_pending_{user_id}"
-                for job in context.job_queue.jobs():
-                    if job.name == job_name:
-                        job.schedule_removal()
-                        break
-            task = _pending_tasks.pop(user_id, None)
-            if task and not task.done():
-                task.cancel()
-            keyboard = _ai_choice_keyboard()
-            if keyboard:
-                await update.message.reply_text(
-                    "Готово к анализу. Выберите ИИ:",
-                    reply_markup=keyboard,
-                )
-            else:
-                await _process_pending_images(context, user_id)
-            return
-        # иначе просто ответим, что нечего разбирать
-        await update.message.reply_text("Пока нет документов для разбора. Пришли фото или файлы анализов/заключений.", reply_markup=MAIN_KEYBOARD)
+        await _finish_doc_upload(update, context, user_id)
         return
 
     # Умное определение намерения: collecting_docs -> AI-классификатор
     if context.user_data.get("collecting_docs"):
-        classify_prompt = INTENT_CLASSIFY_PROMPT.format(user_text=user_text[:300])
-        intent_raw = await _ask_ai_text(classify_prompt, user_text[:200])
-        intent = (intent_raw or "").strip().lower().split()[0] if intent_raw else "other"
+        intent, confidence = _classify_intent_local(user_text)
+        if confidence >= INTENT_LOCAL_MIN_CONFIDENCE:
+            _intent_stats["local"] += 1
+        else:
+            _intent_stats["llm"] += 1
+            classify_prompt = INTENT_CLASSIFY_PROMPT.format(user_text=user_text[:300])
+            intent_raw = await _ask_ai_text(classify_prompt, user_text[:200])
+            intent = (intent_raw or "").strip().lower().split()[0] if intent_raw else "other"
+        if intent == "done":
+            await _finish_doc_upload(update, context, user_id)
+            return
         if intent not in ("no_docs", "question", "other"):
             intent = "other"
 
         if intent == "no_docs":
             context.user_data["collecting_docs"] = False
-            _pending.pop(user_id, None)
+            _drop_pending(user_id)
             patient_request = context.user_data.get("patient_request", "")
             survey_answers = context.user_data.get("completed_survey_answers") or {}
             survey_data = _format_survey_data(survey_answers)
             followup_answers = context.user_data.get("last_followup_answers", "") or ""
-            followup_qa = ("\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()[:2000]) if followup_answers.strip() else "Нет."
+            followup_qa = ("\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()) if followup_answers.strip() else "Нет."
             documents_section = "Медицинские документы НЕ предоставлены. Используй только данные опроса, запрос и ответы на уточняющие вопросы."
 
-            await update.message.reply_text("Провожу анализ на основе ваших данных…")
-
             prompt = FULL_ANALYSIS_PROMPT.format(
                 survey_data=survey_data,
                 patient_request=patient_request or "Не указан",
                 followup_qa=followup_qa,
                 documents_section=documents_section,
             )
-            try:
-                analysis = await _ask_ai_text(prompt, (patient_request or "анализ")[:500])
-            except Exception:
-                logger.exception("handle_text no_docs: AI error")
-                await update.message.reply_text("Произошла ошибка при анализе. Попробуйте ещё раз через минуту.", reply_markup=MAIN_KEYBOARD)
-                return
+            # Выводы и рекомендации показываются по мере генерации (частями, если длинно)
+            analysis, _ = await _stream_answer(
+                context.bot, update.effective_chat.id, prompt, (patient_request or "анализ")[:500],
+                "Провожу анализ на основе ваших данных…", html=True, reply_markup=MAIN_KEYBOARD,
+            )
             if not analysis:
                 await update.message.reply_text("Не удалось выполнить анализ. Попробуйте позже.", reply_markup=MAIN_KEYBOARD)
                 return
@@ -2328,10 +4673,6 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             analysis = _strip_foreign_chars(analysis)
             context.user_data["full_analysis"] = analysis
             _save_conclusion(user_id, analysis)
-            # Сразу показываем выводы и рекомендации (частями, если длинно)
-            to_show = analysis[:3997] + "..." if len(analysis) > 4000 else analysis
-            formatted = _format_conclusion_for_elderly(to_show)
-            await _send_long_html(context.bot, update.effective_chat.id, formatted, reply_markup=MAIN_KEYBOARD)
             continue_kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("✅ Да, продолжить", callback_data=CB_CONTINUE_YES), InlineKeyboardButton("❌ Нет, спасибо", callback_data=CB_CONTINUE_NO)],
             ])
@@ -2346,23 +4687,23 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
             q_prompt = FOLLOWUP_PROMPT.format(
                 survey_data=survey_data,
-                previous_analysis=previous_analysis[:3000] if previous_analysis else f"Описание ситуации: {patient_request}",
+                previous_analysis=previous_analysis if previous_analysis else f"Описание ситуации: {patient_request}",
                 followup_question=user_text,
                 followup_qa="",
             )
-            await update.message.reply_text("Отвечаю на ваш вопрос…")
-            answer = await _ask_ai_text(q_prompt, user_text[:500])
-            if answer:
-                answer = _strip_latex(answer)
-                answer = _strip_foreign_chars(answer)
-            else:
-                answer = "К сожалению, не удалось обработать вопрос. Попробуйте переформулировать."
+            answer, _ = await _stream_answer(
+                context.bot, update.effective_chat.id, q_prompt, user_text[:500], "Отвечаю на ваш вопрос…", step="qa",
+                reply_markup=MAIN_KEYBOARD,
+            )
+            if not answer:
+                await update.message.reply_text(
+                    "К сожалению, не удалось обработать вопрос. Попробуйте переформулировать.", reply_markup=MAIN_KEYBOARD
+                )
 
             docs_kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("📎 Отправить документы на анализ", callback_data=CB_SEND_DOCS)],
                 [InlineKeyboardButton("📝 Нет документов", callback_data=CB_NO_DOCS)],
             ])
-            await update.message.reply_text(answer, reply_markup=MAIN_KEYBOARD)
             await update.message.reply_text(
                 "Вы также можете загрузить медицинские документы для более точного анализа "
                 "или нажать «Нет документов», чтобы продолжить без них.",
@@ -2390,28 +4731,14 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await _advance_clarify(update.effective_chat.id, context, user_text.strip())
         return
 
-    has_groq = _use_groq()
-    has_openai = bool(get_openai_client())
-    if not has_groq and not has_openai:
+    if not _any_provider_available():
         await update.message.reply_text(_no_ai_message())
         return
 
-    await update.message.reply_text("Думаю…")
-
-    text = ""
-    last_err = None
-    if has_groq:
-        try:
-            text = await _ask_groq_text(user_text)
-        except Exception as e:
-            last_err = e
-            logger.warning("Groq при тексте: %s", e)
-    if not text and has_openai:
-        try:
-            text = await _ask_openai_text(user_text)
-        except Exception as e:
-            last_err = e
-            logger.warning("OpenAI при тексте: %s", e)
+    text, last_err = await _stream_answer(
+        context.bot, update.effective_chat.id, TEXT_PROMPT, user_text, "Думаю…", max_tokens=1000, step="qa",
+        reply_markup=MAIN_KEYBOARD,
+    )
 
     if not text:
         msg = "Не удалось получить ответ. "
@@ -2420,10 +4747,6 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         else:
             msg += "Проверь ключи в .env (Groq или OpenAI)."
         await update.message.reply_text(msg, reply_markup=MAIN_KEYBOARD)
-        return
-    if len(text) > 4000:
-        text = text[:3997] + "..."
-    await update.message.reply_text(text, reply_markup=MAIN_KEYBOARD)
 
 
 async def _handle_patient_request(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
@@ -2443,16 +4766,27 @@ async def _handle_patient_request(update: Update, context: ContextTypes.DEFAULT_
 
     await update.message.reply_text("Анализирую ваш запрос…")
 
-    first_q_prompt = ADAPTIVE_QUESTION_PROMPT.format(
-        survey_data=survey_data,
-        patient_history=history_text,
-        patient_request=text[:1500],
-        qa_so_far="Вопросы ещё не задавались.",
-        question_number=1,
-        max_questions=MAX_ADAPTIVE_QUESTIONS,
-    )
-    first_q_raw = await _ask_ai_text(first_q_prompt, text[:500])
-    first_q = _parse_adaptive_question(first_q_raw) if first_q_raw else None
+    context.user_data.pop("clarify_plan", None)
+    context.user_data["clarify_replans"] = 0
+    context.user_data["clarify_spec_used"] = 0
+    plan = None
+    if CLARIFY_PLAN_ENABLED:
+        plan = await _request_question_plan(survey_data, history_text, text, "Вопросы ещё не задавались.", 0)
+    if plan is not None:
+        first_q = _plan_question(plan, plan["start"]) if plan["start"] else None
+        if first_q:
+            context.user_data["clarify_plan"] = plan
+    else:
+        first_q_prompt = ADAPTIVE_QUESTION_PROMPT.format(
+            survey_data=survey_data,
+            patient_history=history_text,
+            patient_request=text,
+            qa_so_far="Вопросы ещё не задавались.",
+            question_number=1,
+            max_questions=MAX_ADAPTIVE_QUESTIONS,
+        )
+        first_q_raw = await _ask_ai_text(first_q_prompt, text[:500], step="clarify")
+        first_q = _parse_adaptive_question(first_q_raw) if first_q_raw else None
 
     if first_q:
         sa = context.user_data.get("completed_survey_answers") or {}
@@ -2477,23 +4811,21 @@ async def _handle_patient_request(update: Update, context: ContextTypes.DEFAULT_
         context.user_data.pop("is_followup_request", None)
         prompt = FOLLOWUP_PROMPT.format(
             survey_data=survey_data,
-            previous_analysis=previous_analysis[:3000],
+            previous_analysis=previous_analysis,
             followup_question=text,
             followup_qa="",
-            patient_history=history_text,
         )
-        ai_response = await _ask_ai_text(prompt, text)
+        ai_response, _ = await _stream_answer(
+            context.bot, update.effective_chat.id, prompt, text, "Отвечаю на ваш вопрос…", reply_markup=MAIN_KEYBOARD
+        )
         if not ai_response:
-            ai_response = "К сожалению, не удалось обработать запрос. Попробуйте переформулировать."
-
-        ai_response = _strip_latex(ai_response)
-        ai_response = _strip_foreign_chars(ai_response)
+            await update.message.reply_text(
+                "К сожалению, не удалось обработать запрос. Попробуйте переформулировать.", reply_markup=MAIN_KEYBOARD
+            )
 
         context.user_data["collecting_docs"] = True
         user_id = update.effective_user.id
-        _pending.pop(user_id, None)
-
-        await update.message.reply_text(ai_response, reply_markup=MAIN_KEYBOARD)
+        _drop_pending(user_id)
 
         continue_kb = InlineKeyboardMarkup([
             [
@@ -2527,8 +4859,13 @@ async def _send_clarify_question(chat_id: int, context: ContextTypes.DEFAULT_TYP
     if not options and re.search(yes_no_pattern, q_text, re.I) and not re.search(r"\bили\b", q_text, re.I):
         options = ["Да", "Нет"]
 
+    if isinstance(q_data, dict):
+        q_data["options"] = options  # кнопки и handle_clarify_callback должны видеть один список вариантов
+
     context.user_data["clarify_step"] = step
     context.user_data["awaiting_clarify_answer"] = True
+    if options:
+        _start_clarify_speculation(chat_id, context, step, options)
 
     header = f"<b>Вопрос {step + 1}</b>\n\n{_escape_html(q_text)}"
     if options:
@@ -2544,8 +4881,128 @@ async def _send_clarify_question(chat_id: int, context: ContextTypes.DEFAULT_TYP
         )
 
 
+async def _request_question_plan(
+    survey_data: str, history_text: str, patient_request: str, qa_so_far: str, asked: int
+) -> Optional[Dict[str, Any]]:
+    """Один запрос за весь план уточняющих вопросов (см. QUESTION_PLAN_PROMPT). None — план не получен."""
+    prompt = QUESTION_PLAN_PROMPT.format(
+        survey_data=survey_data,
+        patient_history=history_text,
+        patient_request=patient_request,
+        qa_so_far=qa_so_far,
+        max_questions=MAX_ADAPTIVE_QUESTIONS - asked,
+    )
+    raw = await _ask_ai_text(prompt, patient_request[:500], step="clarify", max_tokens=3000)
+    plan = _parse_question_plan(raw) if raw else None
+    if plan is None:
+        logger.info("План вопросов не разобран, перехожу на вопросы по одному")
+        return None
+    plan["asked"] = []
+    logger.info("План вопросов: %d вопросов", len(plan["nodes"]))
+    return plan
+
+
+def _plan_question(plan: Dict[str, Any], node_id: str) -> Dict[str, Any]:
+    """Делает вопрос плана текущим и возвращает его в формате clarify_questions."""
+    plan["current"] = node_id
+    plan["asked"].append(node_id)
+    node = plan["nodes"][node_id]
+    return {"q": node["q"], "options": node["options"]}
+
+
+async def _next_planned_question(
+    context: ContextTypes.DEFAULT_TYPE, plan: Dict[str, Any], answer: str,
+    questions: List[Dict[str, Any]], answers: Dict[int, str],
+) -> Optional[Dict[str, Any]]:
+    """Следующий вопрос по плану без запроса к ИИ; перепланирует, только если ответ не совпал с вариантами."""
+    if len(questions) >= MAX_ADAPTIVE_QUESTIONS:
+        return None
+    node_id, matched = _plan_next_node(plan, plan.get("current", ""), answer)
+    replans = context.user_data.get("clarify_replans", 0)
+    if not matched and replans < CLARIFY_MAX_REPLANS:
+        context.user_data["clarify_replans"] = replans + 1
+        new_plan = await _request_question_plan(
+            _format_survey_data(context.user_data.get("completed_survey_answers") or {}),
+            _format_patient_history(context.user_data.get("patient_history", [])),
+            context.user_data.get("patient_request", ""),
+            _format_qa_so_far(questions, answers),
+            len(questions),
+        )
+        if new_plan is not None:
+            context.user_data["clarify_plan"] = plan = new_plan
+            node_id = plan["start"]
+    if not node_id:
+        return None
+    return _plan_question(plan, node_id)
+
+
+async def _adaptive_next_question(
+    context: ContextTypes.DEFAULT_TYPE, questions: List[Dict[str, Any]], answers: Dict[int, str],
+    question_number: int, step: Optional[str] = None, priority: str = "interactive",
+) -> Optional[Dict[str, Any]]:
+    """Следующий вопрос пошагового опроса по ADAPTIVE_QUESTION_PROMPT; None — вопросов больше не нужно."""
+    patient_request = context.user_data.get("patient_request", "")
+    prompt = ADAPTIVE_QUESTION_PROMPT.format(
+        survey_data=_format_survey_data(context.user_data.get("completed_survey_answers") or {}),
+        patient_history=_format_patient_history(context.user_data.get("patient_history", [])),
+        patient_request=patient_request,
+        qa_so_far=_format_qa_so_far(questions, answers),
+        question_number=question_number,
+        max_questions=MAX_ADAPTIVE_QUESTIONS,
+    )
+    raw = await _ask_ai_text(prompt, patient_request[:500], step=step, priority=priority)
+    return _parse_adaptive_question(raw) if raw else None
+
+
+def _cancel_clarify_speculation(chat_id: int) -> None:
+    """Отменяет спекулятивные запросы по чату."""
+    spec = _clarify_speculation.pop(chat_id, None)
+    for task in (spec or {}).get("tasks", {}).values():
+        if not task.done():
+            task.cancel()
+
+
+def _start_clarify_speculation(
+    chat_id: int, context: ContextTypes.DEFAULT_TYPE, step: int, options: List[str]
+) -> None:
+    """Запускает генерацию следующего вопроса для каждого варианта ответа (только пошаговый режим, в пределах бюджета)."""
+    _cancel_clarify_speculation(chat_id)
+    if not CLARIFY_SPECULATE_ENABLED or context.user_data.get("clarify_plan") is not None:
+        return
+    next_number = step + 2
+    if next_number > MAX_ADAPTIVE_QUESTIONS:
+        return
+    options = options[:CLARIFY_SPECULATE_OPTIONS]
+    used = context.user_data.get("clarify_spec_used", 0)
+    if used + len(options) > CLARIFY_SPECULATE_BUDGET:
+        return
+    context.user_data["clarify_spec_used"] = used + len(options)
+    questions = list(context.user_data.get("clarify_questions", []))
+    tasks: Dict[str, asyncio.Task] = {}
+    for option in options:
+        answers = dict(context.user_data.get("clarify_answers", {}))
+        answers[step] = option
+        tasks[option] = asyncio.create_task(
+            _adaptive_next_question(context, questions, answers, next_number, priority="background")
+        )
+    _speculation_stats["launched"] += len(tasks)
+    _clarify_speculation[chat_id] = {"step": step, "tasks": tasks}
+
+
+def _take_clarify_speculation(chat_id: int, step: int, answer: str) -> Optional[asyncio.Task]:
+    """Забирает заранее запущенный запрос для выбранного варианта, остальные ветки отменяет."""
+    spec = _clarify_speculation.get(chat_id)
+    if not spec or spec["step"] != step:
+        _cancel_clarify_speculation(chat_id)
+        return None
+    task = spec["tasks"].pop(answer, None)
+    _cancel_clarify_speculation(chat_id)
+    _speculation_stats["hits" if task is not None else "misses"] += 1
+    return task
+
+
 async def _advance_clarify(chat_id: int, context: ContextTypes.DEFAULT_TYPE, answer: str) -> None:
-    """Адаптивный опрос: сохраняет ответ, генерирует следующий вопрос или завершает."""
+    """Адаптивный опрос: сохраняет ответ, берёт следующий вопрос из плана (или генерирует его) либо завершает."""
     step = context.user_data.get("clarify_step", 0)
     answers = context.user_data.get("clarify_answers", {})
     answers[step] = answer
@@ -2555,24 +5012,22 @@ async def _advance_clarify(chat_id: int, context: ContextTypes.DEFAULT_TYPE, ans
     questions = context.user_data.get("clarify_questions", [])
     next_number = step + 2  # step 0-based, question_number 1-based
 
-    if next_number <= MAX_ADAPTIVE_QUESTIONS:
-        survey_answers = context.user_data.get("completed_survey_answers") or {}
-        survey_data = _format_survey_data(survey_answers)
-        patient_request = context.user_data.get("patient_request", "")
-        patient_history = context.user_data.get("patient_history", [])
-        history_text = _format_patient_history(patient_history)
-        qa_text = _format_qa_so_far(questions, answers)
-
-        next_q_prompt = ADAPTIVE_QUESTION_PROMPT.format(
-            survey_data=survey_data,
-            patient_history=history_text,
-            patient_request=patient_request[:1500],
-            qa_so_far=qa_text,
-            question_number=next_number,
-            max_questions=MAX_ADAPTIVE_QUESTIONS,
-        )
-        next_q_raw = await _ask_ai_text(next_q_prompt, patient_request[:500])
-        next_q = _parse_adaptive_question(next_q_raw) if next_q_raw else None
+    plan = context.user_data.get("clarify_plan")
+    if plan is not None:
+        next_q = await _next_planned_question(context, plan, answer, questions, answers)
+        if next_q:
+            questions.append(next_q)
+            context.user_data["clarify_questions"] = questions
+            await _send_clarify_question(chat_id, context, step + 1)
+            return
+    elif next_number <= MAX_ADAPTIVE_QUESTIONS:
+        speculative = _take_clarify_speculation(chat_id, step, answer)
+        if speculative is not None:
+            # Фоновая задача, возможно, ещё ждёт слот — теперь её ждёт пользователь
+            _llm_promote(speculative, "interactive")
+            next_q = await speculative
+        else:
+            next_q = await _adaptive_next_question(context, questions, answers, next_number, step="clarify")
 
         if next_q:
             questions.append(next_q)
@@ -2593,6 +5048,10 @@ async def _advance_clarify(chat_id: int, context: ContextTypes.DEFAULT_TYPE, ans
     context.user_data.pop("clarify_answers", None)
     context.user_data.pop("clarify_step", None)
     context.user_data.pop("awaiting_clarify_answer", None)
+    context.user_data.pop("clarify_plan", None)
+    context.user_data.pop("clarify_replans", None)
+    context.user_data.pop("clarify_spec_used", None)
+    _cancel_clarify_speculation(chat_id)
 
     patient_request = context.user_data.get("patient_request", "")
     survey_answers = context.user_data.get("completed_survey_answers") or {}
@@ -2634,28 +5093,28 @@ async def _finish_followup_with_clarify(
     """Follow-up анализ после уточняющих вопросов: использует FOLLOWUP_PROMPT с ответами."""
     followup_qa = ""
     if followup_answers and followup_answers.strip():
-        followup_qa = followup_answers.strip()[:2000]
+        followup_qa = followup_answers.strip()
 
     prompt = FOLLOWUP_PROMPT.format(
         survey_data=survey_data,
-        previous_analysis=previous_analysis[:3000],
+        previous_analysis=previous_analysis,
         followup_question=patient_request,
         followup_qa=followup_qa,
     )
-    await update.message.reply_text("Анализирую вашу ситуацию с учётом ответов…")
-    ai_response = await _ask_ai_text(prompt, patient_request[:500])
-    if not ai_response:
+    ai_response, _ = await _stream_answer(
+        context.bot, update.effective_chat.id, prompt, patient_request[:500],
+        "Анализирую вашу ситуацию с учётом ответов…", reply_markup=MAIN_KEYBOARD,
+    )
+    if ai_response:
+        ai_response = _clean_answer(ai_response)
+    else:
         ai_response = "К сожалению, не удалось обработать запрос. Попробуйте переформулировать."
-
-    ai_response = _strip_latex(ai_response)
-    ai_response = _strip_foreign_chars(ai_response)
+        await update.message.reply_text(ai_response, reply_markup=MAIN_KEYBOARD)
 
     context.user_data["full_analysis"] = ai_response
     context.user_data["collecting_docs"] = True
     user_id = update.effective_user.id
-    _pending.pop(user_id, None)
-
-    await update.message.reply_text(ai_response, reply_markup=MAIN_KEYBOARD)
+    _drop_pending(user_id)
 
     continue_kb = InlineKeyboardMarkup([
         [
@@ -2680,7 +5139,7 @@ async def _finish_patient_request_with_docs(
     """После ответов на уточняющие вопросы (или без них): анализ запроса, список документов, кнопка загрузки."""
     followup_qa = ""
     if followup_answers and followup_answers.strip():
-        followup_qa = "\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()[:2000]
+        followup_qa = "\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()
 
     prompt = REQUEST_ANALYSIS_PROMPT.format(
         survey_data=survey_data,
@@ -2688,7 +5147,7 @@ async def _finish_patient_request_with_docs(
         followup_qa=followup_qa,
     )
     await update.message.reply_text("Анализирую ваш запрос…")
-    ai_response = await _ask_ai_text(prompt, patient_request[:500])
+    ai_response = await _ask_ai_text(prompt, patient_request[:500], max_tokens=_output_tokens(1), priority="analysis")
     if not ai_response:
         ai_response = (
             "Пожалуйста, загрузите имеющиеся медицинские документы:\n\n"
@@ -2699,14 +5158,14 @@ async def _finish_patient_request_with_docs(
     context.user_data["collecting_docs"] = True
     context.user_data["last_followup_answers"] = followup_answers or ""
     user_id = update.effective_user.id
-    _pending.pop(user_id, None)
+    _drop_pending(user_id)
 
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("📎 Отправить документы на анализ", callback_data=CB_SEND_DOCS)],
         [InlineKeyboardButton("📝 Нет документов", callback_data=CB_NO_DOCS)],
     ])
+    await _send_pages(context.bot, update.effective_chat.id, ai_response)
     await update.message.reply_text(
-        f"{ai_response}\n\n"
         "Загрузите документы (фото или файлы). Когда всё прикрепите — нажмите кнопку ниже.\n"
         "Если документов нет — нажмите «Нет документов».",
         reply_markup=keyboard,
@@ -2719,18 +5178,14 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not voice:
         return
     try:
-        tg_file = await context.bot.get_file(voice.file_id)
-        buf = io.BytesIO()
-        await tg_file.download_to_memory(buf)
-        buf.seek(0)
-        voice_bytes = buf.read()
+        voice_bytes = await _download_file(context.bot, voice.file_id, update.effective_user.id)
     except Exception as e:
         logger.warning("Не удалось скачать голосовое: %s", e)
         await update.message.reply_text("Не удалось загрузить голосовое сообщение. Попробуйте ещё раз.")
         return
 
     await update.message.reply_text("Распознаю голос…")
-    text = await asyncio.to_thread(_transcribe_voice_sync, voice_bytes)
+    text = await _transcribe_voice(voice_bytes)
     if not text:
         await update.message.reply_text(
             "Не удалось распознать речь. Попробуйте записать ещё раз или напишите текстом."
@@ -2751,13 +5206,15 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         post_doc_questions = context.user_data.pop("post_doc_followup_questions", [])
         full_analysis = context.user_data.get("full_analysis", "")
         if full_analysis:
-            qa_block = "Ответы пациента на уточняющие вопросы:\n" + text[:2000]
+            # Ответы целиком — в разделе qa_block шаблона (его сокращает бюджет токенов), в сообщении — только начало
             refine_prompt = REFINED_ANALYSIS_PROMPT.format(
-                full_analysis=full_analysis[:6000],
-                qa_block=qa_block,
+                full_analysis=full_analysis,
+                qa_block="Ответы пациента на уточняющие вопросы:\n" + text,
             )
             await update.message.reply_text("Уточняю заключение с учётом ваших ответов…")
-            refined = await _ask_ai_text(refine_prompt, qa_block)
+            refined = await _ask_ai_text(
+                refine_prompt, text[:500], max_tokens=_output_tokens(ANALYSIS_MAX_PAGES), priority="analysis"
+            )
             if refined:
                 refined = _strip_latex(refined)
                 context.user_data["full_analysis"] = refined
@@ -2779,40 +5236,41 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
 
     # Если не в режиме запроса — обрабатываем как обычный текстовый вопрос
-    has_groq = _use_groq()
-    has_openai = bool(get_openai_client())
-    if not has_groq and not has_openai:
+    if not _any_provider_available():
         await update.message.reply_text(_no_ai_message())
         return
-    await update.message.reply_text("Думаю…")
-    response = await _ask_ai_text(TEXT_PROMPT, text)
-    if response:
-        if len(response) > 4000:
-            response = response[:3997] + "..."
-        await update.message.reply_text(response, reply_markup=MAIN_KEYBOARD)
-    else:
+    response, _ = await _stream_answer(
+        context.bot, update.effective_chat.id, TEXT_PROMPT, text, "Думаю…", max_tokens=1000, step="qa",
+        reply_markup=MAIN_KEYBOARD,
+    )
+    if not response:
         await update.message.reply_text("Не удалось получить ответ.", reply_markup=MAIN_KEYBOARD)
 
 
-def _transcribe_voice_sync(voice_bytes: bytes) -> str:
-    """Синхронная обёртка для транскрибации (вызывается через asyncio.to_thread)."""
-    buf = io.BytesIO(voice_bytes)
-    buf.name = "voice.ogg"
-    client = get_groq_client()
-    if client:
-        try:
-            result = client.audio.transcriptions.create(model="whisper-large-v3", file=buf)
-            return (result.text or "").strip()
-        except Exception as e:
-            logger.warning("Groq Whisper: %s", e)
-    buf.seek(0)
-    client = get_openai_client()
-    if client:
+async def _transcribe_voice(voice_bytes: bytes) -> str:
+    """Транскрибация голосового через Whisper; порядок провайдеров выбирает маршрутизатор."""
+    async with _llm_slot("interactive"):
+        return await _transcribe_routed(voice_bytes)
+
+
+async def _transcribe_routed(voice_bytes: bytes) -> str:
+    for provider in _route_providers():
+        client = _get_ai_client(provider)
+        if not client or not _claim_probe(provider):
+            continue
+        buf = io.BytesIO(voice_bytes)
+        buf.name = "voice.ogg"
+        started = time.monotonic()
         try:
-            result = client.audio.transcriptions.create(model="whisper-1", file=buf)
-            return (result.text or "").strip()
+            result = await client.audio.transcriptions.create(
+                model=WHISPER_MODELS[provider], file=buf, timeout=AI_TEXT_TIMEOUT_SEC
+            )
         except Exception as e:
-            logger.warning("OpenAI Whisper: %s", e)
+            _record_ai_result(provider, time.monotonic() - started, e)
+            logger.warning("%s Whisper: %s", "Groq" if provider == "groq" else "OpenAI", e)
+            continue
+        _record_ai_result(provider, time.monotonic() - started)
+        return (result.text or "").strip()
     return ""
 
 
@@ -2854,21 +5312,6 @@ async def handle_send_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     except Exception:
         pass
 
-    images_b64: List[tuple] = []
-    for file_id, mime in file_ids:
-        try:
-            tg_file = await bot.get_file(file_id)
-            buf = io.BytesIO()
-            await tg_file.download_to_memory(buf)
-            buf.seek(0)
-            images_b64.append((base64.b64encode(buf.read()).decode("utf-8"), mime))
-        except Exception as e:
-            logger.warning("Не удалось загрузить файл %s: %s", file_id, e)
-
-    if not images_b64:
-        await bot.send_message(chat_id, "Не удалось загрузить документы. Попробуйте отправить снова.")
-        return
-
     progress_msg = await bot.send_message(
         chat_id, f"Анализирую ваши данные…\n\n{_progress_bar(0)}"
     )
@@ -2877,21 +5320,25 @@ async def handle_send_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         _progress_updater(bot, chat_id, progress_msg.message_id, stop_event)
     )
 
-    followup_answers = context.user_data.get("last_followup_answers", "") or ""
-    followup_qa = ("\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()[:2000]) if followup_answers.strip() else "Нет."
-    documents_section = "К сообщению приложены медицинские документы пациента (изображения). Внимательно изучи ВСЕ документы и используй данные из них в итоге."
-    prompt = FULL_ANALYSIS_PROMPT.format(
-        survey_data=survey_data,
-        patient_request=patient_request or "Не указан",
-        followup_qa=followup_qa,
-        documents_section=documents_section,
-    )
-    user_msg = (
-        f"Запрос пациента: {patient_request}\n\n"
-        "Приложены медицинские документы. Проведи полный анализ по инструкции (8 пунктов итога)."
-    )
+    analysis = ""
+    findings: List[str] = []
+    post_doc_questions: Optional[List[Dict[str, Any]]] = None
     try:
-        analysis = await _ask_ai_with_images(prompt, user_msg, images_b64)
+        # Этап 1: данные каждого документа параллельно (из кеша или vision-запросом);
+        # этап 2: одно заключение вместе с уточняющими вопросами (структурированный ответ)
+        findings = await _collect_document_findings(bot, file_ids, user_id=user_id)
+        if findings:
+            followup_answers = context.user_data.get("last_followup_answers", "") or ""
+            raw, _ = await _synthesize_analysis(
+                survey_data, patient_request, followup_answers, findings, with_questions=True
+            )
+            parsed = _parse_analysis_with_questions(raw) if raw else None
+            if parsed is not None:
+                analysis, post_doc_questions = parsed
+            else:
+                if raw:
+                    logger.warning("Итог с вопросами не по схеме, запрашиваю итог и вопросы отдельно")
+                analysis, _ = await _synthesize_analysis(survey_data, patient_request, followup_answers, findings)
     finally:
         stop_event.set()
         progress_task.cancel()
@@ -2913,6 +5360,10 @@ async def handle_send_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         except Exception:
             pass
 
+    if not findings:
+        await bot.send_message(chat_id, "Не удалось загрузить документы. Попробуйте отправить снова.")
+        return
+
     if not analysis:
         await bot.send_message(
             chat_id,
@@ -2924,14 +5375,15 @@ async def handle_send_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     context.user_data["full_analysis"] = analysis
     _save_conclusion(user_id, analysis)
 
-    # Уточняющие вопросы после анализа документов для более точного заключения
-    analysis_summary = (analysis[:1500] + "…") if len(analysis) > 1500 else analysis
-    post_doc_prompt = POST_DOC_QUESTIONS_PROMPT.format(
-        patient_request=patient_request or "Не указан",
-        analysis_summary=analysis_summary,
-    )
-    questions_raw = await _ask_ai_text(post_doc_prompt, analysis_summary[:500])
-    post_doc_questions = _parse_questions_from_ai(questions_raw) if questions_raw else []
+    # Уточняющие вопросы обычно пришли вместе с итогом; отдельный запрос — только если структурированный не удался
+    if post_doc_questions is None:
+        analysis_summary = (analysis[:1500] + "…") if len(analysis) > 1500 else analysis
+        post_doc_prompt = POST_DOC_QUESTIONS_PROMPT.format(
+            patient_request=patient_request or "Не указан",
+            analysis_summary=analysis_summary,
+        )
+        questions_raw = await _ask_ai_text(post_doc_prompt, analysis_summary[:500])
+        post_doc_questions = _parse_questions_from_ai(questions_raw) if questions_raw else []
 
     if post_doc_questions:
         context.user_data["post_doc_followup_questions"] = post_doc_questions
@@ -2967,13 +5419,13 @@ async def handle_no_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     bot = context.bot
 
     context.user_data["collecting_docs"] = False
-    _pending.pop(user_id, None)
+    _drop_pending(user_id)
 
     patient_request = context.user_data.get("patient_request", "")
     survey_answers = context.user_data.get("completed_survey_answers") or {}
     survey_data = _format_survey_data(survey_answers)
     followup_answers = context.user_data.get("last_followup_answers", "") or ""
-    followup_qa = ("\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()[:2000]) if followup_answers.strip() else "Нет."
+    followup_qa = ("\n\nОТВЕТЫ ПАЦИЕНТА НА УТОЧНЯЮЩИЕ ВОПРОСЫ:\n" + followup_answers.strip()) if followup_answers.strip() else "Нет."
     documents_section = "Медицинские документы НЕ предоставлены. Используй только данные опроса, запрос и ответы на уточняющие вопросы."
 
     try:
@@ -2988,12 +5440,12 @@ async def handle_no_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         documents_section=documents_section,
     )
 
-    try:
-        analysis = await _ask_ai_text(prompt, (patient_request or "анализ")[:500])
-    except Exception:
-        logger.exception("handle_no_docs: AI error")
-        await bot.send_message(chat_id, "Произошла ошибка при анализе. Попробуйте ещё раз через минуту.", reply_markup=MAIN_KEYBOARD)
-        return
+    # Сразу показываем выводы и рекомендации по мере генерации (без кнопки «Показать результаты»)
+    logger.info("handle_no_docs: потоковый вывод выводов chat_id=%s", chat_id)
+    analysis, _ = await _stream_answer(
+        bot, chat_id, prompt, (patient_request or "анализ")[:500], "Анализирую ваши данные…", html=True,
+        reply_markup=MAIN_KEYBOARD,
+    )
     if not analysis:
         await bot.send_message(chat_id, "Не удалось выполнить анализ. Попробуйте позже.", reply_markup=MAIN_KEYBOARD)
         return
@@ -3002,12 +5454,6 @@ async def handle_no_docs(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     analysis = _strip_foreign_chars(analysis)
     context.user_data["full_analysis"] = analysis
     _save_conclusion(user_id, analysis)
-
-    # Сразу показываем выводы и рекомендации (без кнопки «Показать результаты»)
-    to_show = analysis[:3997] + "..." if len(analysis) > 4000 else analysis
-    formatted = _format_conclusion_for_elderly(to_show)
-    logger.info("handle_no_docs: отправляю выводы пользователю chat_id=%s", chat_id)
-    await _send_long_html(bot, chat_id, formatted, reply_markup=MAIN_KEYBOARD)
     continue_kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Да, продолжить", callback_data=CB_CONTINUE_YES), InlineKeyboardButton("❌ Нет, спасибо", callback_data=CB_CONTINUE_NO)],
     ])
@@ -3031,15 +5477,7 @@ async def handle_show_results(update: Update, context: ContextTypes.DEFAULT_TYPE
     except Exception:
         pass
 
-    if len(analysis) > 4000:
-        analysis = analysis[:3997] + "..."
-    formatted = _format_conclusion_for_elderly(analysis)
-    await bot.send_message(
-        chat_id,
-        formatted,
-        parse_mode="HTML",
-        reply_markup=MAIN_KEYBOARD,
-    )
+    await _send_pages(bot, chat_id, analysis, html=True, reply_markup=MAIN_KEYBOARD)
 
     continue_kb = InlineKeyboardMarkup([
         [
@@ -3132,26 +5570,142 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     context.user_data["tg_phone"] = phone
     sheet_row = context.user_data.get("survey_sheet_row")
     if sheet_row:
-        await asyncio.to_thread(
-            lambda: _sheet_update_phone(sheet_row, phone)
-        )
+        _sheet_update_phone(sheet_row, phone)
     await update.message.reply_text(
         f"Спасибо! Номер {phone} сохранён.",
         reply_markup=MAIN_KEYBOARD,
     )
 
 
-def _sheet_update_phone(row_index: int, phone: str) -> Optional[str]:
-    """Записывает номер телефона в столбец D (телефон)."""
-    try:
-        wks, err = _get_sheet_wks()
-        if wks is None:
-            return err
-        wks.update_cell(row_index, 4, phone)
-        return None
-    except Exception as e:
-        _sheet_cache["wks"] = None
-        return str(e)[:200]
+async def _job_log_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    report = _step_report()
+    if report:
+        logger.info("Метрики ИИ: %s", report)
+    if _vision_cache["hits"] or _vision_cache["misses"]:
+        logger.info(
+            "Кеш документов: попаданий %d, промахов %d, записей %d",
+            _vision_cache["hits"], _vision_cache["misses"], len(_vision_cache["entries"]),
+        )
+    if _speculation_stats["launched"]:
+        logger.info(
+            "Спекулятивные вопросы: запущено %d, использовано %d, промахов %d",
+            _speculation_stats["launched"], _speculation_stats["hits"], _speculation_stats["misses"],
+        )
+    tokens = _token_report()
+    if tokens:
+        logger.info("Токены: %s", tokens)
+    rates = _rate_report()
+    if rates:
+        logger.info("Лимиты провайдеров: %s", rates)
+    sched = _llm_sched_report()
+    if sched:
+        logger.info("Очередь ИИ: %s", sched)
+    if _output_stats["wasted_tokens"] or _output_stats["length_stops"]:
+        logger.info(
+            "Вывод: не показано ~%d токенов, ответов обрезано лимитом max_tokens: %d",
+            _output_stats["wasted_tokens"], _output_stats["length_stops"],
+        )
+    total = _intent_stats["local"] + _intent_stats["llm"]
+    if total:
+        logger.info(
+            "Классификатор намерений: локально %d из %d (%.0f%%)",
+            _intent_stats["local"], total, 100 * _intent_stats["local"] / total,
+        )
+    if _use_db() and (_db_state["replicated"] or _db_state["failures"]):
+        logger.info(
+            "Зеркало в таблицу: выгружено строк %d, ошибок %d, ждут выгрузки %d",
+            _db_state["replicated"], _db_state["failures"], await asyncio.to_thread(_db_backlog),
+        )
+    if _sheet_write_state["flushes"] or _sheet_writes:
+        logger.info(
+            "Запись в таблицу: ячеек %d за %d запросов, ошибок %d, в очереди строк %d",
+            _sheet_write_state["cells"], _sheet_write_state["calls"], _sheet_write_state["failures"], len(_sheet_writes),
+        )
+    _prefetch_sweep()
+    if _prefetch_state["hits"] or _prefetch:
+        logger.info(
+            "Предзагрузка: использовано %d, не поместилось %d, в памяти %d КБ",
+            _prefetch_state["hits"], _prefetch_state["dropped"], _prefetch_state["bytes"] // 1024,
+        )
+
+
+async def _on_startup(app: Application) -> None:
+    _start_ai_warmup()
+    await asyncio.to_thread(_vision_cache_load)
+    # Сначала дописываем в таблицу очередь прошлого запуска — иначе импорт в базу её не увидит
+    await asyncio.to_thread(_sheet_queue_load)
+    if await _sheet_flush():
+        await asyncio.to_thread(_sheet_queue_save)
+        await asyncio.to_thread(_storage_open)
+    elif STORAGE_BACKEND == "sqlite":
+        logger.warning("Очередь записи в таблицу не выгружена — импорт в базу повторит фоновая задача")
+    await asyncio.to_thread(_survey_index_warm)
+    if app.job_queue:
+        app.job_queue.run_repeating(_job_log_metrics, interval=AI_METRICS_LOG_SEC, first=AI_METRICS_LOG_SEC)
+        app.job_queue.run_repeating(_job_sheet_flush, interval=SHEET_FLUSH_SEC, first=SHEET_FLUSH_SEC)
+
+
+async def _on_shutdown(app: Application) -> None:
+    if _use_db():
+        for _ in range(10):
+            if await asyncio.to_thread(_db_replicate):
+                break
+    await _sheet_flush()
+    await asyncio.to_thread(_sheet_queue_save)
+    await asyncio.to_thread(_storage_close)
+    await asyncio.to_thread(_vision_cache_save)
+    _image_pool.shutdown(wait=False)
+    report = _step_report()
+    if report:
+        logger.info("Метрики ИИ: %s", report)
+    await _close_ai_clients()
+
+
+# Обновления разных пользователей обрабатываются параллельно (не больше UPDATE_CONCURRENCY сразу),
+# обновления одного пользователя — строго по очереди, чтобы context.user_data менялся в порядке сообщений.
+# Лимит PTB задан заведомо большим, реальный — свой семафор, который берётся уже после очереди пользователя:
+# серия сообщений одного пользователя ждёт в своей очереди и не занимает слоты, нужные другим
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_QUEUE_LIMIT = 100000
+
+
+class _PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с очередью на каждого пользователя (asyncio.Lock по user_id)."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(UPDATE_QUEUE_LIMIT)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        _llm_user.set(key)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                self._waiting.pop(key, None)
+                self._locks.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 def main() -> None:
@@ -3159,7 +5713,14 @@ def main() -> None:
     if not token:
         raise ValueError("Задай BOT_TOKEN в .env или в переменных окружения")
 
-    app = Application.builder().token(token).build()
+    app = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(_PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(_on_startup)
+        .post_shutdown(_on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))